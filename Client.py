@@ -1,10 +1,18 @@
 from abc import ABC, abstractmethod
 import logging
+import queue
 import socket
+import threading
+from collections import deque
 import GameData
 from constants import HOST, PORT, DATASIZE
 from sys import stdout
-from hanabi_model import HanabiAction, Play, Discard, Hint, UnknownCard
+from hanabi_model import (
+    HanabiAction,
+    action_from_server_data,
+    request_from_action,
+)
+from state_mirror import StateMirror
 
 logging.basicConfig(
     format="[%(asctime)s] %(levelname)s: %(message)s",
@@ -25,19 +33,42 @@ class ClientState:
 class Client(ABC):
     """A class encapsulating some methods to comunicate with the server."""
 
-    def __init__(self, name, host=HOST, port=PORT):
+    def __init__(
+        self,
+        name,
+        host=HOST,
+        port=PORT,
+        mirror_state=True,
+        background_reader=False,
+        transport=None,
+    ):
         self.player_name = name
         self.host = host
         self.port = port
-        self.socket = None
+        # if given, a socket-like object (send, recv) used instead of a
+        # new connection, e.g. a seat of a multiplexed Session
+        self.socket = transport
         self.state = ClientState.NOT_CONNECTED
         self.current_player = None
+        self.actions = None  # actions of the game registered so far
+        # if set, the state is rebuilt from the actions instead of fetched
+        self.mirror_state = mirror_state
+        self.mirror = None
+        # set when the last fetched state is ahead of the mirror
+        self.mirror_stale = False
+        self.state_requests = 0
+        # responses received while waiting for a state, to be read next
+        self.pending = deque()
+        # if set, a thread reads and decodes the responses in background
+        self.background_reader = background_reader
+        self.responses = None
         # self.player_order = None
         self.__connect()
 
     def __connect(self):
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.connect((self.host, self.port))
+        if self.socket is None:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.connect((self.host, self.port))
         connection_request = GameData.ClientPlayerAddData(self.player_name)
         self.__send_request(connection_request)
         response = self.__read_response()
@@ -46,16 +77,59 @@ class Client(ABC):
             logging.info(
                 f"Connection accepted by the server. Welcome {self.player_name}"
             )
+        elif type(response) is GameData.ServerActionInvalid:
+            raise ConnectionError(f"Connection refused by the server: {response.message}")
         else:
             raise ConnectionError("There was an error while connecting to the server.")
+        if self.background_reader:
+            self.__start_reader()
         return
 
-    def __read_response(self) -> GameData.ServerToClientData:
-        """Read the next server response."""
+    def __start_reader(self):
+        self.responses = queue.Queue()
+        reader = threading.Thread(
+            target=self.__reader_loop, name=f"{self.player_name}-reader", daemon=True
+        )
+        reader.start()
+        return
+
+    def __reader_loop(self):
+        """Decode the server responses into the responses queue until the
+        connection is closed. Errors are queued too, to be raised by
+        __read_response."""
+        while True:
+            try:
+                response = self.__receive()
+            except Exception as e:
+                self.responses.put(e)
+                return
+            self.responses.put(response)
+
+    def __receive(self) -> GameData.ServerToClientData:
+        """Read and decode the next response from the socket."""
         data = self.socket.recv(DATASIZE)
+        if not data:
+            raise ConnectionError("Connection closed by the server.")
+        # the server sends frames of DATASIZE bytes, which may be split
+        while len(data) < DATASIZE:
+            chunk = self.socket.recv(DATASIZE - len(data))
+            if not chunk:
+                raise ConnectionError("Connection closed by the server.")
+            data += chunk
         response = GameData.GameData.deserialize(data)
         return response
 
+    def __read_response(self) -> GameData.ServerToClientData:
+        """Read the next server response."""
+        if self.pending:
+            return self.pending.popleft()
+        if self.responses is None:
+            return self.__receive()
+        response = self.responses.get()
+        if isinstance(response, Exception):
+            raise response
+        return response
+
     def __send_request(self, request: GameData.ClientToServerData):
         """Send the specified request to the server."""
         self.socket.send(request.serialize())
@@ -65,6 +139,7 @@ class Client(ABC):
         """Send a status request to the server"""
         request = GameData.ClientGetGameStateRequest(self.player_name)
         self.__send_request(request)
+        self.state_requests += 1
         return
 
     def send_start(self):
@@ -95,6 +170,11 @@ class Client(ABC):
                 self.state = ClientState.IN_GAME
 
                 state = self.fetch_state()
+                # the state already includes the actions played meanwhile: its
+                # action count (state.actions) is where HanabiState starts counting
+                self.pending.clear()
+                if self.mirror_state:
+                    self.mirror = StateMirror(self.player_name, state)
                 self._init_game_state(state)
 
                 logging.debug(msg="{self.player_name} - ready request sent")
@@ -106,6 +186,7 @@ class Client(ABC):
     @abstractmethod
     def _init_game_state(self, state: GameData.ServerGameStateData):
         self.current_player = state.currentPlayer
+        self.actions = state.actions
         return
 
     def run(self):
@@ -113,16 +194,33 @@ class Client(ABC):
             return
         s = self.socket
         while self.state == ClientState.IN_GAME:
-            if self.current_player == self.player_name:
+            # the actions received meanwhile are registered before deciding
+            if self.current_player == self.player_name and not self.pending:
                 action = self.get_action_to_be_played()  # implemented by agent subclass
                 action_result, new_state = self.__play_action(action)
             else:
                 action_result, new_state = self.fetch_action_result()
             if action_result is not None:  # possbible for game over
                 self.update_state_with_action(action_result, new_state)
+                if self.__is_idle():
+                    self.prepare_decision()
             stdout.flush()
         return
 
+    def __is_idle(self) -> bool:
+        """Return True if the client would only wait for the other players."""
+        return (
+            self.responses is not None
+            and self.responses.empty()
+            and not self.pending
+            and self.current_player != self.player_name
+        )
+
+    def prepare_decision(self):
+        """Called while waiting for the other players: the agent subclass
+        can precompute what its next decision needs."""
+        return
+
     @abstractmethod
     def get_action_to_be_played(self):
         """Return the action to be played.
@@ -130,44 +228,13 @@ class Client(ABC):
         raise NotImplementedError
 
     def __play_action(self, action: HanabiAction):
-        if type(action) is Play:
-            self.__play_card(action)
-        elif type(action) is Discard:
-            self.__discard_card(action)
-        elif type(action) is Hint:
-            self.__give_hint(action)
-        else:
-            raise TypeError(f"Inappropriate action type: {action}")
+        request = request_from_action(action, self.player_name, self.actions)
+        if self.state == ClientState.IN_GAME:
+            self.__send_request(request)
         # check server response:
         action_result, new_state = self.fetch_action_result()
         return action_result, new_state
 
-    def __discard_card(self, discard: Discard):
-        """Send the appropriate request to play the given card."""
-        if self.state == ClientState.IN_GAME:
-            discard_req = GameData.ClientPlayerDiscardCardRequest(
-                self.player_name, discard.card_index
-            )
-            self.__send_request(discard_req)
-        return
-
-    def __play_card(self, play: Play):
-        if self.state != ClientState.IN_GAME:
-            return
-        play_req = GameData.ClientPlayerPlayCardRequest(
-            self.player_name, play.card_index
-        )
-        self.__send_request(play_req)
-        return
-
-    def __give_hint(self, hint: Hint):
-        if self.state == ClientState.IN_GAME:
-            hint_req = GameData.ClientHintData(
-                self.player_name, hint.to, hint._type, hint.value
-            )
-            self.__send_request(hint_req)
-        return
-
     def fetch_action_result(self) -> tuple:
         """Return a tuple (HanabiAction, GameData.ServerGameStateData)
         The first element is the action performed.
@@ -189,24 +256,52 @@ class Client(ABC):
         elif type(response) is GameData.ServerInvalidDataReceived:
             raise ValueError(f"InvalidData received: {response.data}")
         elif type(response) is GameData.ServerGameOver:
-            logging.info("The game is over.")
+            logging.info(
+                f"The game is over. {self.state_requests} state requests sent."
+            )
             self.state = ClientState.GAME_OVER
             return None, None
 
         logging.debug(response)
-        new_state = self.fetch_state()
+        new_state = None
+        if self.mirror is not None and not self.mirror_stale:
+            new_state = self.mirror.apply(response)
+        if new_state is None or self.mirror.needs_resync:
+            server_state = self.fetch_state()
+            if self.state == ClientState.GAME_OVER:
+                return None, None
+            if self.mirror is not None:
+                if self.pending:
+                    # the state is ahead of this action: mirror again
+                    # once the pending actions are registered
+                    self.mirror_stale = True
+                elif new_state is None:
+                    self.mirror_stale = False
+                    self.mirror.reset(server_state)
+                else:
+                    self.mirror.verify(server_state)
+            new_state = server_state
         played_action = self.build_action_from_server_response(response, new_state)
         return (played_action, new_state)
 
     def fetch_state(self) -> GameData.ServerGameStateData:
         """Send a ClientGetGameStateRequest and return the
-        received ServerGameStateData."""
+        received ServerGameStateData. The actions received while waiting
+        are kept in `pending`, to be read next."""
         if self.state != ClientState.IN_GAME:
             raise RuntimeError("You must be in game")
         self.__send_status()
+        received = []
         response = self.__read_response()
         while not type(response) is GameData.ServerGameStateData:
+            if type(response) is GameData.ServerGameOver:
+                # the game ended while waiting for the state
+                logging.info("The game is over.")
+                self.state = ClientState.GAME_OVER
+            else:
+                received.append(response)
             response = self.__read_response()
+        self.pending.extend(received)
         return response
         # raise ValueError(f"Invalid state received. {response} received.")
 
@@ -218,57 +313,12 @@ class Client(ABC):
     ):
         """Update current player"""
         self.current_player = new_state.currentPlayer
+        self.actions += 1
         return
 
     def build_action_from_server_response(
         self, data: GameData.ServerToClientData, new_state: GameData.ServerToClientData
     ):
         """Create an Hanabi action from the server response and the new state after the action"""
-
-        if type(data) is GameData.ServerHintData:
-            # an hint has been sent :^O
-            sender = data.source
-            destination = data.destination
-            _type = data.type
-            value = data.value
-            positions = data.positions
-            return Hint(sender, destination, _type, value, positions)
-
-        elif type(data) is GameData.ServerActionValid:
-            # a discard has been performed :^)
-            # include the drawn card in the created Discard action
-            sender = data.lastPlayer
-            card_index = data.cardHandIndex
-            card_discarded = data.card
-            card_drawn = self.get_new_sender_card(sender, new_state, card_index)
-            return Discard(sender, card_index, card_discarded, card_drawn)
-
-        elif type(data) is GameData.ServerPlayerMoveOk:
-            # a card has been successfully played :^D
-            sender = data.lastPlayer
-            card_index = data.cardHandIndex
-            real_card = data.card
-            card_drawn = self.get_new_sender_card(sender, new_state, card_index)
-            result = Play.GOOD_MOVE
-            return Play(sender, card_index, real_card, card_drawn, result)
-
-        elif type(data) is GameData.ServerPlayerThunderStrike:
-            # a card has been unsuccessfully played :^@
-            sender = data.lastPlayer
-            card_index = data.cardHandIndex
-            real_card = data.card
-            card_drawn = self.get_new_sender_card(sender, new_state, card_index)
-            result = Play.THUNDERSTRIKE
-            return Play(sender, card_index, real_card, card_drawn, result)
-        else:
-            raise ValueError("Invalid action response: {data}")
-
-    def get_new_sender_card(
-        self, sender: str, new_state: GameData.ServerGameStateData, card_index: int
-    ):
-        if sender == self.player_name:
-            return UnknownCard()
-        for p in new_state.players:
-            if p.name == sender:
-                return p.hand[-1]  # drawn card are appended to the player hand
-        raise ValueError("Unable to fetch the new drawn card!!")
+        # a fetched state also includes the pending responses, which follow this one
+        return action_from_server_data(data, new_state, self.player_name, self.pending)
@@ -34,6 +34,9 @@ class ClientToServerData(GameData):
     def __init__(self, sender, action) -> None:
         super().__init__(sender)
         self.action = action # debug purposes
+        # actions performed in the game as seen by the sender, if it counts them:
+        # the server drops the requests sent before its latest action
+        self.actions = None
 
 class ClientHintData(ClientToServerData):
     '''
@@ -60,6 +63,18 @@ class ClientPlayerAddData(ClientToServerData):
         action = "Connection request"
         super().__init__(sender, action)
 
+class ClientSpectatorAddData(ClientToServerData):
+    '''
+    A connection request from a spectator to the server.
+    The spectator does not play: it receives the events of the table.
+    fullInformation: if True, the spectator also receives the state of the game,
+        with every hand, after every action.
+    '''
+    def __init__(self, sender, fullInformation: bool = False) -> None:
+        action = "Spectator connection request"
+        self.fullInformation = fullInformation
+        super().__init__(sender, action)
+
 class ClientPlayerStartRequest(ClientToServerData):
     '''
     The client says it's ready to play.
@@ -149,6 +164,16 @@ class ServerPlayerConnectionOk(ServerToClientData):
         self.message = "Player " + str(playerName) + " connected succesfully!"
         super().__init__(action)
 
+class ServerSpectatorConnectionOk(ServerToClientData):
+    '''
+    Server successfully received the connection request from the spectator.
+    The events of the table follow, starting from the state of the game if it is in progress.
+    '''
+    def __init__(self, spectatorName) -> None:
+        action = "Spectator connection ok"
+        self.message = "Spectator " + str(spectatorName) + " connected succesfully!"
+        super().__init__(action)
+
 class ServerPlayerStartRequestAccepted(ServerToClientData):
     '''
     The server acknowledges you are ready.
@@ -182,9 +207,10 @@ class ServerGameStateData(ServerToClientData):
     usedStormTokens: used red (storm) tokens. 0 is the minimum, 3 is the maximum. At 3 the game is over.
     tableCards: shows the cards that are currently being played (forming the current firework).
     discardPile: shows the discard pile.
+    actions: the number of actions (hints, plays, discards) performed since the start of the game.
     NOTE: params might get added on request, if the game allows for it.
     '''
-    def __init__(self, currentPlayer: str, handSize: int, players: list, usedNoteTokens: int, usedStormTokens: int, table: list, discard: list) -> None:
+    def __init__(self, currentPlayer: str, handSize: int, players: list, usedNoteTokens: int, usedStormTokens: int, table: list, discard: list, actions: int = 0) -> None:
         action = "Show cards response"
         self.currentPlayer = currentPlayer
         self.handSize = handSize
@@ -193,6 +219,7 @@ class ServerGameStateData(ServerToClientData):
         self.usedStormTokens = usedStormTokens
         self.tableCards = table
         self.discardPile = discard
+        self.actions = actions
         super().__init__(action)
 
 
@@ -290,4 +317,26 @@ class ServerGameOver(ServerToClientData):
         self.message = "Game over"
         self.score = score
         self.scoreMessage = scoreMessage
-        super().__init__(action)
\ No newline at end of file
+        super().__init__(action)
+
+# Multiplexed sessions
+class SeatFrame(GameData):
+    '''
+    A frame of a multiplexed session: many seats share one connection.
+    The first frame of the connection makes it a session.
+    seat: the seat id chosen by the client. None from the server: the data is for every seat of the session.
+    payload: the data of the seat, already serialized (without the padding). None closes the seat.
+    '''
+    def __init__(self, seat, payload: bytes) -> None:
+        self.seat = seat
+        self.payload = payload
+        super().__init__("Session")
+
+    @staticmethod
+    def wrap(seat, serialized: bytes):
+        binarySize = serialized[0:2]
+        datasize = int.from_bytes(binarySize, 'little')
+        return SeatFrame(seat, serialized[2:datasize + 2])
+
+    def unwrap(self):
+        return pickle.loads(self.payload)
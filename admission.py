@@ -0,0 +1,54 @@
+"""Admission control of the server connections.
+
+A TokenBucket admits `rate` events per second on average, and bursts of
+up to `burst` events. AdmissionStats counts the connections accepted and
+turned away, and the time from accept to the answer of the first request
+(the connection setup latency seen by the server)."""
+import threading
+from time import monotonic
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = monotonic()
+        self.lock = threading.Lock()
+
+    def try_take(self) -> bool:
+        """Take a token if there is one, without waiting."""
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class AdmissionStats:
+    def __init__(self):
+        self.accepted = 0
+        self.busy = 0  # turned away: too many connections in handshake
+        self.throttled = 0  # turned away: players joining too fast
+        self.handshakes = 0
+        self.handshake_time = 0.0
+        self.max_handshake_time = 0.0
+        self.lock = threading.Lock()
+
+    def add_handshake(self, seconds: float):
+        with self.lock:
+            self.handshakes += 1
+            self.handshake_time += seconds
+            self.max_handshake_time = max(self.max_handshake_time, seconds)
+        return
+
+    def to_string(self) -> str:
+        mean = self.handshake_time / self.handshakes if self.handshakes else 0.0
+        return (
+            f"accepted: {self.accepted}; busy: {self.busy}; "
+            f"throttled: {self.throttled}; setup time: mean {1000 * mean:.2f} ms, "
+            f"max {1000 * self.max_handshake_time:.2f} ms"
+        )
@@ -0,0 +1,243 @@
+from abc import ABC, abstractmethod
+import asyncio
+import logging
+from collections import deque
+import GameData
+from constants import HOST, PORT, DATASIZE
+from client import ClientState
+from hanabi_model import (
+    HanabiAction,
+    action_from_server_data,
+    request_from_action,
+)
+from state_mirror import StateMirror
+
+
+################### ASYNC CLIENT ###################
+class AsyncClient(ABC):
+    """The asyncio counterpart of Client: a single event loop can drive
+    many clients, without a thread per seat.
+
+    The decision hook get_action_to_be_played is a plain method: it runs
+    inline in the event loop, or in `executor` if one is given
+    (see loop.run_in_executor)."""
+
+    def __init__(self, name, host=HOST, port=PORT, executor=None, mirror_state=True):
+        self.player_name = name
+        self.host = host
+        self.port = port
+        self.executor = executor
+        # if set, the state is rebuilt from the actions instead of fetched
+        self.mirror_state = mirror_state
+        self.mirror = None
+        # set when the last fetched state is ahead of the mirror
+        self.mirror_stale = False
+        self.state_requests = 0
+        # responses received while waiting for a state, to be read next
+        self.pending = deque()
+        self.reader = None
+        self.writer = None
+        self.state = ClientState.NOT_CONNECTED
+        self.current_player = None
+        self.actions = None  # actions of the game registered so far
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        connection_request = GameData.ClientPlayerAddData(self.player_name)
+        await self._send_request(connection_request)
+        response = await self._read_response()
+        if type(response) is GameData.ServerPlayerConnectionOk:
+            self.state = ClientState.CONNECTED
+            logging.info(
+                f"Connection accepted by the server. Welcome {self.player_name}"
+            )
+        elif type(response) is GameData.ServerActionInvalid:
+            raise ConnectionError(f"Connection refused by the server: {response.message}")
+        else:
+            raise ConnectionError("There was an error while connecting to the server.")
+        return
+
+    async def _read_response(self) -> GameData.ServerToClientData:
+        """Read the next server response."""
+        if self.pending:
+            return self.pending.popleft()
+        # the server always sends frames of exactly DATASIZE bytes
+        data = await self.reader.readexactly(DATASIZE)
+        response = GameData.GameData.deserialize(data)
+        return response
+
+    async def _send_request(self, request: GameData.ClientToServerData):
+        """Send the specified request to the server."""
+        self.writer.write(request.serialize())
+        await self.writer.drain()
+        return
+
+    async def _send_status(self):
+        """Send a status request to the server"""
+        request = GameData.ClientGetGameStateRequest(self.player_name)
+        await self._send_request(request)
+        self.state_requests += 1
+        return
+
+    async def send_start(self):
+        if self.state != ClientState.CONNECTED:
+            raise RuntimeError("You must be connected")
+
+        start_request = GameData.ClientPlayerStartRequest(self.player_name)
+        await self._send_request(start_request)
+        response = await self._read_response()
+        if type(response) is GameData.ServerPlayerStartRequestAccepted:
+            self.state = ClientState.LOBBY
+            logging.info(
+                msg=f"{self.player_name} - Ready: {response.acceptedStartRequests}/{response.connectedPlayers}"
+            )
+        else:
+            raise ConnectionError("Invalid response received on Start request.")
+        return
+
+    async def wait_start(self):
+        if self.state != ClientState.LOBBY:
+            raise RuntimeError("You have to be in the lobby")
+        # read until it's a ServerStart
+        while self.state != ClientState.IN_GAME:
+            response = await self._read_response()
+            if type(response) is GameData.ServerStartGameData:
+                ready_request = GameData.ClientPlayerReadyData(self.player_name)
+                await self._send_request(ready_request)
+                self.state = ClientState.IN_GAME
+
+                state = await self.fetch_state()
+                # the state already includes the actions played meanwhile: its
+                # action count (state.actions) is where HanabiState starts counting
+                self.pending.clear()
+                if self.mirror_state:
+                    self.mirror = StateMirror(self.player_name, state)
+                self._init_game_state(state)
+
+                logging.info(msg=f"{self.player_name} - Game started")
+            logging.debug(msg=f"response received: {response} of type {type(response)}")
+        return True
+
+    @abstractmethod
+    def _init_game_state(self, state: GameData.ServerGameStateData):
+        self.current_player = state.currentPlayer
+        self.actions = state.actions
+        return
+
+    async def run(self):
+        if self.state != ClientState.IN_GAME:
+            return
+        while self.state == ClientState.IN_GAME:
+            # the actions received meanwhile are registered before deciding
+            if self.current_player == self.player_name and not self.pending:
+                action = await self.decide()
+                await self._send_action(action)
+            action_result, new_state = await self.fetch_action_result()
+            if action_result is not None:  # possbible for game over
+                self.update_state_with_action(action_result, new_state)
+                if not self.pending and self.current_player != self.player_name:
+                    self.prepare_decision()
+        return
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            await self.writer.wait_closed()
+        return
+
+    async def decide(self) -> HanabiAction:
+        """Run the decision hook, inline or in the executor."""
+        if self.executor is None:
+            return self.get_action_to_be_played()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.get_action_to_be_played)
+
+    def prepare_decision(self):
+        """Called inline, while waiting for the other players: the agent
+        subclass can precompute what its next decision needs."""
+        return
+
+    @abstractmethod
+    def get_action_to_be_played(self):
+        """Return the action to be played.
+        Implemented by the agent subclass."""
+        raise NotImplementedError
+
+    async def _send_action(self, action: HanabiAction):
+        request = request_from_action(action, self.player_name, self.actions)
+        if self.state != ClientState.IN_GAME:
+            return
+        await self._send_request(request)
+        return
+
+    async def fetch_action_result(self) -> tuple:
+        """Return a tuple (HanabiAction, GameData.ServerGameStateData),
+        see Client.fetch_action_result."""
+        response = await self._read_response()
+
+        if type(response) is GameData.ServerActionInvalid:
+            raise ValueError(f"ActionInvalid received: {response.message}")
+        elif type(response) is GameData.ServerInvalidDataReceived:
+            raise ValueError(f"InvalidData received: {response.data}")
+        elif type(response) is GameData.ServerGameOver:
+            logging.info(
+                f"The game is over. {self.state_requests} state requests sent."
+            )
+            self.state = ClientState.GAME_OVER
+            return None, None
+
+        logging.debug(response)
+        new_state = None
+        if self.mirror is not None and not self.mirror_stale:
+            new_state = self.mirror.apply(response)
+        if new_state is None or self.mirror.needs_resync:
+            server_state = await self.fetch_state()
+            if self.state == ClientState.GAME_OVER:
+                return None, None
+            if self.mirror is not None:
+                if self.pending:
+                    # the state is ahead of this action: mirror again
+                    # once the pending actions are registered
+                    self.mirror_stale = True
+                elif new_state is None:
+                    self.mirror_stale = False
+                    self.mirror.reset(server_state)
+                else:
+                    self.mirror.verify(server_state)
+            new_state = server_state
+        # a fetched state also includes the pending responses, which follow this one
+        played_action = action_from_server_data(
+            response, new_state, self.player_name, self.pending
+        )
+        return (played_action, new_state)
+
+    async def fetch_state(self) -> GameData.ServerGameStateData:
+        """Send a ClientGetGameStateRequest and return the
+        received ServerGameStateData. The actions received while waiting
+        are kept in `pending`, to be read next."""
+        if self.state != ClientState.IN_GAME:
+            raise RuntimeError("You must be in game")
+        await self._send_status()
+        received = []
+        response = await self._read_response()
+        while not type(response) is GameData.ServerGameStateData:
+            if type(response) is GameData.ServerGameOver:
+                # the game ended while waiting for the state
+                logging.info("The game is over.")
+                self.state = ClientState.GAME_OVER
+            else:
+                received.append(response)
+            response = await self._read_response()
+        self.pending.extend(received)
+        return response
+
+    @abstractmethod
+    def update_state_with_action(
+        self,
+        played_action: HanabiAction,
+        new_state: GameData.ServerGameStateData,
+    ):
+        """Update current player"""
+        self.current_player = new_state.currentPlayer
+        self.actions += 1
+        return
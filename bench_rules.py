@@ -0,0 +1,103 @@
+"""Benchmark the decision latency of the rule pipeline.
+
+A corpus of decision points is recorded from local self-play games, then
+every recorded state is decided both by evaluating every rule guard at
+runtime and by the compiled RulePipeline (RulePipeline.match, bypassing the
+decision cache). The two are interleaved on every state, each on a fresh
+copy of the state and of its DecisionContext, and each latency is the best
+of `repeats` runs, so that neither side benefits from the order.
+
+    python bench_rules.py [n_games] [corpus_file]
+"""
+import logging
+import os
+import pickle
+import random
+import sys
+from contextlib import redirect_stdout
+from statistics import mean, median
+from time import perf_counter
+from hanabi_model import DecisionContext
+from local_game import LocalGame
+from rule_pipeline import RulePipeline
+
+
+def record_corpus(n_games: int, seed=0) -> list:
+    """Play `n_games` local games (2 to 5 players) and return the pickled
+    HanabiState of every decision point."""
+    corpus = []
+    random.seed(seed)
+
+    def record(seat, action):
+        corpus.append(pickle.dumps(seat.hanabi_state))
+
+    for i in range(n_games):
+        LocalGame(2 + i % 4, on_decision=record).play()
+    return corpus
+
+
+def decide_unindexed(pipeline: RulePipeline, state, ctx):
+    """Decide as the agent used to: every rule checks its guards at runtime."""
+    for rule in pipeline.rules:
+        if not rule.is_eligible(state.used_note_tokens, state.used_storm_tokens):
+            continue
+        action = rule.match(state, ctx)
+        if action is not None:
+            return action
+    return None
+
+
+def decide_compiled(pipeline: RulePipeline, state, ctx):
+    return pipeline.match(state, ctx)
+
+
+def time_decisions(deciders: dict, pipeline: RulePipeline, corpus: list, repeats=3) -> dict:
+    """Return the latencies of every decider (name: function) on the corpus."""
+    latencies = {name: [] for name in deciders}
+    for i, data in enumerate(corpus):
+        best = {name: float("inf") for name in deciders}
+        for _ in range(repeats):
+            for name, decide in deciders.items():
+                state = pickle.loads(data)
+                ctx = DecisionContext(state)
+                random.seed(i)
+                start = perf_counter()
+                decide(pipeline, state, ctx)
+                best[name] = min(best[name], perf_counter() - start)
+        for name in deciders:
+            latencies[name].append(best[name])
+    return latencies
+
+
+def report(name: str, latencies: list):
+    latencies = sorted(latencies)
+    p99 = latencies[int(len(latencies) * 0.99)]
+    print(
+        f"{name:>10}: mean {mean(latencies) * 1e6:8.1f} us"
+        f"  median {median(latencies) * 1e6:8.1f} us  p99 {p99 * 1e6:8.1f} us"
+    )
+
+
+if __name__ == "__main__":
+    n_games = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    corpus_file = sys.argv[2] if len(sys.argv) > 2 else None
+    logging.getLogger().setLevel(logging.WARNING)
+
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        if corpus_file is not None and os.path.exists(corpus_file):
+            with open(corpus_file, "rb") as f:
+                corpus = pickle.load(f)
+        else:
+            corpus = record_corpus(n_games)
+            if corpus_file is not None:
+                with open(corpus_file, "wb") as f:
+                    pickle.dump(corpus, f)
+
+        pipeline = RulePipeline()
+        latencies = time_decisions(
+            {"unindexed": decide_unindexed, "compiled": decide_compiled}, pipeline, corpus
+        )
+
+    print(f"{len(corpus)} recorded decision points")
+    for name, values in latencies.items():
+        report(name, values)
@@ -0,0 +1,303 @@
+"""Self-play datasets of the rule based policy.
+
+Every decision point of headless LocalGames is encoded as a fixed-width
+observation, the mask of the legal actions, the chosen action and the
+final score of the game. Records are appended to memory-mapped NumPy
+shards (.npy files, see np.lib.format.open_memmap) listed in index.json,
+and read back without copies by ShardDataset.
+
+    python dataset.py generate DIR [--games N] [--workers W] [--seed S]
+    python dataset.py read DIR [--batch-size B]
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+import numpy as np
+from hanabi_model import (
+    HanabiAction,
+    HanabiState,
+    HandBelief,
+    Hint,
+    Play,
+    Discard,
+    UnknownCard,
+)
+from local_game import LocalGame
+
+MAX_HAND_SIZE = 5
+MAX_OTHER_PLAYERS = 4
+N_TYPES = HandBelief.N_TYPES
+N_COLORS = len(UnknownCard.COLORS)
+
+# observation layout, in order
+OBSERVATION_FIELDS = [
+    ("tokens", 2),  # used note and storm tokens, normalized
+    ("table", N_COLORS),  # height of each firework / 5
+    ("discard", N_TYPES),  # discarded copies of each type / copies
+    ("deck", 1),  # cards left to draw / 50
+    ("n_players", 4),  # one hot, 2 to 5 players
+    ("my_slots", MAX_HAND_SIZE),  # 1 for the slots holding a card
+    ("my_belief", MAX_HAND_SIZE * N_TYPES),  # P(slot holds type)
+    # the hands of the other players, starting from the next one
+    ("other_hands", MAX_OTHER_PLAYERS * MAX_HAND_SIZE * N_TYPES),  # one hot
+    ("other_clued", MAX_OTHER_PLAYERS * MAX_HAND_SIZE),  # 1 if clued
+]
+OBSERVATION_SIZE = sum(size for _, size in OBSERVATION_FIELDS)
+
+# action space: play slot, discard slot, hint color or value to the
+# i-th next player
+N_PLAY = MAX_HAND_SIZE
+N_DISCARD = MAX_HAND_SIZE
+HINTS_PER_PLAYER = N_COLORS + 5
+N_ACTIONS = N_PLAY + N_DISCARD + MAX_OTHER_PLAYERS * HINTS_PER_PLAYER
+
+RECORD_DTYPE = np.dtype(
+    [
+        ("observation", np.float32, (OBSERVATION_SIZE,)),
+        ("legal", np.bool_, (N_ACTIONS,)),
+        ("action", np.int16),
+        ("score", np.int8),
+        ("n_players", np.int8),
+        ("game", np.int32),
+    ]
+)
+
+
+def encode_observation(state: HanabiState, out: np.ndarray = None) -> np.ndarray:
+    """Return the observation vector of the agent owning `state`."""
+    if out is None:
+        out = np.zeros(OBSERVATION_SIZE, dtype=np.float32)
+    else:
+        out[:] = 0
+    fields = dict()
+    offset = 0
+    for name, size in OBSERVATION_FIELDS:
+        fields[name] = out[offset : offset + size]
+        offset += size
+
+    ledger = state.ledger
+    fields["tokens"][:] = (state.used_note_tokens / 8, state.used_storm_tokens / 3)
+    for i, color in enumerate(UnknownCard.COLORS):
+        fields["table"][i] = ledger.table_heights[color] / 5
+    for (value, color), n in ledger.discard_counts.items():
+        t = HandBelief.type_index(value, color)
+        fields["discard"][t] = n / HandBelief.TYPE_COPIES[t]
+    fields["deck"][0] = state.deck_size() / 50
+    fields["n_players"][len(state.players_list) - 2] = 1
+
+    belief = state.inference.belief.probabilities()
+    fields["my_slots"][: len(belief)] = 1
+    fields["my_belief"].reshape(MAX_HAND_SIZE, N_TYPES)[: len(belief)] = belief
+
+    hands = fields["other_hands"].reshape(MAX_OTHER_PLAYERS, MAX_HAND_SIZE, N_TYPES)
+    clued = fields["other_clued"].reshape(MAX_OTHER_PLAYERS, MAX_HAND_SIZE)
+    for p, player in enumerate(state.get_relative_player_order()):
+        hints = state.get_clued_cards(player.name)
+        for slot, card in enumerate(player.hand):
+            hands[p, slot, HandBelief.type_index(card.value, card.color)] = 1
+            clued[p, slot] = card in hints
+    return out
+
+
+def action_index(state: HanabiState, action: HanabiAction) -> int:
+    """Return the index of the action in the action space."""
+    if type(action) is Play:
+        return action.card_index
+    if type(action) is Discard:
+        return N_PLAY + action.card_index
+    if type(action) is Hint:
+        names = [p.name for p in state.get_relative_player_order()]
+        if action._type == Hint.HINT_TYPE_VAL:
+            hint = N_COLORS + action.value - 1
+        else:
+            hint = UnknownCard.COLORS.index(action.value)
+        return N_PLAY + N_DISCARD + names.index(action.to) * HINTS_PER_PLAYER + hint
+    raise TypeError(f"Inappropriate action type: {action}")
+
+
+def legal_actions(state: HanabiState, out: np.ndarray = None) -> np.ndarray:
+    """Return the boolean mask of the legal actions."""
+    if out is None:
+        out = np.zeros(N_ACTIONS, dtype=np.bool_)
+    else:
+        out[:] = False
+    hand_size = len(state.inference.my_hand)
+    out[:hand_size] = True
+    if state.used_note_tokens > 0:
+        out[N_PLAY : N_PLAY + hand_size] = True
+    if state.used_note_tokens < 8:
+        for p, player in enumerate(state.get_relative_player_order()):
+            base = N_PLAY + N_DISCARD + p * HINTS_PER_PLAYER
+            for card in player.hand:
+                out[base + UnknownCard.COLORS.index(card.color)] = True
+                out[base + N_COLORS + card.value - 1] = True
+    return out
+
+
+def play_game(game_id: int, n_players: int, seed: int) -> np.ndarray:
+    """Play a self-play game and return its decision points as records."""
+    random.seed(seed)
+    decisions = []
+
+    def record(seat, action):
+        state = seat.hanabi_state
+        decisions.append(
+            (encode_observation(state), legal_actions(state), action_index(state, action))
+        )
+
+    score = LocalGame(n_players, on_decision=record).play()
+    records = np.zeros(len(decisions), dtype=RECORD_DTYPE)
+    for i, (observation, legal, action) in enumerate(decisions):
+        records[i]["observation"] = observation
+        records[i]["legal"] = legal
+        records[i]["action"] = action
+    records["score"] = score
+    records["n_players"] = n_players
+    records["game"] = game_id
+    return records
+
+
+class ShardWriter:
+    """Append records to the memory-mapped shards of a dataset directory.
+    An existing dataset is extended, starting from its last shard."""
+
+    INDEX = "index.json"
+
+    def __init__(self, directory: str, shard_size=16384):
+        self.directory = directory
+        self.shard_size = shard_size
+        os.makedirs(directory, exist_ok=True)
+        self.index = {"dtype": RECORD_DTYPE.descr, "games": 0, "shards": []}
+        index_path = os.path.join(directory, ShardWriter.INDEX)
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                self.index = json.load(f)
+            if np.dtype([tuple(f) for f in self.index["dtype"]]) != RECORD_DTYPE:
+                raise ValueError(f"{directory} has records of a different format")
+        self.shard = None
+        self.count = 0
+        if self.index["shards"]:
+            last = self.index["shards"][-1]
+            self.shard = np.lib.format.open_memmap(
+                os.path.join(directory, last["file"]), mode="r+"
+            )
+            self.count = last["count"]
+
+    def _open_shard(self):
+        name = f"shard-{len(self.index['shards']):05d}.npy"
+        self.shard = np.lib.format.open_memmap(
+            os.path.join(self.directory, name),
+            mode="w+",
+            dtype=RECORD_DTYPE,
+            shape=(self.shard_size,),
+        )
+        self.index["shards"].append({"file": name, "count": 0})
+        self.count = 0
+        return
+
+    def append(self, records: np.ndarray):
+        while len(records):
+            if self.shard is None or self.count == len(self.shard):
+                self._open_shard()
+            n = min(len(records), len(self.shard) - self.count)
+            self.shard[self.count : self.count + n] = records[:n]
+            self.count += n
+            self.index["shards"][-1]["count"] = self.count
+            records = records[n:]
+        return
+
+    def close(self):
+        """Flush the shards and write the index."""
+        if self.shard is not None:
+            self.shard.flush()
+        with open(os.path.join(self.directory, ShardWriter.INDEX), "w") as f:
+            json.dump(self.index, f)
+        return
+
+
+class ShardDataset:
+    """Read-only view over the records of a dataset directory.
+    Shards are memory mapped: records are read without copies."""
+
+    def __init__(self, directory: str):
+        with open(os.path.join(directory, ShardWriter.INDEX)) as f:
+            index = json.load(f)
+        self.shards = [
+            np.load(os.path.join(directory, s["file"]), mmap_mode="r")[: s["count"]]
+            for s in index["shards"]
+        ]
+        self.offsets = np.cumsum([0] + [len(s) for s in self.shards])
+
+    def __len__(self) -> int:
+        return int(self.offsets[-1])
+
+    def __getitem__(self, i: int):
+        shard = int(np.searchsorted(self.offsets, i, side="right")) - 1
+        return self.shards[shard][i - self.offsets[shard]]
+
+    def batches(self, batch_size: int):
+        """Yield the records in batches, as views of the shards. Batches do
+        not span shards, so the last batch of a shard may be smaller."""
+        for shard in self.shards:
+            for start in range(0, len(shard), batch_size):
+                yield shard[start : start + batch_size]
+
+
+def _init_worker():
+    """Silence the game in the worker processes."""
+    logging.getLogger().setLevel(logging.WARNING)
+    sys.stdout = open(os.devnull, "w")
+
+
+def generate(directory: str, n_games: int, workers=None, seed=0) -> int:
+    """Play `n_games` games (2 to 5 players) over a process pool and
+    append their records to the dataset. Return the number of records."""
+    writer = ShardWriter(directory)
+    first_game = writer.index["games"]
+    n_records = 0
+    with ProcessPoolExecutor(workers, initializer=_init_worker) as executor:
+        games = [
+            (first_game + g, 2 + g % 4, seed * 1_000_003 + first_game + g)
+            for g in range(n_games)
+        ]
+        for records in executor.map(play_game, *zip(*games), chunksize=4):
+            writer.append(records)
+            n_records += len(records)
+    writer.index["games"] += n_games
+    writer.close()
+    return n_records
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Self-play datasets")
+    commands = parser.add_subparsers(dest="command", required=True)
+    gen = commands.add_parser("generate", help="append self-play games")
+    gen.add_argument("directory")
+    gen.add_argument("--games", type=int, default=100)
+    gen.add_argument("--workers", type=int, default=None)
+    gen.add_argument("--seed", type=int, default=0)
+    read = commands.add_parser("read", help="measure the reading throughput")
+    read.add_argument("directory")
+    read.add_argument("--batch-size", type=int, default=1024)
+    args = parser.parse_args()
+
+    start = perf_counter()
+    if args.command == "generate":
+        n = generate(args.directory, args.games, args.workers, args.seed)
+        elapsed = perf_counter() - start
+        print(f"{n} samples from {args.games} games: {n / elapsed:.0f} samples/s")
+    else:
+        dataset = ShardDataset(args.directory)
+        checksum = 0.0
+        for batch in dataset.batches(args.batch_size):
+            checksum += float(batch["observation"].sum())
+        elapsed = perf_counter() - start
+        print(
+            f"{len(dataset)} samples read: {len(dataset) / elapsed:.0f} samples/s"
+            f" (checksum {checksum:.1f})"
+        )
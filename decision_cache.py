@@ -0,0 +1,180 @@
+"""Decision cache shared by all the agents of a process.
+
+Decision points recur across runs (replayed seeds, benchmarks, datasets)
+and up to a permutation of the colors. The decisions of a RulePipeline are cached in
+a bounded LRU table keyed by the pipeline fingerprint (its rules and
+their parameters, see RulePipeline.fingerprint) and the canonical key of
+the state (see HanabiState.canonical_key). Actions are stored relative
+to the state: hints name the receiver by its position after the agent
+and the color by its position in the canonical order, so that a
+decision is replayed in every equivalent state.
+
+The cache is disabled by default. enable() creates the shared cache,
+loading the entries saved by a previous run, and save() merges the
+entries back in the file. Entries are not invalidated when the code of
+the rules changes: delete the file in that case.
+
+Decisions depending on random choices (HintRandomCard, DiscardRandomCard,
+PlayEndgame) and ties between colors are frozen by the cache: an
+equivalent state replays the first decision taken. Profiled agents (see
+RuleProfiler) always match the rules and do not use the cache."""
+import json
+import os
+import threading
+from collections import OrderedDict
+from hanabi_model import DecisionContext, HanabiAction, HanabiState, Hint, Play, Discard
+
+DEFAULT_CAPACITY = 1 << 18
+FORMAT_VERSION = 1
+
+PLAY = "play"
+DISCARD = "discard"
+HINT = "hint"
+
+ENABLED = False
+_cache = None
+_path = None
+
+
+class DecisionCache:
+    """Bounded LRU table of the encoded decisions, safe to share
+    between threads."""
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.entries = OrderedDict()  # key: encoded action
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    @property
+    def lookups(self) -> int:
+        return self.hits + self.misses
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / self.lookups if self.lookups else 0.0
+
+    def get(self, key: tuple):
+        with self.lock:
+            try:
+                value = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: tuple, value: tuple):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+        return
+
+    def load(self, path: str) -> int:
+        """Add the entries of the file, as the least recently used ones.
+        Return the number of entries read."""
+        with open(path) as f:
+            data = json.load(f)
+        if data.get("version") != FORMAT_VERSION:
+            return 0
+        with self.lock:
+            for key, value in reversed(data["entries"]):
+                key = tuple(key)
+                if len(self.entries) >= self.capacity:
+                    break
+                if key not in self.entries:
+                    self.entries[key] = tuple(value)
+                    self.entries.move_to_end(key, last=False)
+        return len(data["entries"])
+
+    def save(self, path: str):
+        """Write the entries in the file, merged with the entries saved
+        meanwhile by other processes: ours are the most recently used."""
+        if os.path.exists(path):
+            self.load(path)
+        with self.lock:
+            entries = [[list(k), list(v)] for k, v in self.entries.items()]
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"version": FORMAT_VERSION, "entries": entries}, f)
+        os.replace(tmp_path, path)
+        return
+
+
+def enable(capacity=DEFAULT_CAPACITY, path=None):
+    """Create the shared cache, with the entries saved in `path` if any."""
+    global ENABLED, _cache, _path
+    _cache = DecisionCache(capacity)
+    _path = path
+    if path is not None and os.path.exists(path):
+        _cache.load(path)
+    ENABLED = True
+    return
+
+
+def disable():
+    global ENABLED
+    ENABLED = False
+    return
+
+
+def save():
+    """Save the shared cache in the file given to enable, if any."""
+    if _cache is not None and _path is not None:
+        _cache.save(_path)
+    return
+
+
+def counters() -> tuple:
+    """Return the (hits, lookups) of the shared cache."""
+    if _cache is None:
+        return 0, 0
+    return _cache.hits, _cache.lookups
+
+
+def encode_action(state: HanabiState, action: HanabiAction, colors: list) -> tuple:
+    if type(action) is Play:
+        return (PLAY, action.card_index)
+    if type(action) is Discard:
+        return (DISCARD, action.card_index)
+    if type(action) is Hint:
+        offset = state.state_hash.offsets[action.to]
+        value = action.value
+        if action._type == Hint.HINT_TYPE_COL:
+            value = colors.index(value)
+        return (HINT, offset, action._type, value)
+    raise TypeError(f"Inappropriate action type: {action}")
+
+
+def decode_action(state: HanabiState, encoded: tuple, colors: list) -> HanabiAction:
+    kind = encoded[0]
+    if kind == PLAY:
+        return Play(state.my_name, encoded[1])
+    if kind == DISCARD:
+        return Discard(state.my_name, encoded[1])
+    _, offset, hint_type, value = encoded
+    to = state.players_list[(state.my_turn + offset) % len(state.players_list)].name
+    if hint_type == Hint.HINT_TYPE_COL:
+        value = colors[value]
+    return Hint(state.my_name, to, hint_type, value)
+
+
+def decide(pipeline, state: HanabiState, ctx: DecisionContext) -> HanabiAction:
+    """Return the cached decision of the pipeline in the state,
+    matching the rules and caching the result on a miss."""
+    key, colors = state.canonical_key()
+    key = (pipeline.fingerprint, *key)
+    encoded = _cache.get(key)
+    if encoded is not None:
+        return decode_action(state, encoded, colors)
+    action = pipeline.match(state, ctx)
+    if action is not None:
+        _cache.put(key, encode_action(state, action, colors))
+    return action
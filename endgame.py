@@ -0,0 +1,200 @@
+"""Endgame search for the last moves of the game.
+
+Once the deck is empty (or almost empty) every player has a bounded number
+of moves left (see HanabiState.remaining_moves), so the rest of the game
+can be searched exhaustively. The agent's hand is unknown: the search is
+repeated on determinized worlds (see hanabi_model.determinize), where every
+hand and the deck order are known, and the action with the best mean
+final score over the worlds is chosen.
+
+Within a world players cooperate with full information, so the value of
+a position is the best final score reachable from it. Values are kept in
+the transposition table of the search, keyed by the canonical position:
+the order of the cards in a hand does not matter, so hands are sorted.
+Every decision has its own search, and so its own table: the agents of a
+process can search concurrently."""
+import random
+from time import perf_counter
+from hanabi_model import HanabiState, UnknownCard, determinize
+
+PLAY = "play"
+DISCARD = "discard"
+HINT = "hint"
+
+MAX_SCORE = 25
+MAX_NOTE_TOKENS = 8
+MAX_STORM_TOKENS = 3
+MAX_TABLE_ENTRIES = 1_000_000  # per search
+
+# position: (heights, used note tokens, used storm tokens, hands, deck,
+#            current player, remaining moves)
+# heights is a tuple of 5 ints, hands a tuple of sorted tuples of card types
+# (color index * 5 + value - 1), deck a tuple of card types drawn from the end
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+def card_type(card) -> int:
+    return UnknownCard.COLORS.index(card.color) * 5 + card.value - 1
+
+
+def position_from_world(world: dict) -> tuple:
+    n_players = len(world["players"])
+    heights = tuple(len(world["table"][color]) for color in UnknownCard.COLORS)
+    hands = tuple(
+        tuple(card_type(c) for c in world["hands"][name]) for name in world["players"]
+    )
+    remaining = world["remaining_moves"]
+    return (
+        heights,
+        world["note_tokens"],
+        world["storm_tokens"],
+        hands,
+        tuple(card_type(c) for c in world["deck"]),
+        world["current_player"],
+        n_players + 1 if remaining is None else remaining,
+    )
+
+
+def step(position: tuple, kind: str, index: int) -> tuple:
+    """Return the position after the current player performs the action,
+    following the rules of game.Game."""
+    heights, note, storm, hands, deck, current, remaining = position
+    hand = list(hands[current])
+    if kind == HINT:
+        note += 1
+    else:
+        t = hand.pop(index)
+        color, value = divmod(t, 5)
+        if kind == DISCARD:
+            note -= 1
+        elif heights[color] == value:  # value is 0-based: the next card
+            heights = heights[:color] + (value + 1,) + heights[color + 1 :]
+            if value == 4 and note > 0:
+                note -= 1
+        else:
+            storm += 1
+        if deck:
+            hand.append(deck[-1])
+            deck = deck[:-1]
+    hands = hands[:current] + (tuple(hand),) + hands[current + 1 :]
+    if not deck:
+        remaining -= 1
+    return (heights, note, storm, hands, deck, (current + 1) % len(hands), remaining)
+
+
+def final_score(position: tuple):
+    """Return the score if the game is over in the position, else None."""
+    heights, _, storm, _, deck, _, remaining = position
+    if storm == MAX_STORM_TOKENS:
+        return 0
+    score = sum(heights)
+    if score == MAX_SCORE or (not deck and remaining == 0):
+        return score
+    return None
+
+
+def canonical(position: tuple) -> tuple:
+    heights, note, storm, hands, deck, current, remaining = position
+    hands = tuple(tuple(sorted(hand)) for hand in hands)
+    return (heights, note, storm, hands, deck, current, remaining)
+
+
+class EndgameSearch:
+    """Exhaustive search of the positions, stopped at the deadline."""
+
+    CHECK_INTERVAL = 1024  # nodes between two deadline checks
+
+    def __init__(self, deadline: float):
+        self.deadline = deadline
+        self.nodes = 0
+        self.table = dict()  # canonical position: value
+
+    def children(self, position: tuple):
+        """Yield the positions after the sensible actions of the current
+        player: plays of playable cards, then a single hint (all hints
+        are the same with full information), then discards. Cards of the
+        same type are tried once. Misplays are never better than a hint
+        or a discard, one of which is always possible."""
+        heights, note, _, hands, _, current, _ = position
+        hand = hands[current]
+        tried = set()
+        for i, t in enumerate(hand):
+            if heights[t // 5] == t % 5 and t not in tried:
+                tried.add(t)
+                yield step(position, PLAY, i)
+        if note < MAX_NOTE_TOKENS:
+            yield step(position, HINT, None)
+        if note > 0:
+            tried.clear()
+            for i, t in enumerate(hand):
+                if t not in tried:
+                    tried.add(t)
+                    yield step(position, DISCARD, i)
+
+    def value(self, position: tuple) -> int:
+        """Return the best final score reachable from the position."""
+        score = final_score(position)
+        if score is not None:
+            return score
+        key = canonical(position)
+        cached = self.table.get(key)
+        if cached is not None:
+            return cached
+        self.nodes += 1
+        if self.nodes % EndgameSearch.CHECK_INTERVAL == 0:
+            if perf_counter() > self.deadline:
+                raise SearchTimeout
+
+        heights, _, _, _, deck, _, remaining = position
+        # every move scores at most one point
+        bound = MAX_SCORE if deck else min(MAX_SCORE, sum(heights) + remaining)
+        best = 0
+        for child in self.children(position):
+            best = max(best, self.value(child))
+            if best >= bound:
+                break
+        if len(self.table) < MAX_TABLE_ENTRIES:  # once full, stop caching
+            self.table[key] = best
+        return best
+
+
+def candidate_actions(state: HanabiState) -> list:
+    """Return the (kind, index) actions of the agent."""
+    hand_size = len(state.inference.my_hand)
+    actions = [(PLAY, i) for i in range(hand_size)]
+    if state.used_note_tokens > 0:
+        actions += [(DISCARD, i) for i in range(hand_size)]
+    if state.used_note_tokens < MAX_NOTE_TOKENS:
+        actions.append((HINT, None))
+    return actions
+
+
+def best_action(state: HanabiState, time_budget: float, max_worlds=64, rng=None):
+    """Return the (kind, index) action with the best mean final score over
+    the worlds searched within the time budget, or None if no world has
+    been completely searched. The index of a hint is None: any hint."""
+    rng = random.Random(random.getrandbits(32)) if rng is None else rng
+    deadline = perf_counter() + time_budget
+    actions = candidate_actions(state)
+    totals = [0] * len(actions)
+    worlds = 0
+    search = EndgameSearch(deadline)
+    while worlds < max_worlds and perf_counter() < deadline:
+        world = determinize(state, rng)
+        if world is None:
+            break
+        position = position_from_world(world)
+        try:
+            scores = [search.value(step(position, *a)) for a in actions]
+        except SearchTimeout:
+            break
+        for i, score in enumerate(scores):
+            totals[i] += score
+        worlds += 1
+    if worlds == 0:
+        return None
+    best = max(range(len(actions)), key=totals.__getitem__)
+    return actions[best]
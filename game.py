@@ -1,5 +1,5 @@
 from copy import deepcopy
-from random import shuffle
+from random import Random, shuffle
 import GameData
 import logging
 
@@ -63,8 +63,6 @@ class Player(object):
 
 class Game(object):
 
-    __dataActions = {}
-
     __scoreMessages = [
         "Booooooooooooring!",
         "Meh!",
@@ -158,6 +156,7 @@ class Game(object):
         # Init players
         self.__players = []
         self.__currentPlayer = 0
+        self.__actions = 0  # actions performed, reported in the game state
 
         # init game
         self.__started = False
@@ -166,12 +165,26 @@ class Game(object):
 
         # score
         self.__score = 0
-        # add actions for each class of data
+        self.__initDataActions()
+
+    # add actions for each class of data, bound to this game
+    def __initDataActions(self):
+        self.__dataActions = {}
         self.__dataActions[GameData.ClientPlayerDiscardCardRequest] = self.__satisfyDiscardRequest
         self.__dataActions[GameData.ClientGetGameStateRequest] = self.__satisfyShowCardRequest
         self.__dataActions[GameData.ClientPlayerPlayCardRequest] = self.__satisfyPlayCardRequest
         self.__dataActions[GameData.ClientHintData] = self.__satisfyHintRequest
 
+    # Pickling (server snapshots): the bound actions are rebuilt on load
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_Game__dataActions"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__initDataActions()
+
     # Request satisfaction methods
     # Each method produces a tuple of ServerToClientData derivates
     # where the first element is the one to send to a single player, while the second one has to be sent to all players
@@ -223,7 +236,7 @@ class Game(object):
     def __satisfyShowCardRequest(self, data: GameData.ClientGetGameStateRequest):
         logging.info("Showing hand to: " + data.sender)
         currentPlayer, playerList, playerHandSize = self.__getPlayersStatus(data.sender)
-        return (GameData.ServerGameStateData(currentPlayer, playerHandSize, playerList, self.__noteTokens, self.__stormTokens, self.__tableCards, self.__discardPile), None)
+        return (GameData.ServerGameStateData(currentPlayer, playerHandSize, playerList, self.__noteTokens, self.__stormTokens, self.__tableCards, self.__discardPile, self.__actions), None)
 
     # Play card request
 
@@ -325,12 +338,17 @@ class Game(object):
         return count
 
     def __nextTurn(self):
+        self.__actions += 1
         self.__currentPlayer += 1
         self.__currentPlayer %= len(self.__players)
 
-    def start(self):
+    # The same seed deals the same deck.
+    def start(self, seed=None):
         self.__lastMoves = len(self.__players) + 1
-        shuffle(self.__cardsToDraw)
+        if seed is None:
+            shuffle(self.__cardsToDraw)
+        else:
+            Random(seed).shuffle(self.__cardsToDraw)
         if len(self.__players) < 2:
             logging.warning("Not enough players!")
             return
@@ -345,6 +363,21 @@ class Game(object):
                     p.takeCard(self.__cardsToDraw)
         self.__started = True
 
+    # Set up an already started game from the given state: used to simulate
+    # the rest of a game from a known (or sampled) position.
+    # lastMoves is None if there are still cards to draw.
+    def loadState(self, players: list, cardsToDraw: list, tableCards: dict, discardPile: list, noteTokens: int, stormTokens: int, currentPlayer: int, lastMoves=None):
+        self.__players = players
+        self.__cardsToDraw = cardsToDraw
+        self.__tableCards = tableCards
+        self.__discardPile = discardPile
+        self.__noteTokens = noteTokens
+        self.__stormTokens = stormTokens
+        self.__currentPlayer = currentPlayer
+        self.__lastTurn = lastMoves is not None
+        self.__lastMoves = len(players) + 1 if lastMoves is None else lastMoves
+        self.__started = True
+
     def __getPlayersStatus(self, currentPlayerName):
         players = []
         handSize = 0
@@ -441,3 +474,27 @@ class Game(object):
 
     def getScore(self):
         return self.__score
+
+    def getStormTokens(self):
+        return self.__stormTokens
+
+    def hasStarted(self):
+        return self.__started
+
+    # The state seen by a spectator: every hand if fullInformation, else no hand.
+    # Nothing is logged: it is built after every action.
+    def getSpectatorState(self, fullInformation: bool) -> GameData.ServerGameStateData:
+        if fullInformation:
+            players = self.__players
+        else:
+            players = [Player(p.name) for p in self.__players]
+        return GameData.ServerGameStateData(self.__players[self.__currentPlayer].name, 0, players, self.__noteTokens, self.__stormTokens, self.__tableCards, self.__discardPile, self.__actions)
+
+    def getNoteTokens(self):
+        return self.__noteTokens
+
+    def getCurrentPlayerName(self) -> str:
+        return self.__getCurrentPlayer().name
+
+    def getActions(self) -> int:
+        return self.__actions
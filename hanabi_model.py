@@ -5,9 +5,11 @@ import GameData
 from game import Player, Card
 from itertools import product
 from collections import Counter
-import logging
-
-logging.basicConfig(format="%(message)s", level=logging.DEBUG)
+import random
+import threading
+import weakref
+import numpy as np
+import tracing
 
 
 class HanabiAction(ABC):
@@ -87,26 +89,114 @@ class Discard(HanabiAction):
             card_drawn = f"Card drawn: ?"
         elif type(self.card_drawn) is Card:
             card_drawn = f"Card drawn: {self.card_drawn.toString()}"
+        else:
+            card_drawn = "Card drawn: none"
         return "\n".join([sender, card_indx, card_discarded, card_drawn])
 
 
+def action_from_server_data(
+    data: GameData.ServerToClientData,
+    new_state: GameData.ServerGameStateData,
+    player_name: str,
+    later=(),
+) -> HanabiAction:
+    """Create an Hanabi action from the server response and the state
+    after the action, as seen by player `player_name`. `later` are the
+    responses received after `data` whose actions the state already
+    includes, if it is ahead (see get_drawn_card)."""
+
+    if type(data) is GameData.ServerHintData:
+        # an hint has been sent :^O
+        return Hint(data.source, data.destination, data.type, data.value, data.positions)
+
+    if type(data) is GameData.ServerActionValid:
+        # a discard has been performed :^)
+        # include the drawn card in the created Discard action
+        card_drawn = get_drawn_card(data, new_state, player_name, later)
+        return Discard(data.lastPlayer, data.cardHandIndex, data.card, card_drawn)
+
+    if type(data) is GameData.ServerPlayerMoveOk:
+        # a card has been successfully played :^D
+        result = Play.GOOD_MOVE
+    elif type(data) is GameData.ServerPlayerThunderStrike:
+        # a card has been unsuccessfully played :^@
+        result = Play.THUNDERSTRIKE
+    else:
+        raise ValueError(f"Invalid action response: {data}")
+    card_drawn = get_drawn_card(data, new_state, player_name, later)
+    return Play(data.lastPlayer, data.cardHandIndex, data.card, card_drawn, result)
+
+
+def get_drawn_card(
+    data, new_state: GameData.ServerGameStateData, player_name: str, later=()
+):
+    """Return the card drawn by the sender of a play or discard, an
+    UnknownCard if the sender is `player_name`, or None if the deck is empty.
+
+    The drawn card is appended to the sender's hand. If the state includes
+    the `later` responses too, the card is followed through the later plays
+    and discards of the sender: each one removing a card before it moves
+    it one position down, and the one removing it tells which card it is."""
+    hand_size = 5 if len(new_state.players) <= 3 else 4
+    if data.handLength < hand_size:
+        return None  # hands shrink only when there is nothing left to draw
+    if data.lastPlayer == player_name:
+        return UnknownCard()
+    position = data.handLength - 1
+    for response in later:
+        if getattr(response, "lastPlayer", None) != data.lastPlayer:
+            continue  # hints carry no lastPlayer
+        if response.cardHandIndex == position:
+            return response.card  # played or discarded meanwhile
+        if response.cardHandIndex < position:
+            position -= 1
+    for p in new_state.players:
+        if p.name == data.lastPlayer:
+            return p.hand[position]
+    raise ValueError("Unable to fetch the new drawn card!!")
+
+
+def request_from_action(
+    action: HanabiAction, player_name: str, actions: int = None
+) -> GameData.ClientToServerData:
+    """Create the request to send to the server to perform the action.
+    `actions`, if given, is the number of actions of the game the player
+    has seen when deciding (see GameData.ClientToServerData)."""
+    if type(action) is Play:
+        request = GameData.ClientPlayerPlayCardRequest(player_name, action.card_index)
+    elif type(action) is Discard:
+        request = GameData.ClientPlayerDiscardCardRequest(
+            player_name, action.card_index
+        )
+    elif type(action) is Hint:
+        request = GameData.ClientHintData(
+            player_name, action.to, action._type, action.value
+        )
+    else:
+        raise TypeError(f"Inappropriate action type: {action}")
+    request.actions = actions
+    return request
+
+
 class Inference:
-    def __init__(
-        self,
-        state,
-        n_cards,
-        other_players_card: set,
-        playable_cards: set(),
-    ):
+    def __init__(self, state, n_cards):
         self.state = state
         self.n_cards = n_cards
-        self.visible_cards = other_players_card
         self.my_hand = [UnknownCard(self.visible_cards) for _ in range(self.n_cards)]
+        self.belief = HandBelief(self.n_cards, state.ledger)
         self.not_trusted_players = set()
         self.chop_index = 0
-        self.playable_cards = playable_cards
         return
 
+    @property
+    def visible_cards(self) -> set:
+        """The cards seen so far, as tracked by the state ledger."""
+        return self.state.ledger.visible_cards
+
+    @property
+    def playable_cards(self) -> set:
+        return self.state.ledger.playable_cards
+
     def add_hint(self, hint: Hint):
         """Update the knowledge about the agent unknown cards.
         Also perform a negative inference, i.e. it registers
@@ -116,6 +206,7 @@ class Inference:
                 c.add_positive_knowledge(hint)
             else:  # the cards is NOT covered by the hint
                 c.add_negative_knowledge(hint)
+        self.belief.add_hint(hint)
 
         # update the chop after adding the hint to the cards
         if self.chop_index in hint.positions:
@@ -148,18 +239,22 @@ class Inference:
         # the new card is placed at the end of the player hand
         # so: remove the played card and append an unknown card at the end
         self.my_hand = self.my_hand[:card_index] + self.my_hand[card_index + 1 :]
+        self.belief.remove_slot(card_index)
         if type(hanabi_action) is Discard:
             self.add_visible_card(hanabi_action.card_discarded)
         elif type(hanabi_action) is Play:
             self.add_visible_card(hanabi_action.real_card)
-        self.my_hand.append(UnknownCard(self.visible_cards))
+        if hanabi_action.card_drawn is not None:  # the deck may be empty
+            self.my_hand.append(UnknownCard(self.visible_cards))
+            self.belief.add_slot()
         return
 
     def add_visible_card(self, card: Card):
-        """Add a new visible card to the set of visible cards."""
-        self.visible_cards.add(card)
+        """Remove a newly visible card from the possible cards of the
+        agent's hand. The card must already be registered in the ledger."""
         for u in self.my_hand:
             u.remove_possible(card)
+        self.belief.add_visible_card(card)
         return
 
 
@@ -269,19 +364,619 @@ class UnknownCard:
         return self.__str__()
 
 
+################### CARD LEDGER ###################
+class CardLedger:
+    """Card accounting kept up to date from the action stream.
+
+    It counts every card type (value, color) seen in the other players'
+    hands and tracks the cards visible to the agent. The cards on the
+    table and in the discard pile, the set of currently playable cards and
+    the set of cards still needed to complete the fireworks are public:
+    they are read from the PublicKnowledge of the table, which may be
+    shared with the other agents of the process. Each update only touches
+    the cards moved by the action."""
+
+    CARDS_BY_TYPE = dict()  # (value, color): frozenset of Cards
+    N_CARDS = 50
+
+    def __init__(self, public):
+        self.public = public
+        self.hand_counts = Counter()
+        self.hand_cards = set()
+        self.visible_cards = set(public.discard_pile)
+        for pile in public.table_cards.values():
+            self.visible_cards.update(pile)
+        return
+
+    @staticmethod
+    def cards_of(value: int, color: str) -> frozenset:
+        """Return all the copies of the given card type."""
+        if not CardLedger.CARDS_BY_TYPE:
+            for c in UnknownCard.all_possible_cards():
+                key = (c.value, c.color)
+                CardLedger.CARDS_BY_TYPE[key] = CardLedger.CARDS_BY_TYPE.get(
+                    key, frozenset()
+                ) | {c}
+        return CardLedger.CARDS_BY_TYPE[(value, color)]
+
+    @property
+    def table_counts(self) -> Counter:
+        return self.public.table_counts
+
+    @property
+    def discard_counts(self) -> Counter:
+        return self.public.discard_counts
+
+    @property
+    def table_heights(self) -> dict:
+        return self.public.table_heights
+
+    @property
+    def table_cards(self) -> dict:
+        return self.public.table_cards
+
+    @property
+    def discard_pile(self) -> frozenset:
+        return self.public.discard_pile
+
+    @property
+    def playable_cards(self) -> frozenset:
+        return self.public.playable_cards
+
+    @property
+    def future_playable_cards(self) -> frozenset:
+        return self.public.future_playable_cards
+
+    def load(self, state_data: GameData.ServerGameStateData, my_name: str):
+        """Register the cards in the hands of the other players."""
+        for p in state_data.players:
+            if p.name == my_name:
+                continue
+            for card in p.hand:
+                self.draw_card(card)
+        return
+
+    def draw_card(self, card: Card):
+        """Register a card that entered the hand of another player."""
+        if card in self.hand_cards:
+            return
+        self.hand_cards.add(card)
+        self.hand_counts[(card.value, card.color)] += 1
+        self.visible_cards.add(card)
+        return
+
+    def remove_card(self, card: Card):
+        """Register a card played or discarded. The table and the discard
+        pile are updated by the PublicKnowledge."""
+        self.visible_cards.add(card)
+        if card not in self.hand_cards:
+            return  # the card was in the agent's hand
+        self.hand_cards.remove(card)
+        self.hand_counts[(card.value, card.color)] -= 1
+        return
+
+
+################### PUBLIC KNOWLEDGE ###################
+class PublicKnowledge:
+    """The facts known by every player of a table: the fireworks, the
+    discard pile, the cards that are playable or still needed, and the
+    clued positions of every hand.
+
+    The agents playing at the same table in a process share a single
+    instance (see shared), updated once per action. Actions are numbered
+    from the start of the game: the server state reports the number of
+    actions it includes (ServerGameStateData.actions), and every agent
+    counts the actions it receives after the state it was built from. The
+    first agent receiving an action applies it (see apply). An agent only
+    joins an instance at the action of its own state (see HanabiState), so
+    no agent is ever ahead of the instance. Updates replace the sets,
+    counters and dicts instead of modifying them, so that an agent reading
+    them from another thread never sees them change under it.
+
+    The clues given before the state the instance is built from are not
+    known: the server state does not carry them."""
+
+    _tables = weakref.WeakValueDictionary()  # table key: PublicKnowledge
+    _tables_lock = threading.Lock()
+
+    def __init__(self, state_data: GameData.ServerGameStateData):
+        self.table_counts = Counter()
+        self.discard_counts = Counter()
+        self.table_heights = {color: 0 for color in UnknownCard.COLORS}
+        self.table_cards = {color: () for color in UnknownCard.COLORS}
+        self.discard_pile = frozenset()
+        # copies of the next card of each pile which are not discarded
+        playable_cards = set()
+        # cards that can still be played in this game (playable included)
+        future_playable_cards = set()
+        for color in UnknownCard.COLORS:
+            playable_cards |= CardLedger.cards_of(1, color)
+            for value in UnknownCard.DECK_DISTR:
+                future_playable_cards |= CardLedger.cards_of(value, color)
+        self.playable_cards = frozenset(playable_cards)
+        self.future_playable_cards = frozenset(future_playable_cards)
+        # player: bitmask of the clued positions of its hand
+        self.clued = {p.name: 0 for p in state_data.players}
+        self.moves = state_data.actions  # actions applied
+        self.lock = threading.Lock()
+
+        # table cards are registered before the discarded ones, so that
+        # dead piles are detected against the final height of the fireworks
+        for pile in state_data.tableCards.values():
+            for card in pile:
+                self._add_to_table(card)
+        for card in state_data.discardPile:
+            self._add_to_discard(card)
+        return
+
+    @staticmethod
+    def shared(table_key, state_data: GameData.ServerGameStateData):
+        """Return the public knowledge of the table, created from the state
+        if no other agent of the process is playing at that table."""
+        with PublicKnowledge._tables_lock:
+            public = PublicKnowledge._tables.get(table_key)
+            if public is None:
+                public = PublicKnowledge(state_data)
+                PublicKnowledge._tables[table_key] = public
+            return public
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+        return
+
+    def apply(self, move: int, update, *args) -> bool:
+        """Call update(*args) for the `move`-th action of the game, unless
+        another agent of the table has already done it. Return True if the
+        update has been applied."""
+        with self.lock:
+            if move <= self.moves:
+                return False
+            if move != self.moves + 1:
+                raise ValueError(f"Action {move} received after action {self.moves}")
+            self.moves = move
+            update(*args)
+        return True
+
+    def hint(self, hint: Hint):
+        clued = self.clued[hint.to]
+        for p in hint.positions:
+            clued |= 1 << p
+        self.clued = {**self.clued, hint.to: clued}
+        return
+
+    def play(self, play: Play):
+        self._remove_from_hand(play.sender, play.card_index)
+        if play.result != Play.THUNDERSTRIKE:
+            self._add_to_table(play.real_card)
+        else:
+            self._add_to_discard(play.real_card)
+        return
+
+    def discard(self, discard: Discard):
+        self._remove_from_hand(discard.sender, discard.card_index)
+        self._add_to_discard(discard.card_discarded)
+        return
+
+    def _remove_from_hand(self, player: str, index: int):
+        """The cards following the removed one slide one position down."""
+        clued = self.clued[player]
+        low = (1 << index) - 1
+        clued = (clued & low) | ((clued >> (index + 1)) << index)
+        self.clued = {**self.clued, player: clued}
+        return
+
+    def _add_to_table(self, card: Card):
+        table_counts = Counter(self.table_counts)
+        table_counts[(card.value, card.color)] += 1
+        self.table_counts = table_counts
+        self.table_heights = {**self.table_heights, card.color: card.value}
+        self.table_cards = {
+            **self.table_cards,
+            card.color: self.table_cards[card.color] + (card,),
+        }
+        same_cards = CardLedger.cards_of(card.value, card.color)
+        playable_cards = self.playable_cards - same_cards
+        if card.value < 5:
+            next_cards = CardLedger.cards_of(card.value + 1, card.color)
+            playable_cards |= next_cards - self.discard_pile
+        self.playable_cards = playable_cards
+        self.future_playable_cards = self.future_playable_cards - same_cards
+        return
+
+    def _add_to_discard(self, card: Card):
+        self.discard_pile = self.discard_pile | {card}
+        key = (card.value, card.color)
+        discard_counts = Counter(self.discard_counts)
+        discard_counts[key] += 1
+        self.discard_counts = discard_counts
+        self.playable_cards = self.playable_cards - {card}
+        future_playable_cards = self.future_playable_cards - {card}
+        copies = UnknownCard.DECK_DISTR[card.value]
+        dead_pile = discard_counts[key] == copies
+        if dead_pile and card.value > self.table_heights[card.color]:
+            # the pile cannot grow anymore: the following cards are useless
+            for value in range(card.value + 1, 6):
+                future_playable_cards -= CardLedger.cards_of(value, card.color)
+        self.future_playable_cards = future_playable_cards
+        return
+
+
+################### HAND BELIEF ###################
+class HandBelief:
+    """Belief over the card types of the agent's hand, as a (hand size, 25)
+    array: one row per slot, one column per card type (see type_index).
+
+    Hints and newly visible cards update the rows with vectorized mask
+    operations. Probabilities weight every possible type by its copies
+    still unseen, and are rescaled so that the slots of the hand do not
+    hold, on average, more copies of a type than the ones left."""
+
+    N_TYPES = 25
+    NORMALIZATION_ITERATIONS = 5
+    # type t is the card of color COLORS[t // 5] and value t % 5 + 1
+    TYPE_COLORS = np.repeat(np.arange(len(UnknownCard.COLORS)), 5)
+    TYPE_VALUES = np.tile(np.arange(1, 6), len(UnknownCard.COLORS))
+    TYPE_COPIES = np.array([UnknownCard.DECK_DISTR[v] for v in TYPE_VALUES])
+
+    def __init__(self, hand_size: int, ledger: CardLedger):
+        self.mask = np.ones((hand_size, HandBelief.N_TYPES), dtype=bool)
+        self.unseen = HandBelief.TYPE_COPIES.copy()
+        for counts in (ledger.table_counts, ledger.discard_counts, ledger.hand_counts):
+            for (value, color), n in counts.items():
+                self.unseen[HandBelief.type_index(value, color)] -= n
+        self._probabilities = None
+        # (probabilities, table heights, discard counts, type arrays, products)
+        self._products = None
+        return
+
+    @staticmethod
+    def type_index(value: int, color: str) -> int:
+        return UnknownCard.COLORS.index(color) * 5 + value - 1
+
+    def add_hint(self, hint: Hint):
+        if hint._type == Hint.HINT_TYPE_COL:
+            touched = HandBelief.TYPE_COLORS == UnknownCard.COLORS.index(hint.value)
+        else:
+            touched = HandBelief.TYPE_VALUES == hint.value
+        covered = np.zeros(len(self.mask), dtype=bool)
+        covered[[p for p in hint.positions if p < len(self.mask)]] = True
+        # covered slots keep the touched types, the others the remaining ones
+        self.mask &= covered[:, None] == touched[None, :]
+        self._probabilities = None
+        return
+
+    def add_visible_card(self, card: Card):
+        self.unseen[HandBelief.type_index(card.value, card.color)] -= 1
+        self._probabilities = None
+        return
+
+    def remove_slot(self, index: int):
+        self.mask = np.delete(self.mask, index, axis=0)
+        self._probabilities = None
+        return
+
+    def add_slot(self):
+        new_row = np.ones((1, HandBelief.N_TYPES), dtype=bool)
+        self.mask = np.vstack([self.mask, new_row])
+        self._probabilities = None
+        return
+
+    def probabilities(self) -> np.ndarray:
+        """Return the (hand size, 25) array of P(slot holds type)."""
+        if self._probabilities is not None:
+            return self._probabilities
+        unseen = np.maximum(self.unseen, 0).astype(float)
+        weights = self.mask * unseen
+        for _ in range(HandBelief.NORMALIZATION_ITERATIONS):
+            p = HandBelief._normalize_rows(weights)
+            expected = p.sum(axis=0)
+            over = expected > unseen
+            if not over.any():
+                break
+            # scale down the types expected in more slots than their copies
+            scale = np.ones_like(unseen)
+            scale[over] = unseen[over] / expected[over]
+            weights = p * scale
+        self._probabilities = HandBelief._normalize_rows(weights)
+        return self._probabilities
+
+    @staticmethod
+    def _normalize_rows(weights: np.ndarray) -> np.ndarray:
+        totals = weights.sum(axis=1, keepdims=True)
+        totals[totals == 0] = 1  # inconsistent knowledge: leave the row empty
+        return weights / totals
+
+    @staticmethod
+    def type_status(ledger: CardLedger) -> tuple:
+        """Return three boolean arrays over the card types: the playable ones,
+        the ones still needed to complete the fireworks and the critical ones,
+        i.e. needed types of which a single copy is left."""
+        heights = np.array([ledger.table_heights[c] for c in UnknownCard.COLORS])
+        discarded = np.zeros(HandBelief.N_TYPES, dtype=int)
+        for (value, color), n in ledger.discard_counts.items():
+            discarded[HandBelief.type_index(value, color)] = n
+        left = HandBelief.TYPE_COPIES - discarded
+        # the first value of each color whose copies are all discarded
+        dead = np.where(left == 0, HandBelief.TYPE_VALUES, 6).reshape(-1, 5).min(axis=1)
+        type_heights = heights[HandBelief.TYPE_COLORS]
+        playable = HandBelief.TYPE_VALUES == type_heights + 1
+        needed = (HandBelief.TYPE_VALUES > type_heights) & (
+            HandBelief.TYPE_VALUES < dead[HandBelief.TYPE_COLORS]
+        )
+        critical = needed & (left == 1)
+        return playable, needed, critical
+
+    def _product(self, ledger: CardLedger, key: str) -> np.ndarray:
+        """Return the probability of each slot of holding a type of the
+        `key` status, cached until the belief, the fireworks or the discard
+        pile change. The public knowledge replaces its dicts and counters
+        on every update, so their identity tells whether they changed: the
+        cache survives the actions that do not touch them, e.g. the hints
+        between the other players."""
+        probabilities = self.probabilities()
+        heights, discarded = ledger.table_heights, ledger.discard_counts
+        cache = self._products
+        if (
+            cache is None
+            or cache[0] is not probabilities
+            or cache[1] is not heights
+            or cache[2] is not discarded
+        ):
+            playable, needed, critical = HandBelief.type_status(ledger)
+            types = {"playable": playable, "useless": ~needed, "critical": critical}
+            cache = self._products = (probabilities, heights, discarded, types, dict())
+        products = cache[4]
+        if key not in products:
+            products[key] = probabilities @ cache[3][key]
+        return products[key]
+
+    def p_playable(self, ledger: CardLedger) -> np.ndarray:
+        """Return the probability of each slot of being playable."""
+        return self._product(ledger, "playable")
+
+    def p_critical(self, ledger: CardLedger) -> np.ndarray:
+        """Return the probability of each slot of being the last copy
+        of a card still needed."""
+        return self._product(ledger, "critical")
+
+    def p_useless(self, ledger: CardLedger) -> np.ndarray:
+        """Return the probability of each slot of being not needed anymore."""
+        return self._product(ledger, "useless")
+
+
+################### HINT INDEX ###################
+class HintIndex:
+    """For the hand of every other player, what each of the 10 possible
+    hints (5 colors, then the values 1 to 5) would touch: the positions as
+    a bitmask and the cards as a set. The clued positions are read from
+    the PublicKnowledge of the table. Updated incrementally on every draw,
+    play and discard."""
+
+    N_HINTS = 10
+
+    def __init__(self, players: list, my_name: str, public: PublicKnowledge):
+        # players in turn order, without me
+        self.players = [p.name for p in players if p.name != my_name]
+        self.hands = {name: [] for name in self.players}
+        self.masks = {name: [0] * HintIndex.N_HINTS for name in self.players}
+        self.cards = {
+            name: [set() for _ in range(HintIndex.N_HINTS)] for name in self.players
+        }
+        self.public = public
+        for p in players:
+            if p.name != my_name:
+                for card in p.hand:
+                    self.draw(p.name, card)
+
+    @property
+    def clued(self) -> dict:
+        """Player: bitmask of the clued positions of its hand."""
+        return self.public.clued
+
+    @staticmethod
+    def card_keys(card: Card) -> tuple:
+        """Return the keys of the color and the value hints touching the card."""
+        return UnknownCard.COLORS.index(card.color), 4 + card.value
+
+    @staticmethod
+    def hint_of(key: int) -> tuple:
+        """Return the (hint type, value) of the hint key."""
+        if key < 5:
+            return Hint.HINT_TYPE_COL, UnknownCard.COLORS[key]
+        return Hint.HINT_TYPE_VAL, key - 4
+
+    def draw(self, player: str, card: Card):
+        hand = self.hands[player]
+        bit = 1 << len(hand)
+        hand.append(card)
+        for key in HintIndex.card_keys(card):
+            self.masks[player][key] |= bit
+            self.cards[player][key].add(card)
+        return
+
+    def remove(self, player: str, index: int) -> Card:
+        """Remove the card in the given position: the following cards
+        slide one position down, as in the player's hand."""
+        card = self.hands[player].pop(index)
+        low = (1 << index) - 1
+
+        def shift(mask):
+            return (mask & low) | ((mask >> (index + 1)) << index)
+
+        masks = self.masks[player]
+        for key in range(HintIndex.N_HINTS):
+            masks[key] = shift(masks[key])
+        for key in HintIndex.card_keys(card):
+            self.cards[player][key].discard(card)
+        return card
+
+    def touched_cards(self, player: str, key: int) -> set:
+        """The set is owned by the index: do not modify it."""
+        return self.cards[player][key]
+
+    def touched_count(self, player: str, key: int, remove_clued=False) -> int:
+        mask = self.masks[player][key]
+        if remove_clued:
+            mask &= ~self.clued[player]
+        return mask.bit_count()
+
+    def best_hint(self, player: str, remove_clued=False) -> tuple:
+        """Return the (key, number of cards) of the hint touching the most
+        cards of the player, counting only the unclued ones if required.
+        Ties go to the hint touching the leftmost card, the value first."""
+        ignored = self.clued[player] if remove_clued else 0
+        best, best_rank = None, None
+        for key, mask in enumerate(self.masks[player]):
+            mask &= ~ignored
+            if not mask:
+                continue
+            first = (mask & -mask).bit_length()  # position of the leftmost card
+            rank = (-mask.bit_count(), first, key < 5)
+            if best_rank is None or rank < best_rank:
+                best, best_rank = key, rank
+        if best is None:
+            return None, 0
+        return best, -best_rank[0]
+
+
+################### STATE HASH ###################
+def _random_keys(rng: random.Random, *shape):
+    if not shape:
+        return rng.getrandbits(64)
+    return [_random_keys(rng, *shape[1:]) for _ in range(shape[0])]
+
+
+class StateHash:
+    """Zobrist hash of the cards known by the agent, split by color.
+
+    Every card feature (a value on the table, the k-th discarded copy of a
+    value, a value in a slot of another player, the values still possible
+    in a slot of the agent's hand) has a random key which depends on the
+    value but not on the color, xored in the hash of the card color.
+    Permuting the colors of a state permutes its five hashes, and two
+    colors with the same hash can be exchanged without changing the state.
+    Updated incrementally on every draw, play, discard and hint.
+
+    Keys are drawn from a fixed seed: hashes are the same in every process
+    and every run, so they can be persisted."""
+
+    MAX_PLAYERS = 5
+    MAX_HAND_SIZE = 5
+    _RNG = random.Random(0x48414E414249)
+    TABLE = _random_keys(_RNG, 6)  # value
+    DISCARD = _random_keys(_RNG, 6, 4)  # value, copy
+    HAND = _random_keys(_RNG, MAX_PLAYERS, MAX_HAND_SIZE, 6)  # offset, slot, value
+    MINE = _random_keys(_RNG, MAX_HAND_SIZE, 32)  # slot, mask of the values
+    VALUE_BITS = 1 << np.arange(5)
+
+    def __init__(self, players: list, my_name: str):
+        names = [p.name for p in players]
+        my_turn = names.index(my_name)
+        # position of every other player after the agent
+        self.offsets = {
+            name: (t - my_turn) % len(names)
+            for t, name in enumerate(names)
+            if name != my_name
+        }
+        self.colors = [0] * len(UnknownCard.COLORS)  # table, discard, hands
+        self.mine = [0] * len(UnknownCard.COLORS)  # agent's hand
+        self.discard_counts = Counter()
+        self.hands = {name: [] for name in self.offsets}
+
+    def table(self, card: Card):
+        self.colors[UnknownCard.COLORS.index(card.color)] ^= StateHash.TABLE[card.value]
+        return
+
+    def discard(self, card: Card):
+        key = (card.value, card.color)
+        self.discard_counts[key] += 1
+        copy = self.discard_counts[key]
+        c = UnknownCard.COLORS.index(card.color)
+        self.colors[c] ^= StateHash.DISCARD[card.value][copy]
+        return
+
+    def _toggle_card(self, player: str, slot: int, card: Card):
+        c = UnknownCard.COLORS.index(card.color)
+        self.colors[c] ^= StateHash.HAND[self.offsets[player]][slot][card.value]
+        return
+
+    def draw(self, player: str, card: Card):
+        hand = self.hands[player]
+        self._toggle_card(player, len(hand), card)
+        hand.append(card)
+        return
+
+    def remove(self, player: str, index: int):
+        """Remove the card in the given position, the following cards
+        slide one position down."""
+        hand = self.hands[player]
+        for slot in range(index, len(hand)):
+            self._toggle_card(player, slot, hand[slot])
+        hand.pop(index)
+        for slot in range(index, len(hand)):
+            self._toggle_card(player, slot, hand[slot])
+        return
+
+    def set_my_hand(self, mask: np.ndarray):
+        """Rehash the agent's hand from the (hand size, 25) mask of the
+        possible types of HandBelief."""
+        bits = mask.reshape(len(mask), len(self.mine), 5) @ StateHash.VALUE_BITS
+        self.mine = [0] * len(self.mine)
+        for slot, row in enumerate(bits.tolist()):
+            for c, values in enumerate(row):
+                self.mine[c] ^= StateHash.MINE[slot][values]
+        return
+
+    def color_hashes(self) -> list:
+        return [h ^ m for h, m in zip(self.colors, self.mine)]
+
+
 ################### HANABI STATE ###################
 class HanabiState:
-    def __init__(self, player: str, state_data: GameData.ServerGameStateData):
+    """The view of the game of a single agent. The public facts are read
+    from `public`, the PublicKnowledge of the table, which is shared with
+    the other agents of the table if given (see PublicKnowledge.shared).
+    The given instance is only used if it is at the same action as the
+    state: an agent whose first state is older or newer than the one of
+    the table keeps a private instance, so that no action is counted twice
+    or skipped."""
+
+    def __init__(
+        self,
+        player: str,
+        state_data: GameData.ServerGameStateData,
+        public: PublicKnowledge = None,
+    ):
 
         self.current_player = state_data.currentPlayer
         self.players_list = state_data.players
         self.used_note_tokens = state_data.usedNoteTokens
         self.used_storm_tokens = state_data.usedStormTokens
-        self.table_cards = state_data.tableCards
-        self.discard_pile = set(state_data.discardPile)
+        # number of the last action received: the state includes the previous ones
+        self.moves = state_data.actions
+        if public is None:
+            public = PublicKnowledge(state_data)
+        with public.lock:  # no action is applied while the view is built
+            if public.moves != self.moves:
+                public = PublicKnowledge(state_data)
+            self.public = public
+            self._load(player, state_data)
+        return
+
+    def _load(self, player: str, state_data: GameData.ServerGameStateData):
+        self.ledger = CardLedger(self.public)
+        self.ledger.load(state_data, player)
+        # incremented on every change, used to invalidate derived values
+        self.version = 0
+        # moves left before the end of the game, once the deck is empty
+        self.remaining_moves = None
 
-        # the first index is the player (in turn order)
-        self.other_players_hints = {player.name: set() for player in self.players_list}
         # tracks the info received by clued players' cards
         # dict: Cards: (number, color)
         self.cards_known_infos = dict()
@@ -294,10 +989,19 @@ class HanabiState:
                 self.my_turn = t
                 self.me = p
 
-        visible_cards = self.get_visible_cards()
-        self.inference = Inference(
-            self, self.n_cards, visible_cards, self.get_valid_playable_cards()
-        )
+        self.inference = Inference(self, self.n_cards)
+        self.hint_index = HintIndex(self.players_list, self.my_name, self.public)
+        self.state_hash = StateHash(self.players_list, self.my_name)
+        for pile in self.ledger.table_cards.values():
+            for card in pile:
+                self.state_hash.table(card)
+        for card in self.ledger.discard_pile:
+            self.state_hash.discard(card)
+        for p in self.players_list:
+            if p.name != self.my_name:
+                for card in p.hand:
+                    self.state_hash.draw(p.name, card)
+        self.state_hash.set_my_hand(self.inference.belief.mask)
 
         return
 
@@ -308,24 +1012,22 @@ class HanabiState:
                     self.my_turn == t
         return self.my_turn
 
+    @property
+    def discard_pile(self) -> set:
+        return self.ledger.discard_pile
+
     def get_visible_cards(self) -> set:
         """Return the set of RealCard which is currently in the hands
-        of the ohter players."""
-        visible_cards = (
-            set([c for p in self.players_list[1:] for c in p.hand])
-            .union(set(self.discard_pile))
-            .union(set(self.table_cards))
-        )
-        logging.debug(f"{visible_cards}")
-        return visible_cards
+        of the ohter players, on the table or in the discard pile."""
+        return self.ledger.visible_cards
 
     def update_state(self, new_state: GameData.ServerGameStateData):
+        """Update tokens and hands. Cards moved by the action are
+        registered in the ledger by the on_* methods."""
         self.used_note_tokens = new_state.usedNoteTokens
         self.used_storm_tokens = new_state.usedStormTokens
         self.players_list = new_state.players
-        self.table_cards = new_state.tableCards
-        self.discard_pile = set(new_state.discardPile)
-        self.inference.playable_cards = self.get_valid_playable_cards()
+        self.version += 1
         return
 
     def get_player(self, player_name: str) -> Player:
@@ -335,76 +1037,93 @@ class HanabiState:
         return None
 
     def on_hint(self, hint: Hint):
+        self.version += 1
+        self.moves += 1
+        self.public.apply(self.moves, self.public.hint, hint)
         if hint.to == self.me.name:
-            logging.debug(f"{self.me.name} received an hint from {hint._from}")
+            if tracing.ENABLED:
+                tracing.event("hint_received", player=self.my_name, sender=hint._from)
             self.inference.add_hint(hint)
+            self.state_hash.set_my_hand(self.inference.belief.mask)
         else:
-            logging.debug(f"{hint._from} sent an hint to {hint.to}")
-            receiver_hand = self.get_player(hint.to).hand
-            for p in hint.positions:
-                try:
-                    self.other_players_hints[hint.to].add(receiver_hand[p])
-                except IndexError:
-                    pass  # that hurts
+            if tracing.ENABLED:
+                tracing.event(
+                    "hint_seen", player=self.my_name, sender=hint._from, to=hint.to
+                )
+        self._count_move()
         return
 
     def on_play(self, play: Play):
-        logging.debug(f"card drawn: {play.card_drawn}")
-
+        self.version += 1
+        if tracing.ENABLED:
+            tracing.event("card_drawn", player=self.my_name, card=play.card_drawn)
+
+        self.moves += 1
+        self.public.apply(self.moves, self.public.play, play)
+        self.ledger.remove_card(play.real_card)
+        if play.result != Play.THUNDERSTRIKE:
+            self.state_hash.table(play.real_card)
+        else:
+            self.state_hash.discard(play.real_card)
         if play.sender == self.my_name:
             self.inference.add_new_unknown_card(play)
+            self.state_hash.set_my_hand(self.inference.belief.mask)
         else:
-            if play.real_card in self.other_players_hints[play.sender]:
-                self.other_players_hints[play.sender].remove(play.real_card)
-            self.inference.add_visible_card(play.card_drawn)
+            self.hint_index.remove(play.sender, play.card_index)
+            self.state_hash.remove(play.sender, play.card_index)
+            if play.card_drawn is not None:
+                self.hint_index.draw(play.sender, play.card_drawn)
+                self.state_hash.draw(play.sender, play.card_drawn)
+                self.ledger.draw_card(play.card_drawn)
+                self.inference.add_visible_card(play.card_drawn)
+        self._count_move()
         return
 
     def on_discard(self, discard: Discard):
+        self.version += 1
+        self.moves += 1
+        self.public.apply(self.moves, self.public.discard, discard)
+        self.ledger.remove_card(discard.card_discarded)
+        self.state_hash.discard(discard.card_discarded)
         if discard.sender == self.my_name:
             self.inference.add_new_unknown_card(discard)
+            self.state_hash.set_my_hand(self.inference.belief.mask)
         else:
-            if discard.card_discarded in self.other_players_hints[discard.sender]:
-                self.other_players_hints[discard.sender].remove(discard.card_discarded)
-            self.inference.add_visible_card(discard.card_drawn)
+            self.hint_index.remove(discard.sender, discard.card_index)
+            self.state_hash.remove(discard.sender, discard.card_index)
+            if discard.card_drawn is not None:
+                self.hint_index.draw(discard.sender, discard.card_drawn)
+                self.state_hash.draw(discard.sender, discard.card_drawn)
+                self.ledger.draw_card(discard.card_drawn)
+                self.inference.add_visible_card(discard.card_drawn)
+        self._count_move()
         return
 
-    def get_valid_playable_cards(self):
-        """Return the set of all possible playable cards."""
-        playable_cards = set()
-        for pile_color, cards_list in self.table_cards.items():
-            top_number = len(cards_list)
-            if top_number == 5:
-                continue  # no playable cards in this pile
-            playable_cards |= (
-                UnknownCard.possible_cards_with_info(top_number + 1, pile_color)
-                - self.discard_pile
-            )
-        return playable_cards
-
-    def get_future_playable_cards(self):
-        """Return the set of cards missing to complete the game."""
-        future_playable_cards = self.get_valid_playable_cards()
-        for pile_color, cards_list in self.table_cards.items():
-            top_number = len(cards_list)
-            if top_number == 5:
-                continue
-            # add the cards from current playable to 5 (included)
-            for required_number in range(top_number + 1, 6):
-                required_cards = UnknownCard.possible_cards_with_info(
-                    required_number, pile_color
-                )
-                # if required cards have been discarded...
-                if required_cards <= self.discard_pile:
-                    # the folliwing ones are not playable anymore
-                    # Ex: red 2 on top but all red 3s have been discarded
-                    #  => red 4s and 5s are not playable neither
-                    break
-                # otherwise include only cards that are not in the discard pile
-                future_playable_cards |= (
-                    UnknownCard.possible_cards_with_info(required_number, pile_color)
-                    - self.discard_pile
-                )
-        return future_playable_cards
+    def _count_move(self):
+        """Count the moves left once the deck is empty, as the server does."""
+        if self.deck_size() == 0:
+            if self.remaining_moves is None:
+                self.remaining_moves = len(self.players_list) + 1
+            self.remaining_moves -= 1
+        return
+
+    def deck_size(self) -> int:
+        """Return the number of cards left to draw."""
+        return (
+            CardLedger.N_CARDS
+            - len(self.ledger.visible_cards)
+            - len(self.inference.my_hand)
+        )
+
+    def get_valid_playable_cards(self) -> set:
+        """Return the set of all possible playable cards.
+        The set is owned by the ledger: do not modify it."""
+        return self.ledger.playable_cards
+
+    def get_future_playable_cards(self) -> set:
+        """Return the set of cards missing to complete the game.
+        The set is owned by the ledger: do not modify it."""
+        return self.ledger.future_playable_cards
 
     def __str__(self):
         note_tokens = f"{self.used_note_tokens}/8"
@@ -422,7 +1141,7 @@ class HanabiState:
         hints_for_player = list()
         player = self.get_player(player_name)
         for i, c in enumerate(player.hand):
-            if remove_clued and c in self.other_players_hints[player_name]:
+            if remove_clued and c in self.get_clued_cards(player_name):
                 continue
             card_info = [c.value, c.color]  # no card index??
             hints_for_player.extend(card_info)
@@ -436,7 +1155,143 @@ class HanabiState:
         return Counter(hints_for_player)
 
     def get_clued_cards(self, player: str) -> set:
-        return self.other_players_hints[player]
+        """Return the clued cards in the hand of another player."""
+        clued = self.public.clued[player]
+        hand = self.hint_index.hands.get(player, ())
+        return {card for p, card in enumerate(hand) if clued >> p & 1}
+
+    def canonical_key(self) -> tuple:
+        """Return the key of the state up to a permutation of the colors,
+        and the colors in the order of the key: the i-th color hash of the
+        key is the hash of the i-th returned color (see StateHash).
+
+        Two states have the same key when the agent sees the same tokens,
+        deck, fireworks, discard pile, hands and clues, and has the same
+        knowledge of its own hand, once the colors of one are renamed."""
+        hashes = self.state_hash.color_hashes()
+        order = sorted(range(len(hashes)), key=hashes.__getitem__)
+        clued = [0] * len(self.players_list)
+        for name, offset in self.state_hash.offsets.items():
+            clued[offset] = self.hint_index.clued[name]
+        key = (
+            self.used_note_tokens,
+            self.used_storm_tokens,
+            self.deck_size(),
+            self.remaining_moves,
+            self.inference.chop_index,
+            *clued[1:],
+            *(hashes[c] for c in order),
+        )
+        return key, [UnknownCard.COLORS[c] for c in order]
 
     def get_relative_player_order(self) -> list:
         return self.players_list[self.my_turn + 1 :] + self.players_list[: self.my_turn]
+
+
+################### DETERMINIZATION ###################
+ALL_CARDS = frozenset(UnknownCard.all_possible_cards())
+
+
+def sample_hand(state: HanabiState, rng: random.Random, max_attempts=100) -> list:
+    """Sample the agent's hand consistently with the possible cards of every
+    slot, without assigning the same physical card to two slots.
+    Return None if no consistent hand has been found."""
+    slots = list(enumerate(state.inference.my_hand))
+    # the most constrained slots first
+    slots.sort(key=lambda s: len(s[1].possible_cards))
+    for _ in range(max_attempts):
+        hand = [None] * len(slots)
+        assigned = set()
+        for i, unknown_card in slots:
+            candidates = list(unknown_card.possible_cards - assigned)
+            if not candidates:
+                break
+            hand[i] = rng.choice(candidates)
+            assigned.add(hand[i])
+        else:
+            return hand
+    return None
+
+
+def determinize(state: HanabiState, rng: random.Random) -> dict:
+    """Return a full game state consistent with what the agent knows:
+    the agent's hand is sampled and the deck is shuffled.
+    Return None if the agent's knowledge cannot be satisfied."""
+    my_hand = sample_hand(state, rng)
+    if my_hand is None:
+        return None
+    ledger = state.ledger
+    deck = list(ALL_CARDS - ledger.visible_cards - set(my_hand))
+    rng.shuffle(deck)
+    hands = {
+        p.name: (my_hand if p.name == state.my_name else list(p.hand))
+        for p in state.players_list
+    }
+    return {
+        "players": [p.name for p in state.players_list],
+        "hands": hands,
+        "deck": deck,
+        "table": {color: list(pile) for color, pile in ledger.table_cards.items()},
+        "discard": list(ledger.discard_pile),
+        "note_tokens": state.used_note_tokens,
+        "storm_tokens": state.used_storm_tokens,
+        "current_player": state.my_turn,
+        "remaining_moves": state.remaining_moves,
+    }
+
+
+################### DECISION CONTEXT ###################
+class DecisionContext:
+    """Values derived from an HanabiState that are shared by the rules
+    of a single decision. Each value is computed lazily, at most once per
+    state version."""
+
+    def __init__(self, state: HanabiState):
+        self.state = state
+        self.version = state.version
+        self._values = dict()
+
+    def is_valid(self) -> bool:
+        """Return True if the state has not changed since the context creation."""
+        return self.version == self.state.version
+
+    def _memoize(self, key, compute):
+        try:
+            return self._values[key]
+        except KeyError:
+            value = self._values[key] = compute()
+            return value
+
+    @property
+    def playable_cards(self) -> set:
+        return self.state.ledger.playable_cards
+
+    @property
+    def future_playable_cards(self) -> set:
+        return self.state.ledger.future_playable_cards
+
+    def relative_player_order(self) -> list:
+        return self._memoize("order", self.state.get_relative_player_order)
+
+    def playability(self) -> np.ndarray:
+        """Return, for each card in the agent's hand,
+        the probability of being currently playable."""
+        return self._memoize(
+            "playability",
+            lambda: self.state.inference.belief.p_playable(self.state.ledger),
+        )
+
+    def usefulness(self) -> np.ndarray:
+        """Return, for each card in the agent's hand, the probability
+        of being still needed to complete the fireworks."""
+        return self._memoize(
+            "usefulness",
+            lambda: 1 - self.state.inference.belief.p_useless(self.state.ledger),
+        )
+
+    def warm_up(self):
+        """Compute in advance the values the rules ask for."""
+        self.playability()
+        self.usefulness()
+        self.relative_player_order()
+        return
@@ -0,0 +1,102 @@
+import GameData
+from game import Game
+from hanabi_model import (
+    DecisionContext,
+    HanabiAction,
+    HanabiState,
+    Hint,
+    Play,
+    Discard,
+    action_from_server_data,
+    request_from_action,
+)
+from rule_pipeline import RulePipeline
+
+
+class LocalSeat:
+    """A player of a LocalGame. It keeps its own HanabiState, fed with the
+    same data a Client would receive from the server. The public facts are
+    kept in `public` if given (see PublicKnowledge)."""
+
+    def __init__(self, name: str, game: Game, policy: RulePipeline, public=None):
+        self.name = name
+        self.game = game
+        self.policy = policy
+        self.hanabi_state = HanabiState(name, self.fetch_state(), public)
+
+    def fetch_state(self) -> GameData.ServerGameStateData:
+        request = GameData.ClientGetGameStateRequest(self.name)
+        state, _ = self.game.satisfyRequest(request, self.name)
+        return state
+
+    def decide(self) -> HanabiAction:
+        return self.policy.decide(self.hanabi_state, DecisionContext(self.hanabi_state))
+
+    def observe(self, data: GameData.ServerToClientData):
+        """Register in the seat state the action notified by the server."""
+        new_state = self.fetch_state()
+        action = action_from_server_data(data, new_state, self.name)
+        self.hanabi_state.update_state(new_state)
+        if type(action) is Hint:
+            self.hanabi_state.on_hint(action)
+        elif type(action) is Discard:
+            self.hanabi_state.on_discard(action)
+        elif type(action) is Play:
+            self.hanabi_state.on_play(action)
+        return
+
+
+class LocalGame:
+    """A whole Hanabi game played in a single process, without server
+    and sockets. Every seat plays with the given policy.
+
+    If `game` is given, the game continues from its current state (see
+    Game.loadState), otherwise a new game is started, dealing the deck
+    of the given `seed` if any (see Game.start).
+    `on_decision`, if given, is called as on_decision(seat, action) right
+    before each action is sent to the game."""
+
+    def __init__(
+        self, n_players: int, policy=None, on_decision=None, game=None, seed=None
+    ):
+        self.policy = RulePipeline() if policy is None else policy
+        self.on_decision = on_decision
+        if game is None:
+            game = Game()
+            for i in range(n_players):
+                game.addPlayer(f"local_{i}")
+            game.start(seed)
+        self.game = game
+        self.names = [p.name for p in game.getPlayers()]
+        # the seats share the public knowledge of the first one
+        self.seats = []
+        public = None
+        for name in self.names:
+            seat = LocalSeat(name, self.game, self.policy, public)
+            public = seat.hanabi_state.public
+            self.seats.append(seat)
+        current_player = self.seats[0].hanabi_state.current_player
+        self.turns = self.names.index(current_player)
+
+    def play(self, first_action: HanabiAction = None) -> int:
+        """Play the game until the end and return the final score.
+        If given, `first_action` is played by the current player
+        instead of the policy decision."""
+        while not self.game.isGameOver():
+            seat = self.seats[self.turns % len(self.seats)]
+            if first_action is not None:
+                action, first_action = first_action, None
+            else:
+                action = seat.decide()
+            if self.on_decision is not None:
+                self.on_decision(seat, action)
+            request = request_from_action(action, seat.name)
+            single_data, multiple_data = self.game.satisfyRequest(request, seat.name)
+            if single_data is not None:
+                raise ValueError(f"Invalid action by {seat.name}: {action}")
+            self.turns += 1
+            if type(multiple_data) is GameData.ServerGameOver:
+                return multiple_data.score
+            for s in self.seats:
+                s.observe(multiple_data)
+        return self.game.getScore()
@@ -0,0 +1,198 @@
+import logging
+import os
+import random
+import sys
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from statistics import mean
+from time import perf_counter
+from game import Game, Player
+from hanabi_model import (
+    HanabiAction,
+    HanabiState,
+    Hint,
+    Play,
+    Discard,
+    determinize,
+)
+from local_game import LocalGame
+from rule_based_agent import RuleBasedAgent
+
+
+def build_game(world: dict) -> Game:
+    players = []
+    for name in world["players"]:
+        player = Player(name)
+        player.hand = list(world["hands"][name])
+        players.append(player)
+    game = Game()
+    game.loadState(
+        players,
+        list(world["deck"]),
+        {color: list(pile) for color, pile in world["table"].items()},
+        list(world["discard"]),
+        world["note_tokens"],
+        world["storm_tokens"],
+        world["current_player"],
+        world["remaining_moves"],
+    )
+    return game
+
+
+def rollout(world: dict, action: HanabiAction, seed: int) -> int:
+    """Play `action` in the given world, then let every player follow the
+    rules until the end of the game. Return the final score."""
+    random.seed(seed)
+    game = build_game(world)
+    return LocalGame(len(world["players"]), game=game).play(first_action=action)
+
+
+def _init_worker():
+    """Silence the rules and the game in the rollout processes."""
+    logging.getLogger().setLevel(logging.WARNING)
+    sys.stdout = open(os.devnull, "w")
+
+
+def candidate_actions(state: HanabiState) -> list:
+    """Return every legal action of the agent in the given state."""
+    actions = [Play(state.my_name, i) for i in range(len(state.inference.my_hand))]
+    if state.used_note_tokens > 0:
+        actions += [
+            Discard(state.my_name, i) for i in range(len(state.inference.my_hand))
+        ]
+    if state.used_note_tokens < 8:
+        for player in state.get_relative_player_order():
+            for value in sorted({c.value for c in player.hand}):
+                actions.append(
+                    Hint(state.my_name, player.name, Hint.HINT_TYPE_VAL, value)
+                )
+            for color in sorted({c.color for c in player.hand}):
+                actions.append(
+                    Hint(state.my_name, player.name, Hint.HINT_TYPE_COL, color)
+                )
+    return actions
+
+
+def same_action(a: HanabiAction, b: HanabiAction) -> bool:
+    if type(a) is not type(b):
+        return False
+    if isinstance(a, Hint):
+        return (a.to, a._type, a.value) == (b.to, b._type, b.value)
+    return a.card_index == b.card_index
+
+
+class MonteCarloAgent(RuleBasedAgent):
+    """A RuleBasedAgent that searches its move with determinized Monte Carlo
+    rollouts.
+
+    Every candidate action is evaluated on sampled worlds, where the agent's
+    hand is drawn from its Inference and the deck is shuffled, by playing the
+    rest of the game with the rules. Rollouts run in a process pool, one per
+    worker, until the time budget of the move expires. An action replaces the
+    rule-based one only if it has at least min_rollouts rollouts and its mean
+    score beats the mean of the rule-based action by `margin` points."""
+
+    def __init__(
+        self, name, time_budget=1.0, max_workers=None, min_rollouts=16, margin=0.5
+    ):
+        super().__init__(name)
+        self.time_budget = time_budget
+        self.min_rollouts = min_rollouts
+        self.margin = margin
+        self.max_workers = max_workers or os.cpu_count()
+        self.executor = None
+        self.rng = random.Random()
+
+    def get_action_to_be_played(self) -> HanabiAction:
+        rule_action = super().get_action_to_be_played()
+        deadline = perf_counter() + self.time_budget
+        # the rule-based action comes first, so that it always has rollouts
+        candidates = [rule_action] + [
+            a
+            for a in candidate_actions(self.hanabi_state)
+            if not same_action(a, rule_action)
+        ]
+        scores = [[] for _ in candidates]
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(
+                self.max_workers, initializer=_init_worker
+            )
+
+        pending = dict()  # future: candidate index, submission time
+        next_candidate = 0
+        durations = []
+        while perf_counter() < deadline:
+            # one rollout per worker, visiting the candidates round robin; no
+            # rollout is started if it is not expected to end before the
+            # deadline, so that the pool is free at the next move
+            expected = mean(durations) if durations else 0.0
+            while (
+                len(pending) < self.max_workers
+                and perf_counter() + expected < deadline
+            ):
+                world = determinize(self.hanabi_state, self.rng)
+                if world is None:
+                    break
+                i = next_candidate % len(candidates)
+                future = self.executor.submit(
+                    rollout, world, candidates[i], self.rng.getrandbits(32)
+                )
+                pending[future] = i, perf_counter()
+                next_candidate += 1
+            if not pending:
+                break
+            done, _ = wait(
+                pending,
+                timeout=max(0, deadline - perf_counter()),
+                return_when=FIRST_COMPLETED,
+            )
+            for future in done:
+                i, submitted = pending.pop(future)
+                durations.append(perf_counter() - submitted)
+                self._add_score(scores[i], future)
+        # the rollouts already running cannot be cancelled: wait for them
+        for future in pending:
+            future.cancel()
+        for future in wait(pending).done:
+            if not future.cancelled():
+                self._add_score(scores[pending[future][0]], future)
+
+        best_action, best_score = rule_action, None
+        if scores[0]:
+            best_score = mean(scores[0])
+            threshold = best_score + self.margin
+            for action, action_scores in zip(candidates, scores):
+                if len(action_scores) < self.min_rollouts:
+                    continue
+                if mean(action_scores) > threshold:
+                    best_action, threshold = action, mean(action_scores)
+        logging.info(
+            f"{self.player_name} - {sum(map(len, scores))} rollouts, "
+            f"rule action mean score: {best_score}, "
+            f"{'rule' if best_action is rule_action else 'searched'} action played"
+        )
+        return best_action
+
+    def _add_score(self, scores: list, future):
+        if future.exception() is not None:
+            logging.error(
+                f"{self.player_name} - rollout failed",
+                exc_info=future.exception(),
+            )
+            return
+        scores.append(future.result())
+        return
+
+    def run(self):
+        super().run()
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+        return
+
+
+if __name__ == "__main__":
+    agent = MonteCarloAgent(
+        sys.argv[1], time_budget=float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+    )
+    agent.send_start()
+    agent.wait_start()
+    agent.run()
@@ -1,22 +1,387 @@
-from rule_based_agent import RuleBasedAgent
-import sys
-from threading import Thread
+"""Launch rule based agents over a pool of processes.
 
+    python play_agent.py N [--per-process K] [--affinity] [--max-restarts R]
+                           [--asyncio | --background-reader] [--multiplex]
+                           [--profile-dir DIR] [--trace-dir DIR]
+                           [--decision-cache FILE [--cache-size N]]
 
-def deploy_agent(agent):
+Each process hosts up to K agents, one thread each, so that the rule
+evaluation of different processes is not serialized by the GIL. With
+--asyncio the agents of a process share a single event loop instead,
+with --background-reader each agent decodes the server responses in a
+separate thread and prepares its decision while waiting for its turn.
+With --multiplex the (threaded) agents of a process share a single
+connection to the server (see session.Session).
+The launcher restarts the processes that crash in the lobby and
+periodically reports the decisions per second of every process. Once the
+game has started, the server has dropped the players of a crashed process
+and they cannot rejoin it: such crashes are reported, not restarted.
+
+With --decision-cache the agents of each process share a decision cache
+(see decision_cache), loaded from FILE at start and merged back at exit;
+the reports include its hit rate."""
+import argparse
+import asyncio
+import logging
+import multiprocessing as mp
+import os
+import queue
+import time
+import decision_cache
+import tracing
+from threading import BrokenBarrierError, Thread
+from rule_based_agent import AsyncRuleBasedAgent, RuleBasedAgent
+from session import Session
+
+
+def deploy_agent(agent, started=None):
     """Agent must be deployed (send_ready) after they are connected
     otherwise only the first two will be in the game."""
     # TODO: change agent interface for entering the game
     agent.send_start()
     agent.wait_start()
+    if started is not None:
+        started.set()
     agent.run()  # entry point for the game
     return
 
 
-agents = []
-for a in range(int(sys.argv[1])):
-    name = f"agent_{a}"
-    agent = RuleBasedAgent(name)
-    agents.append(agent)
-for agent in agents:
-    Thread(target=deploy_agent, args=[agent]).start()
+def wait_connected(connected):
+    """Wait for every other worker to be connected."""
+    if connected is not None:
+        try:
+            connected.wait()
+        except BrokenBarrierError:
+            pass  # another worker crashed while connecting: play anyway
+    return
+
+
+async def deploy_async_agent(agent, started=None):
+    await agent.send_start()
+    await agent.wait_start()
+    if started is not None:
+        started.set()
+    await agent.run()
+    await agent.close()
+    return
+
+
+async def run_async_agents(
+    worker_id, names, connected, started, stats, report_interval, profile_dir=None
+):
+    """Drive every agent of the worker from a single event loop."""
+    agents = [AsyncRuleBasedAgent(name, profile_dir=profile_dir) for name in names]
+    await asyncio.gather(*(agent.connect() for agent in agents))
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, wait_connected, connected)
+    games = asyncio.gather(
+        *(deploy_async_agent(agent, started) for agent in agents)
+    )
+
+    start = time.perf_counter()
+    while not games.done():
+        await asyncio.wait([games], timeout=report_interval)
+        decisions = sum(agent.decisions for agent in agents)
+        elapsed = time.perf_counter() - start
+        stats.put((worker_id, decisions, elapsed, *decision_cache.counters()))
+    games.result()  # propagate the errors of the agents
+    return
+
+
+def run_agents(
+    worker_id,
+    names,
+    cpu,
+    connected,
+    started,
+    stats,
+    report_interval,
+    use_asyncio=False,
+    background_reader=False,
+    profile_dir=None,
+    trace_dir=None,
+    cache_path=None,
+    cache_size=decision_cache.DEFAULT_CAPACITY,
+    multiplex=False,
+):
+    """Entry point of a worker process: connect the agents, wait for every
+    other worker to be connected, then play. `started` is set once the game
+    has started."""
+    if cpu is not None and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, {cpu})
+    if trace_dir is not None:
+        tracing.enable()
+    if cache_path is not None:
+        decision_cache.enable(cache_size, cache_path)
+    if use_asyncio:
+        asyncio.run(
+            run_async_agents(
+                worker_id,
+                names,
+                connected,
+                started,
+                stats,
+                report_interval,
+                profile_dir,
+            )
+        )
+    else:
+        run_threaded_agents(
+            worker_id,
+            names,
+            connected,
+            started,
+            stats,
+            report_interval,
+            background_reader,
+            profile_dir,
+            multiplex,
+        )
+    if trace_dir is not None:
+        os.makedirs(trace_dir, exist_ok=True)
+        tracing.flush(os.path.join(trace_dir, f"agents-{worker_id}.jsonl"))
+    if cache_path is not None:
+        decision_cache.save()
+    return
+
+
+def run_threaded_agents(
+    worker_id,
+    names,
+    connected,
+    started,
+    stats,
+    report_interval,
+    background_reader,
+    profile_dir,
+    multiplex=False,
+):
+    """Run every agent of the worker in its own thread."""
+    session = Session() if multiplex else None
+    agents = [
+        RuleBasedAgent(
+            name,
+            profile_dir=profile_dir,
+            background_reader=background_reader,
+            transport=None if session is None else session.seat(),
+        )
+        for name in names
+    ]
+    wait_connected(connected)
+    threads = [
+        Thread(target=deploy_agent, args=[agent, started]) for agent in agents
+    ]
+    for t in threads:
+        t.start()
+
+    start = time.perf_counter()
+    while any(t.is_alive() for t in threads):
+        for t in threads:
+            t.join(report_interval / len(threads))
+        decisions = sum(agent.decisions for agent in agents)
+        elapsed = time.perf_counter() - start
+        stats.put((worker_id, decisions, elapsed, *decision_cache.counters()))
+    return
+
+
+class AgentLauncher:
+    """Spread the agents over `n_processes` processes and supervise them."""
+
+    def __init__(
+        self,
+        n_agents: int,
+        per_process: int,
+        affinity=False,
+        max_restarts=3,
+        report_interval=5.0,
+        use_asyncio=False,
+        background_reader=False,
+        profile_dir=None,
+        trace_dir=None,
+        cache_path=None,
+        cache_size=decision_cache.DEFAULT_CAPACITY,
+        multiplex=False,
+    ):
+        self.names = [f"agent_{a}" for a in range(n_agents)]
+        self.groups = [
+            self.names[i : i + per_process]
+            for i in range(0, n_agents, per_process)
+        ]
+        self.affinity = affinity
+        self.max_restarts = max_restarts
+        self.report_interval = report_interval
+        self.use_asyncio = use_asyncio
+        self.background_reader = background_reader
+        self.profile_dir = profile_dir
+        self.trace_dir = trace_dir
+        self.cache_path = cache_path
+        self.cache_size = cache_size
+        self.multiplex = multiplex
+        self.stats = mp.Queue()
+        self.processes = dict()  # worker id: Process
+        self.connected = None
+        self.started = mp.Event()  # set by the workers when the game starts
+        self.restarts = {w: 0 for w in range(len(self.groups))}
+        # worker id: (decisions, elapsed, cache hits, cache lookups)
+        self.decisions = {w: (0, 0.0, 0, 0) for w in range(len(self.groups))}
+
+    def _start_worker(self, worker_id: int, connected=None):
+        cpu = None
+        if self.affinity:
+            cpu = worker_id % os.cpu_count()
+        process = mp.Process(
+            target=run_agents,
+            args=(
+                worker_id,
+                self.groups[worker_id],
+                cpu,
+                connected,
+                self.started,
+                self.stats,
+                self.report_interval,
+                self.use_asyncio,
+                self.background_reader,
+                self.profile_dir,
+                self.trace_dir,
+                self.cache_path,
+                self.cache_size,
+                self.multiplex,
+            ),
+            name=f"agents-{worker_id}",
+        )
+        process.start()
+        self.processes[worker_id] = process
+        return
+
+    def run(self):
+        # agents join the lobby only when all of them are connected
+        self.connected = mp.Barrier(len(self.groups))
+        for worker_id in range(len(self.groups)):
+            self._start_worker(worker_id, self.connected)
+
+        last_report = time.perf_counter()
+        while self.processes:
+            try:
+                worker_id, *stats = self.stats.get(timeout=1.0)
+                self.decisions[worker_id] = stats
+            except queue.Empty:
+                pass
+            self._check_workers()
+            if time.perf_counter() - last_report >= self.report_interval:
+                self.report()
+                last_report = time.perf_counter()
+        self.report()
+        return
+
+    def _check_workers(self):
+        """Restart the workers crashed in the lobby, forget the ones that
+        completed. A restarted worker reconnects its players with the same
+        names, which only works until the game starts."""
+        for worker_id, process in list(self.processes.items()):
+            if process.is_alive():
+                continue
+            del self.processes[worker_id]
+            if process.exitcode == 0:
+                continue
+            logging.warning(
+                f"agents-{worker_id} crashed with exit code {process.exitcode}"
+            )
+            self.connected.abort()  # do not keep the other workers waiting
+            if self.started.is_set():
+                logging.error(
+                    f"agents-{worker_id} crashed during the game: its players "
+                    f"{', '.join(self.groups[worker_id])} cannot rejoin it"
+                )
+            elif self.restarts[worker_id] < self.max_restarts:
+                self.restarts[worker_id] += 1
+                self._start_worker(worker_id)
+        return
+
+    def report(self):
+        total = 0.0
+        total_hits = total_lookups = 0
+        for worker_id, stats in sorted(self.decisions.items()):
+            decisions, elapsed, hits, lookups = stats
+            rate = decisions / elapsed if elapsed else 0.0
+            total += rate
+            total_hits += hits
+            total_lookups += lookups
+            cache = f", cache hit rate {hits / lookups:.1%}" if lookups else ""
+            logging.info(
+                f"agents-{worker_id}: {decisions} decisions, {rate:.1f} decisions/s"
+                f"{cache} ({self.restarts[worker_id]} restarts)"
+            )
+        cache = ""
+        if total_lookups:
+            cache = f", cache hit rate {total_hits / total_lookups:.1%}"
+        logging.info(f"total: {total:.1f} decisions/s{cache}")
+        return
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("n_agents", type=int)
+    parser.add_argument(
+        "--per-process",
+        type=int,
+        default=None,
+        help="agents hosted by each process (default: spread over all the cores)",
+    )
+    parser.add_argument(
+        "--affinity", action="store_true", help="pin each process to a core"
+    )
+    parser.add_argument("--max-restarts", type=int, default=3)
+    parser.add_argument("--report-interval", type=float, default=5.0)
+    parser.add_argument(
+        "--profile-dir",
+        default=None,
+        help="profile the rules and write the profiles in this directory",
+    )
+    parser.add_argument(
+        "--trace-dir",
+        default=None,
+        help="trace the agents and write the traces in this directory at exit",
+    )
+    parser.add_argument(
+        "--decision-cache",
+        default=None,
+        help="share a decision cache between the agents, persisted in this file",
+    )
+    parser.add_argument(
+        "--cache-size", type=int, default=decision_cache.DEFAULT_CAPACITY
+    )
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        "--asyncio",
+        action="store_true",
+        help="drive the agents of each process from one event loop",
+    )
+    mode.add_argument(
+        "--background-reader",
+        action="store_true",
+        help="read the server responses in a separate thread per agent",
+    )
+    parser.add_argument(
+        "--multiplex",
+        action="store_true",
+        help="share one connection between the agents of each process",
+    )
+    args = parser.parse_args()
+    if args.multiplex and args.asyncio:
+        parser.error("--multiplex is not supported with --asyncio")
+
+    per_process = args.per_process or -(-args.n_agents // os.cpu_count())
+    AgentLauncher(
+        args.n_agents,
+        per_process,
+        affinity=args.affinity,
+        max_restarts=args.max_restarts,
+        report_interval=args.report_interval,
+        use_asyncio=args.asyncio,
+        background_reader=args.background_reader,
+        profile_dir=args.profile_dir,
+        trace_dir=args.trace_dir,
+        cache_path=args.decision_cache,
+        cache_size=args.cache_size,
+        multiplex=args.multiplex,
+    ).run()
@@ -1,44 +1,75 @@
 import logging
+from async_client import AsyncClient
 from client import Client
-from hanabi_model import HanabiAction, HanabiState, Hint, Discard, Play
-import rules as rl
+from hanabi_model import (
+    DecisionContext,
+    HanabiAction,
+    HanabiState,
+    Hint,
+    Discard,
+    Play,
+    PublicKnowledge,
+)
+from rule_pipeline import RulePipeline
+from rule_profiler import RuleProfiler
+import tracing
 import GameData
 
 
-class RuleBasedAgent(Client):
-    """A Client enriched with a state which tracks
-    user's actions and make inferences.
+class RuleBasedMixin:
+    """The agent logic, shared by the blocking and the asyncio clients:
+    a state which tracks user's actions and make inferences.
 
     On the same state the agent performs the rule
-    match to get the action to play."""
+    match to get the action to play.
+
+    If `profile_dir` is given the rule matches are profiled and the
+    profile is written in that directory at game over (see RuleProfiler).
+    If `shared_knowledge` is set, the agents of the process playing at the
+    same table track the public facts of the game once for all
+    (see PublicKnowledge)."""
 
     SIGN = "_asd"
 
-    def __init__(self, name):
-        super().__init__(name + RuleBasedAgent.SIGN)
-        self.rules = [
-            rl.PlaySafeCard,
-            rl.PlayAlmostSafeCard,
-            rl.HintPlayableCard,
-            rl.DiscardUselessCard,
-            rl.HintUsefulChop,
-            rl.HintMostUncluedCards,
-            rl.HintMostCards,
-            rl.HintUselessCard,
-            rl.DiscardLessUsefulCard,
-            rl.DiscardChop,
-            rl.HintRandomCard,
-            rl.DiscardRandomCard,
-            rl.PlayLessRiskyCard,
-        ]
+    def __init__(self, name, profile_dir=None, shared_knowledge=True, **kwargs):
+        super().__init__(name + RuleBasedMixin.SIGN, **kwargs)
+        self.shared_knowledge = shared_knowledge
+        self.pipeline = RulePipeline()
+        self.rules = self.pipeline.rules
         self.hanabi_state = None
+        self.decision_context = None
+        self.decisions = 0
+        self.profile_dir = profile_dir
+        self.profiler = None if profile_dir is None else RuleProfiler()
+
+    def get_decision_context(self) -> DecisionContext:
+        """Return the context of the current state version,
+        creating a new one if the state has changed."""
+        ctx = self.decision_context
+        if ctx is None or not ctx.is_valid():
+            ctx = self.decision_context = DecisionContext(self.hanabi_state)
+        return ctx
+
+    def prepare_decision(self):
+        """Warm up the context of the current state: the probabilities
+        over the agent's hand are cached until the belief, the fireworks or
+        the discard pile change (see HandBelief), so the work survives the
+        hints between the other players."""
+        self.get_decision_context().warm_up()
+        return
 
     def get_action_to_be_played(self) -> HanabiAction:
-        for rule in self.rules:
-            print(rule)
-            action = rule.match(self.hanabi_state)
-            if action is not None:
-                return action
+        self.decisions += 1
+        ctx = self.get_decision_context()
+        if self.profiler is None:
+            return self.pipeline.decide(self.hanabi_state, ctx)
+        return self.profiler.decide(self.pipeline, self.hanabi_state, ctx)
+
+    def dump_profile(self):
+        if self.profiler is None:
+            return
+        path = self.profiler.dump(self.profile_dir, self.player_name)
+        logging.info(f"{self.player_name} - rule profile written to {path}")
         return
 
     def _init_game_state(self, state: GameData.ServerStartGameData):
@@ -46,8 +77,12 @@ class RuleBasedAgent(Client):
         if self.hanabi_state is not None:
             return
 
-        self.hanabi_state = HanabiState(self.player_name, state)
-        print(self.hanabi_state)
+        public = None
+        if self.shared_knowledge:
+            table = (self.host, self.port, tuple(p.name for p in state.players))
+            public = PublicKnowledge.shared(table, state)
+        self.hanabi_state = HanabiState(self.player_name, state, public)
+        logging.debug("%s", self.hanabi_state)
         return
 
     def update_state_with_action(
@@ -60,7 +95,8 @@ class RuleBasedAgent(Client):
         super().update_state_with_action(action_response, new_state)
 
         self.hanabi_state.update_state(new_state)
-        logging.debug(f"{action_response}")
+        if tracing.ENABLED:
+            tracing.event("action", player=self.player_name, action=action_response)
         if type(action_response) is Hint:
             # an hint has been sent :^O
             self.hanabi_state.on_hint(action_response)
@@ -75,3 +111,21 @@ class RuleBasedAgent(Client):
                 f"Unexpected response received. {action_response}, {action_response.message}"
             )
         return
+
+
+class RuleBasedAgent(RuleBasedMixin, Client):
+    """A Client playing with the rules."""
+
+    def run(self):
+        super().run()
+        self.dump_profile()
+        return
+
+
+class AsyncRuleBasedAgent(RuleBasedMixin, AsyncClient):
+    """An AsyncClient playing with the rules."""
+
+    async def run(self):
+        await super().run()
+        self.dump_profile()
+        return
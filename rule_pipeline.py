@@ -0,0 +1,86 @@
+import hashlib
+from itertools import product
+from hanabi_model import DecisionContext, HanabiAction, HanabiState
+import decision_cache
+import rules as rl
+
+
+DEFAULT_RULES = [
+    rl.PlayEndgame,
+    rl.PlaySafeCard,
+    rl.PlayAlmostSafeCard,
+    rl.HintPlayableCard,
+    rl.DiscardUselessCard,
+    rl.HintUsefulChop,
+    rl.HintMostUncluedCards,
+    rl.HintMostCards,
+    rl.HintUselessCard,
+    rl.DiscardLessUsefulCard,
+    rl.DiscardChop,
+    rl.HintRandomCard,
+    rl.DiscardRandomCard,
+    rl.PlayLessRiskyCard,
+]
+
+
+class RulePipeline:
+    """An ordered list of rules compiled against their token preconditions.
+
+    For every (used note tokens, used storm tokens) bucket the pipeline
+    stores the ordered list of rules that can possibly fire, so that the
+    token guards are evaluated once at compile time instead of once per
+    rule per decision. The guards are cheap, so this is about declaring
+    the preconditions rather than latency: bench_rules.py measures no
+    difference next to the cost of matching the rules."""
+
+    MAX_NOTE_TOKENS = 8
+    MAX_STORM_TOKENS = 3
+
+    def __init__(self, rules=None):
+        self.rules = list(DEFAULT_RULES if rules is None else rules)
+        self.buckets = dict()
+        for note_tokens, storm_tokens in product(
+            range(RulePipeline.MAX_NOTE_TOKENS + 1),
+            range(RulePipeline.MAX_STORM_TOKENS),
+        ):
+            self.buckets[(note_tokens, storm_tokens)] = [
+                rule
+                for rule in self.rules
+                if rule.is_eligible(note_tokens, storm_tokens)
+            ]
+        self.fingerprint = RulePipeline.fingerprint_of(self.rules)
+        return
+
+    @staticmethod
+    def fingerprint_of(rules: list) -> str:
+        """Return a digest of the rules and of their parameters (the upper
+        case class attributes), stable across processes and runs."""
+        parameters = [
+            (
+                rule.__name__,
+                [(name, getattr(rule, name)) for name in dir(rule) if name.isupper()],
+            )
+            for rule in rules
+        ]
+        return hashlib.sha1(repr(parameters).encode()).hexdigest()[:16]
+
+    def eligible_rules(self, state: HanabiState) -> list:
+        """Return the ordered list of rules that can fire in the given state."""
+        return self.buckets[(state.used_note_tokens, state.used_storm_tokens)]
+
+    def decide(self, state: HanabiState, ctx: DecisionContext = None) -> HanabiAction:
+        """Return the action of the first eligible rule that matches,
+        looked up in the shared decision cache when it is enabled."""
+        if ctx is None:
+            ctx = DecisionContext(state)
+        if decision_cache.ENABLED:
+            return decision_cache.decide(self, state, ctx)
+        return self.match(state, ctx)
+
+    def match(self, state: HanabiState, ctx: DecisionContext) -> HanabiAction:
+        """Return the action of the first eligible rule that matches."""
+        for rule in self.eligible_rules(state):
+            action = rule.match(state, ctx)
+            if action is not None:
+                return action
+        return None
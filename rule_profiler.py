@@ -0,0 +1,174 @@
+"""Per-rule profiling of the rule based agents.
+
+A RuleProfiler records, for every rule, the number of match calls, how
+many of them returned an action and the time spent in each call, plus the
+type of the actions finally chosen. Agents dump it to JSON at game over;
+the dumps of many agents and games are merged with
+
+    python rule_profiler.py aggregate FILE_OR_DIR [FILE_OR_DIR ...] [--json]
+"""
+import argparse
+import json
+import os
+import time
+from collections import Counter
+from time import perf_counter
+
+
+class RuleStats:
+    """Calls, matches and call durations (in seconds) of a single rule."""
+
+    def __init__(self, calls=0, matches=0, samples=None):
+        self.calls = calls
+        self.matches = matches
+        self.samples = [] if samples is None else samples
+
+    @property
+    def total_time(self) -> float:
+        return sum(self.samples)
+
+    @property
+    def match_rate(self) -> float:
+        return self.matches / self.calls if self.calls else 0.0
+
+    def percentile(self, q: float) -> float:
+        if not self.samples:
+            return 0.0
+        samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+    def merge(self, other):
+        self.calls += other.calls
+        self.matches += other.matches
+        self.samples.extend(other.samples)
+        return
+
+    def to_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "matches": self.matches,
+            "match_rate": self.match_rate,
+            "total_time": self.total_time,
+            "p99_time": self.percentile(0.99),
+            "samples": self.samples,
+        }
+
+    @staticmethod
+    def from_dict(data: dict):
+        return RuleStats(data["calls"], data["matches"], list(data["samples"]))
+
+
+class RuleProfiler:
+    """Profile the decisions of a RulePipeline.
+
+    The agents only use it when profiling is enabled: otherwise they call
+    RulePipeline.decide directly and pay nothing."""
+
+    def __init__(self):
+        self.rules = dict()  # rule name: RuleStats
+        self.actions = Counter()  # action type name: number of decisions
+        self.decisions = 0
+
+    def decide(self, pipeline, state, ctx):
+        """Same as pipeline.decide, recording the statistics of the call."""
+        self.decisions += 1
+        for rule in pipeline.eligible_rules(state):
+            start = perf_counter()
+            action = rule.match(state, ctx)
+            elapsed = perf_counter() - start
+            stats = self.rules.get(rule.__name__)
+            if stats is None:
+                stats = self.rules[rule.__name__] = RuleStats()
+            stats.calls += 1
+            stats.samples.append(elapsed)
+            if action is not None:
+                stats.matches += 1
+                self.actions[type(action).__name__] += 1
+                return action
+        self.actions["None"] += 1
+        return None
+
+    def merge(self, other):
+        for name, stats in other.rules.items():
+            self.rules.setdefault(name, RuleStats()).merge(stats)
+        self.actions.update(other.actions)
+        self.decisions += other.decisions
+        return
+
+    def to_dict(self) -> dict:
+        return {
+            "decisions": self.decisions,
+            "actions": dict(self.actions),
+            "rules": {name: stats.to_dict() for name, stats in self.rules.items()},
+        }
+
+    @staticmethod
+    def from_dict(data: dict):
+        profiler = RuleProfiler()
+        profiler.decisions = data["decisions"]
+        profiler.actions.update(data["actions"])
+        for name, stats in data["rules"].items():
+            profiler.rules[name] = RuleStats.from_dict(stats)
+        return profiler
+
+    def dump(self, directory: str, player_name: str) -> str:
+        """Write the profile in `directory` and return the file path."""
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(
+            directory, f"{player_name}-{os.getpid()}-{time.time_ns()}.json"
+        )
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f)
+        return path
+
+    def report(self) -> str:
+        lines = [
+            f"{'rule':<24}{'calls':>8}{'matches':>9}{'rate':>7}"
+            f"{'total ms':>11}{'us/call':>9}{'p99 us':>9}"
+        ]
+        by_time = sorted(self.rules.items(), key=lambda r: -r[1].total_time)
+        for name, s in by_time:
+            lines.append(
+                f"{name:<24}{s.calls:>8}{s.matches:>9}{s.match_rate:>7.1%}"
+                f"{s.total_time * 1e3:>11.3f}{s.total_time / s.calls * 1e6:>9.1f}"
+                f"{s.percentile(0.99) * 1e6:>9.1f}"
+            )
+        actions = ", ".join(f"{a}: {n}" for a, n in self.actions.most_common())
+        lines.append(f"{self.decisions} decisions ({actions})")
+        return "\n".join(lines)
+
+
+def load_profiles(paths: list) -> RuleProfiler:
+    """Merge the profiles found in the given files and directories."""
+    total = RuleProfiler()
+    for path in paths:
+        if os.path.isdir(path):
+            files = [
+                os.path.join(path, f)
+                for f in sorted(os.listdir(path))
+                if f.endswith(".json")
+            ]
+        else:
+            files = [path]
+        for file in files:
+            with open(file) as f:
+                total.merge(RuleProfiler.from_dict(json.load(f)))
+    return total
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rule profiles of the agents")
+    commands = parser.add_subparsers(dest="command", required=True)
+    aggregate = commands.add_parser("aggregate", help="merge many profiles")
+    aggregate.add_argument("paths", nargs="+")
+    aggregate.add_argument("--json", action="store_true", help="print JSON")
+    args = parser.parse_args()
+
+    profiler = load_profiles(args.paths)
+    if args.json:
+        data = profiler.to_dict()
+        for stats in data["rules"].values():
+            del stats["samples"]
+        print(json.dumps(data, indent=2))
+    else:
+        print(profiler.report())
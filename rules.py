@@ -2,19 +2,72 @@ from abc import ABC, abstractmethod
 from logging.config import valid_ident
 from os import remove
 from game import Game
-from hanabi_model import HanabiState, HanabiAction, Hint, Play, Discard, UnknownCard
+from hanabi_model import (
+    DecisionContext,
+    HanabiState,
+    HanabiAction,
+    Hint,
+    HintIndex,
+    Play,
+    Discard,
+)
 from itertools import product
 import random
-import logging
+import numpy as np
+import endgame
+import tracing
 
 
 class Rule(ABC):
+    # Preconditions on the tokens, declared by each rule and checked
+    # before the rule is invoked (see rule_pipeline.RulePipeline).
+    NEEDS_NOTE_TOKEN = False  # True if the rule gives an hint
+    NEEDS_USED_NOTE_TOKEN = False  # True if the rule discards a card
+    MAX_USED_STORM_TOKENS = 2
+
+    @classmethod
+    def is_eligible(cls, used_note_tokens: int, used_storm_tokens: int) -> bool:
+        """Return True if the rule can fire with the given tokens."""
+        if cls.NEEDS_NOTE_TOKEN and used_note_tokens == 8:
+            return False
+        if cls.NEEDS_USED_NOTE_TOKEN and used_note_tokens == 0:
+            return False
+        return used_storm_tokens <= cls.MAX_USED_STORM_TOKENS
+
     @staticmethod
     @abstractmethod
-    def match(hanabi_state: HanabiState) -> HanabiAction:
+    def match(hanabi_state: HanabiState, ctx: DecisionContext) -> HanabiAction:
+        """Return the action suggested by the rule, or None if the rule
+        does not apply. Derived values must be read from `ctx`, which is
+        shared by all the rules evaluated in the same decision."""
         raise NotImplementedError
 
 
+class PlayEndgame(Rule):
+    """Once the deck is (almost) empty, search the action of the final
+    round that maximizes the score (see endgame.best_action)."""
+
+    MAX_DECK_SIZE = 1
+    TIME_BUDGET = 0.2  # seconds
+
+    def match(state: HanabiState, ctx: DecisionContext) -> HanabiAction:
+        if state.deck_size() > PlayEndgame.MAX_DECK_SIZE:
+            return None
+        action = endgame.best_action(state, PlayEndgame.TIME_BUDGET)
+        if action is None:
+            return None
+        kind, index = action
+        if tracing.ENABLED:
+            tracing.event("endgame", player=state.my_name, kind=kind, index=index)
+        if kind == endgame.PLAY:
+            return Play(state.my_name, index)
+        if kind == endgame.DISCARD:
+            return Discard(state.my_name, index)
+        return most_cards_hint(state, remove_clued=True) or most_cards_hint(
+            state, remove_clued=False
+        )
+
+
 class HintRandomCard(Rule):
     """A rule that just give an hint to an
     already not hinted card of the minimum
@@ -22,10 +75,10 @@ class HintRandomCard(Rule):
     (if there is at least an available NoteToken)
     """
 
+    NEEDS_NOTE_TOKEN = True
+
     @staticmethod
-    def match(hanabi_state: HanabiState) -> HanabiAction:
-        if hanabi_state.used_note_tokens == 8:
-            return None
+    def match(hanabi_state: HanabiState, ctx: DecisionContext) -> HanabiAction:
         _from = hanabi_state.me.name
 
         hint_type = Hint.HINT_TYPE_VAL
@@ -38,83 +91,86 @@ class HintRandomCard(Rule):
 
 
 class PlayRandomCard(Rule):
-    def match(hanabi_state: HanabiState) -> HanabiAction:
-        card_index = random.choice(range(hanabi_state.n_cards))
+    def match(hanabi_state: HanabiState, ctx: DecisionContext) -> HanabiAction:
+        card_index = random.choice(range(len(hanabi_state.inference.my_hand)))
         sender = hanabi_state.me.name
         return Play(sender, card_index)
 
 
 class DiscardRandomCard(Rule):
-    def match(state: HanabiState) -> HanabiAction:
-        if state.used_note_tokens == 0:
-            return None
-        card_index = random.choice(range(state.n_cards))
+    NEEDS_USED_NOTE_TOKEN = True
+
+    def match(state: HanabiState, ctx: DecisionContext) -> HanabiAction:
+        card_index = random.choice(range(len(state.inference.my_hand)))
         sender = state.me
         return Discard(sender, card_index)
 
 
 class PlaySafeCard(Rule):
-    def match(state: HanabiState) -> HanabiAction:
-        playable_cards = state.get_valid_playable_cards()
+    def match(state: HanabiState, ctx: DecisionContext) -> HanabiAction:
+        playable_cards = ctx.playable_cards
 
         for i, unknown_card in enumerate(state.inference.my_hand):
             # if the set of possible cards is contained in the set
             # valid playable cards => safe play
             if unknown_card.possible_cards <= playable_cards:
-                print(
-                    f"{state.my_name}: playable are {playable_cards}\n and \n\t{unknown_card.possible_cards} are all playable.\n"
-                )
+                if tracing.ENABLED:
+                    tracing.event(
+                        "safe_play",
+                        player=state.my_name,
+                        slot=i,
+                        possible_cards=frozenset(unknown_card.possible_cards),
+                    )
                 return Play(state.my_name, i)
 
 
 class DiscardUselessCard(Rule):
-    def match(state: HanabiState) -> HanabiAction:
-        if state.used_note_tokens == 0:
-            return None
+    NEEDS_USED_NOTE_TOKEN = True
 
-        future_playable_cards = state.get_future_playable_cards()
+    def match(state: HanabiState, ctx: DecisionContext) -> HanabiAction:
+        future_playable_cards = ctx.future_playable_cards
         for i, unknown_card in enumerate(state.inference.my_hand):
             # if the possible cards of the card
             # are not in the set of future playable cards
             if not unknown_card.possible_cards & future_playable_cards:
-                logging.debug(
-                    "discarding an unplayable card: {unknown_card.possible_cars}"
-                )
+                if tracing.ENABLED:
+                    tracing.event(
+                        "useless_discard",
+                        player=state.my_name,
+                        slot=i,
+                        possible_cards=frozenset(unknown_card.possible_cards),
+                    )
                 return Discard(state.my_name, i)
         pass
 
 
 class HintPlayableCard(Rule):
-    def match(state: HanabiState) -> HanabiAction:
-        if state.used_note_tokens == 8:
-            return None
+    NEEDS_NOTE_TOKEN = True
 
-        playable_cards = state.get_valid_playable_cards()
+    def match(state: HanabiState, ctx: DecisionContext) -> HanabiAction:
+        playable_cards = ctx.playable_cards
+        index = state.hint_index
         # order the player starting from the one following me
-        players = (
-            state.players_list[state.my_turn + 1 :]
-            + state.players_list[: state.my_turn]
-        )
+        players = ctx.relative_player_order()
 
         for player in players:
-            player_cards = set(player.hand)
+            clued_cards = state.get_clued_cards(player.name)
             # if there are some playable cards in player's hand...
-            hintable_cards = player_cards & playable_cards
-            print(f"hintable: by {state.my_name.upper()}:", hintable_cards, sep="\t")
-            for card in hintable_cards:
-                if card in state.get_clued_cards(player.name):
+            for card in index.hands[player.name]:
+                if card not in playable_cards or card in clued_cards:
                     continue
-                same_color_cards = UnknownCard.possible_cards_with_color(card.color)
-                same_value_cards = UnknownCard.possible_cards_with_number(card.value)
-                # and the player doesn't have other non-hintable
-                # cards with the same color...
-                if not (player_cards - hintable_cards) & same_color_cards:
+                if tracing.ENABLED:
+                    tracing.event(
+                        "hintable_card", player=state.my_name, to=player.name, card=card
+                    )
+                color_key, value_key = HintIndex.card_keys(card)
+                # and the color hint touches only playable cards...
+                if index.touched_cards(player.name, color_key) <= playable_cards:
                     return Hint(
                         state.my_name, player.name, Hint.HINT_TYPE_COL, card.color
                     )
-                # or if the player doesn't have other non-hintable
-                # cards with the same number...
-                if not (player_cards - hintable_cards) & same_value_cards:
+                # or the value hint touches only playable cards...
+                if index.touched_cards(player.name, value_key) <= playable_cards:
                     return Hint(
                         state.my_name, player.name, Hint.HINT_TYPE_VAL, card.value
                     )
@@ -122,16 +178,12 @@ class HintPlayableCard(Rule):
 
 
 class HintUsefulChop(Rule):
-    def match(state: HanabiState) -> HanabiAction:
-        if state.used_note_tokens == 8:
-            return None
+    NEEDS_NOTE_TOKEN = True
 
-        playable_cards = state.get_valid_playable_cards()
+    def match(state: HanabiState, ctx: DecisionContext) -> HanabiAction:
+        playable_cards = ctx.playable_cards
         # order the player starting from the one following me
-        players = (
-            state.players_list[state.my_turn + 1 :]
-            + state.players_list[: state.my_turn]
-        )
+        players = ctx.relative_player_order()
         for player in players:
             chop_card = player.hand[0]
             if chop_card.value == 2:  # twos are generally considered useful
@@ -144,147 +196,106 @@ class HintUsefulChop(Rule):
 
 
 class DiscardChop(Rule):
-    def match(state: HanabiState) -> HanabiAction:
-        if state.used_note_tokens == 0:
-            return None
+    NEEDS_USED_NOTE_TOKEN = True
 
+    def match(state: HanabiState, ctx: DecisionContext) -> HanabiAction:
         if state.inference.chop_index is not None:
             return Discard(state.my_name, state.inference.chop_index)
         return None
 
 
 class PlayAlmostSafeCard(Rule):
+    MAX_USED_STORM_TOKENS = 1
     PLAY_TRESHOLD = 0.6
 
-    def match(state: HanabiState) -> HanabiAction:
+    def match(state: HanabiState, ctx: DecisionContext) -> HanabiAction:
         """Play a card that has a probability of at least PLAY_THRESHOLD
         of being playable."""
-        if state.used_storm_tokens > 1:
-            return None
-        playable_cards = state.get_valid_playable_cards()
-
-        for i, unknown_card in enumerate(state.inference.my_hand):
-            # if the set of possible cards is contained in the set
-            # valid playable cards => safe play
-            p = len(playable_cards & unknown_card.possible_cards) / len(
-                unknown_card.possible_cards
+        playability = ctx.playability()
+        almost_safe = np.flatnonzero(playability > PlayAlmostSafeCard.PLAY_TRESHOLD)
+        if tracing.ENABLED:
+            tracing.event(
+                "playability", player=state.my_name, playability=playability.copy()
             )
-            if p > PlayAlmostSafeCard.PLAY_TRESHOLD:
-                logging.debug(msg=f"playing a card that is almost safe...")
-                return Play(state.my_name, i)
-            logging.debug(msg=f"card {i} is not enough safe: {p}")
+        if almost_safe.size:
+            return Play(state.my_name, int(almost_safe[0]))
 
 
 class PlayLessRiskyCard(Rule):
-    def match(state: HanabiState) -> HanabiAction:
-        card_risk = list()
-        playable_cards = state.get_valid_playable_cards()
-        for i, unknown_card in enumerate(state.inference.my_hand):
-            risk = len(playable_cards & unknown_card.possible_cards) / len(
-                unknown_card.possible_cards
+    def match(state: HanabiState, ctx: DecisionContext) -> HanabiAction:
+        playability = ctx.playability()
+        if tracing.ENABLED:
+            tracing.event(
+                "risky_play", player=state.my_name, playability=playability.copy()
             )
-            card_risk.append((i, risk))
-        print(card_risk)
-        best_card = max(card_risk, key=lambda c: c[1])[0]
+        best_card = int(np.argmax(playability))
         return Play(state.my_name, best_card)
 
 
+def most_cards_hint(state: HanabiState, remove_clued: bool) -> Hint:
+    """Return the hint touching the most cards (or the most unclued cards)
+    of a single player, looked up in the state HintIndex."""
+    best_hint = None
+    max_cards_addressed = 0
+    for player_name in state.hint_index.players:
+        key, num_cards_addressed = state.hint_index.best_hint(
+            player_name, remove_clued=remove_clued
+        )
+        if num_cards_addressed > max_cards_addressed:
+            hint_type, hint_value = HintIndex.hint_of(key)
+            best_hint = Hint(state.my_name, player_name, hint_type, hint_value)
+            max_cards_addressed = num_cards_addressed
+    if best_hint is not None and tracing.ENABLED:
+        tracing.event(
+            "best_hint",
+            player=state.my_name,
+            to=best_hint.to,
+            cards_addressed=max_cards_addressed,
+        )
+    return best_hint
+
+
 class HintMostUncluedCards(Rule):
-    def match(state: HanabiState) -> HanabiAction:
-        if state.used_note_tokens == 8:
-            return None
+    NEEDS_NOTE_TOKEN = True
 
-        state.get_relative_player_order()
-        best_hint = None
-        max_cards_addressed = 0
-        for player in state.players_list:
-            valid_hints = state.get_valid_hints(player.name, remove_clued=True)
-            #       most common element is the frirst----v  v---- second element of most common element
-            if not valid_hints:
-                continue
-            most_common_info = valid_hints.most_common(1)[0]  # so ugly I know
-            num_cards_addressed = most_common_info[1]
-            if num_cards_addressed > max_cards_addressed:
-                hint_type = (
-                    Hint.HINT_TYPE_COL
-                    if type(most_common_info[0]) is str
-                    else Hint.HINT_TYPE_VAL
-                )
-                hint_value = most_common_info[0]
-                best_hint = Hint(state.my_name, player.name, hint_type, hint_value)
-                max_cards_addressed = num_cards_addressed
-        if best_hint is not None:
-            logging.debug(
-                f"Best hint addresses {max_cards_addressed} of {best_hint.to}"
-            )
-        return best_hint
+    def match(state: HanabiState, ctx: DecisionContext) -> HanabiAction:
+        return most_cards_hint(state, remove_clued=True)
 
 
-class HintMostCards(Rule):  # so ugly I know
-    def match(state: HanabiState) -> HanabiAction:
-        if state.used_note_tokens == 8:
-            return None
+class HintMostCards(Rule):
+    NEEDS_NOTE_TOKEN = True
 
-        state.get_relative_player_order()
-        best_hint = None
-        max_cards_addressed = 0
-        for player in state.players_list:
-            valid_hints = state.get_valid_hints(player.name, remove_clued=False)
-            #       most common element is the frirst----v  v---- second element of most common element
-            if not valid_hints:
-                continue
-            most_common_info = valid_hints.most_common(1)[0]
-            num_cards_addressed = most_common_info[1]
-            if num_cards_addressed > max_cards_addressed:
-                hint_type = (
-                    Hint.HINT_TYPE_COL
-                    if type(most_common_info[0]) is str
-                    else Hint.HINT_TYPE_VAL
-                )
-                hint_value = most_common_info[0]
-                best_hint = Hint(state.my_name, player.name, hint_type, hint_value)
-                max_cards_addressed = num_cards_addressed
-        if best_hint is not None:
-            logging.debug(
-                f"Best hint addresses {max_cards_addressed} of {best_hint.to}"
-            )
-        return best_hint
+    def match(state: HanabiState, ctx: DecisionContext) -> HanabiAction:
+        return most_cards_hint(state, remove_clued=False)
 
 
 class HintUselessCard(Rule):
-    def match(state: HanabiState) -> HanabiAction:
-        if state.used_note_tokens == 8:
-            return None
-
-        still_useful_card = state.get_future_playable_cards()
-        for player in state.get_relative_player_order():
-            for card in player.hand:
-                if (
-                    not card in still_useful_card
-                    and not card in state.other_players_hints[player.name]
-                ):
-                    return Hint(
-                        state.my_name, player.name, Hint.HINT_TYPE_COL, card.color
-                    )
+    NEEDS_NOTE_TOKEN = True
+
+    def match(state: HanabiState, ctx: DecisionContext) -> HanabiAction:
+        still_useful_card = ctx.future_playable_cards
+        index = state.hint_index
+        for player in ctx.relative_player_order():
+            clued_cards = state.get_clued_cards(player.name)
+            for card in index.hands[player.name]:
+                if card in still_useful_card or card in clued_cards:
+                    continue
+                return Hint(state.my_name, player.name, Hint.HINT_TYPE_COL, card.color)
         return None
 
 
 class DiscardLessUsefulCard(Rule):
-    def match(state: HanabiState) -> Discard:
-        if state.used_note_tokens == 0:
-            return None
-
-        future_useful_cards = state.get_future_playable_cards()
-        cards_usefulness = list()
-        for i, unknown_card in enumerate(state.inference.my_hand):
-            usefulness = len(unknown_card.possible_cards & future_useful_cards) / len(
-                unknown_card.possible_cards
+    NEEDS_USED_NOTE_TOKEN = True
+
+    def match(state: HanabiState, ctx: DecisionContext) -> Discard:
+        usefulness = ctx.usefulness()
+
+        most_useless_card_index = int(np.argmin(usefulness))
+        if tracing.ENABLED:
+            tracing.event(
+                "less_useful_discard",
+                player=state.my_name,
+                slot=most_useless_card_index,
+                usefulness=usefulness[most_useless_card_index],
             )
-            cards_usefulness.append((i, usefulness))
-
-        most_useless_card_index = min(cards_usefulness, key=lambda c: c[1])[0]
-        useleness = min(cards_usefulness, key=lambda c: c[1])[1]
-        logging.debug(
-            f"most useless card is {most_useless_card_index} with uselesness of {useleness}"
-        )
         return Discard(state.my_name, most_useless_card_index)
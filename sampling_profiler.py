@@ -0,0 +1,92 @@
+"""Sampling profiler of all the threads of the process.
+
+A background thread samples the Python stack of every other thread every
+`interval` seconds (sys._current_frames), so the profiled threads run
+unmodified and the overhead only depends on the sampling rate. Frames are
+named file:function, e.g. game.py:__satisfyHintRequest,
+GameData.py:serialize or logging/__init__.py:info, and the frames of the
+threading module are left out. The samples are written as collapsed
+stacks, one "frame;frame;...;frame count" line per distinct stack, the
+input of flamegraph.pl and speedscope.
+
+Samples are wall clock: a thread waiting on a socket or a lock is sampled
+too, its stack ending in the function that waits (e.g. receiveFrame)."""
+import sys
+import threading
+from collections import Counter
+from time import perf_counter, sleep
+
+
+class SamplingProfiler:
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = Counter()  # tuple of frame names: samples
+        self.samples = 0
+        self.sampling_time = 0.0  # spent by the sampler itself
+        self.names = dict()  # code object: frame name
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self.thread.start()
+        return
+
+    def stop(self) -> Counter:
+        """Stop sampling and return the stacks."""
+        self.running = False
+        self.thread.join()
+        return self.stacks
+
+    def _name(self, code) -> str:
+        name = self.names.get(code)
+        if name is None:
+            parts = code.co_filename.rsplit("/", 2)
+            filename = "/".join(parts[-2:]) if parts[-1] == "__init__.py" else parts[-1]
+            name = f"{filename}:{code.co_name}"
+            self.names[code] = name
+        return name
+
+    def sample(self):
+        """Add the current stack of every other thread."""
+        me = threading.get_ident()
+        skipped = threading.__file__
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                if code.co_filename != skipped:
+                    stack.append(self._name(code))
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
+        self.samples += 1
+        return
+
+    def _run(self):
+        while self.running:
+            start = perf_counter()
+            self.sample()
+            elapsed = perf_counter() - start
+            self.sampling_time += elapsed
+            sleep(max(0.0, self.interval - elapsed))
+
+    def write_collapsed(self, path: str) -> int:
+        """Write the collapsed stacks and return the number of lines."""
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(";".join(stack) + f" {count}\n")
+        return len(self.stacks)
+
+    def top(self, n=10, prefixes=("",)) -> list:
+        """Return the n frames starting with one of the prefixes found in
+        most samples, with their counts."""
+        inclusive = Counter()
+        for stack, count in self.stacks.items():
+            for name in set(stack):
+                if name.startswith(prefixes):
+                    inclusive[name] += count
+        return inclusive.most_common(n)
@@ -1,13 +1,24 @@
+import argparse
 import os
 import GameData
 import socket
 from game import Game
 from game import Player
+from hanabi_model import request_from_action
+from local_game import LocalSeat
+from rule_pipeline import RulePipeline
 import threading
 from constants import *
 from signal import signal, SIGPIPE, SIG_DFL
 import logging
+import struct
 import sys
+from collections import deque
+from time import perf_counter
+from timer_wheel import TimerWheel
+import snapshot
+from admission import AdmissionStats, TokenBucket
+from sampling_profiler import SamplingProfiler
 
 mutex = threading.Lock()
 # SERVER
@@ -27,111 +38,743 @@ status = statuses[0]
 commandQueue = {}
 numPlayers = 2
 
+# SPECTATORS
+# Spectators are served by a separate, low priority thread: the players are
+# sent their data first, then the same bytes are queued for the spectators,
+# so that a slow spectator never delays the game.
+SPECTATOR_BACKLOG = 1024  # queued events before a spectator is dropped
+SPECTATOR_SEND_TIMEOUT = 1.0  # seconds
+SPECTATOR_NICENESS = 10
+# a spectator closing its socket must not kill the server (SIGPIPE)
+SEND_FLAGS = getattr(socket, "MSG_NOSIGNAL", 0)
 
-def manageConnection(conn: socket, addr):
-    global status
+spectators = {}
+spectatorCondition = threading.Condition()
+
+
+class Spectator(object):
+    def __init__(self, conn: socket, fullInformation: bool) -> None:
+        self.conn = conn
+        self.fullInformation = fullInformation
+        self.backlog = deque()  # serialized events to send
+
+
+def publishToSpectators(payload: bytes, fullInformationOnly=False):
+    """Queue the serialized event for the spectators, without waiting for the network."""
+    with spectatorCondition:
+        for name, spectator in list(spectators.items()):
+            if fullInformationOnly and not spectator.fullInformation:
+                continue
+            if len(spectator.backlog) >= SPECTATOR_BACKLOG:
+                logging.warning("Spectator too slow, disconnected: " + name)
+                dropSpectator(name, spectator)
+                continue
+            spectator.backlog.append(payload)
+        spectatorCondition.notify()
+
+
+def publishGameState():
+    """Queue the state of the game for the full information spectators, serialized once for all of them."""
+    with spectatorCondition:
+        if not any(s.fullInformation for s in spectators.values()):
+            return
+    publishToSpectators(game.getSpectatorState(True).serialize(), fullInformationOnly=True)
+
+
+def broadcast(data: GameData.ServerToClientData):
+    """Send the data to every player and server bot, then queue the same bytes for the spectators.
+    A multiplexed session receives a single frame for all its seats."""
+    payload = data.serialize()
+    sessions = set()
+    for id in playerConnections:
+        seat = playerConnections[id]
+        if seat.seat is None:
+            seat.conn.send(payload)
+        elif seat.conn not in sessions:
+            sessions.add(seat.conn)
+    if sessions:
+        frame = GameData.SeatFrame.wrap(None, payload).serialize()
+        for conn in sessions:
+            conn.send(frame)
+    if type(data) in BOT_OBSERVED and not game.isGameOver():
+        for bot in botSeats.values():
+            bot.observe(data)
+    publishToSpectators(payload)
+
+
+def dropSpectator(name: str, spectator: Spectator):
+    """Forget the spectator and wake up its connection thread. Call with spectatorCondition held."""
+    if spectators.get(name) is spectator:
+        del spectators[name]
+    try:
+        spectator.conn.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+def addSpectator(conn: socket, data: GameData.ClientSpectatorAddData) -> bool:
+    """Register the spectator and queue its first events. Call with the game mutex held."""
+    name = data.sender
+    with spectatorCondition:
+        if not name or name in spectators or name in playerConnections:
+            logging.warning("Duplicate spectator: " + str(name))
+            conn.send(GameData.ServerActionInvalid(
+                "Player or spectator with that name already registered.").serialize())
+            return False
+        conn.settimeout(SPECTATOR_SEND_TIMEOUT)
+        spectator = Spectator(conn, data.fullInformation)
+        spectator.backlog.append(GameData.ServerSpectatorConnectionOk(name).serialize())
+        if game.hasStarted():
+            spectator.backlog.append(GameData.ServerStartGameData(
+                [p.name for p in game.getPlayers()]).serialize())
+            spectator.backlog.append(game.getSpectatorState(data.fullInformation).serialize())
+        spectators[name] = spectator
+        spectatorCondition.notify()
+    logging.info("Spectator connected: " + name)
+    return True
+
+
+def watchSpectator(conn: socket, name: str):
+    """Wait for the spectator to disconnect: spectators do not send requests."""
+    while True:
+        try:
+            data = conn.recv(DATASIZE)
+        except TimeoutError:
+            continue
+        except OSError:
+            data = None
+        if not data:
+            break
+    with spectatorCondition:
+        spectator = spectators.get(name)
+        if spectator is not None and spectator.conn is conn:
+            del spectators[name]
+    logging.info("Spectator disconnected: " + name)
+
+
+def manageSpectators():
+    """Send the queued events to the spectators, at a lower priority than the players' threads."""
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), SPECTATOR_NICENESS)
+    except (AttributeError, OSError):
+        pass
+    while True:
+        with spectatorCondition:
+            while not any(s.backlog for s in spectators.values()):
+                spectatorCondition.wait()
+            batch = []
+            for name, spectator in spectators.items():
+                if spectator.backlog:
+                    batch.append((name, spectator, list(spectator.backlog)))
+                    spectator.backlog.clear()
+        for name, spectator, payloads in batch:
+            try:
+                for payload in payloads:
+                    spectator.conn.sendall(payload, SEND_FLAGS)
+            except OSError:
+                logging.warning("Spectator unreachable, disconnected: " + name)
+                with spectatorCondition:
+                    dropSpectator(name, spectator)
+
+
+# TURN DEADLINES
+# The current player of every table has turnTimeout seconds to act, after
+# which the server plays the default action for it ("default": discard
+# the oldest card, or hint the next player if no discard is allowed) or
+# the player forfeits the game ("forfeit"). The deadlines of all the tables
+# are kept in a single timing wheel. The request a player sends after the
+# server acted for it arrives out of turn: it is dropped without answer,
+# so that the client loses its turn instead of receiving an error.
+TIMEOUT_ACTIONS = ["default", "forfeit"]
+turnTimeout = None  # seconds, None for no deadline
+timeoutAction = TIMEOUT_ACTIONS[0]
+timerWheel = TimerWheel()
+turnTimer = None
+turnNumber = 0
+turnPlayer = None
+turnStart = 0.0
+seatTimings = {}
+lateSeats = set()  # players the server acted for, whose uncounted request is late
+
+
+class SeatTiming(object):
+    '''
+    Response times of a seat: the think time is the response time of the
+    player minus the round trip time of its connection (the network latency).
+    '''
+    def __init__(self) -> None:
+        self.turns = 0
+        self.thinkTime = 0.0
+        self.maxThinkTime = 0.0
+        self.latency = 0.0
+        self.timeouts = 0
+
+    def add(self, responseTime: float, roundTripTime: float):
+        thinkTime = max(0.0, responseTime - roundTripTime)
+        self.turns += 1
+        self.thinkTime += thinkTime
+        self.maxThinkTime = max(self.maxThinkTime, thinkTime)
+        self.latency += roundTripTime
+
+    def toString(self):
+        turns = max(1, self.turns)
+        return ("turns: " + str(self.turns) +
+                "; think time: mean " + f"{1000 * self.thinkTime / turns:.2f}" +
+                " ms, max " + f"{1000 * self.maxThinkTime:.2f}" +
+                " ms; latency: mean " + f"{1000 * self.latency / turns:.3f}" +
+                " ms; timeouts: " + str(self.timeouts))
+
+
+def roundTripTime(conn: socket) -> float:
+    """Minimum round trip time of the connection measured by the kernel, in seconds (0 if unknown).
+    The smoothed round trip time would include the delayed acknowledgements of the client."""
+    try:
+        info = conn.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 152)
+        return struct.unpack_from("I", info, 148)[0] / 1e6  # tcp_info.tcpi_min_rtt, in us
+    except (AttributeError, OSError, struct.error):
+        return 0.0
+
+
+def startTurn():
+    """Start the clock of the current player. Call with the game mutex held."""
+    global turnTimer, turnNumber, turnPlayer, turnStart
+    if turnTimer is not None:
+        timerWheel.cancel(turnTimer)
+        turnTimer = None
+    turnNumber += 1
+    turnPlayer = game.getCurrentPlayerName()
+    turnStart = perf_counter()
+    if turnTimeout is not None:
+        turnTimer = timerWheel.schedule(turnTimeout, onTurnTimeout, turnNumber)
+
+
+def endTurn(playerName: str, seat):
+    """Record the response time of the player that has just acted (seat None for the server bots)."""
+    if playerName == turnPlayer:
+        timing = seatTimings.setdefault(playerName, SeatTiming())
+        timing.add(perf_counter() - turnStart, 0.0 if seat is None else roundTripTime(seat.conn))
+
+
+def defaultRequest(playerName: str) -> GameData.ClientToServerData:
+    if game.getNoteTokens() > 0:
+        request = GameData.ClientPlayerDiscardCardRequest(playerName, 0)
+    else:
+        players = game.getPlayers()
+        names = [p.name for p in players]
+        nextPlayer = players[(names.index(playerName) + 1) % len(players)]
+        request = GameData.ClientHintData(playerName, nextPlayer.name, "value", nextPlayer.hand[0].value)
+    # counted, so that it is never taken for the late request of the player
+    request.actions = game.getActions()
+    return request
+
+
+def onTurnTimeout(number: int):
+    """Called by the timer wheel when the current player runs out of time."""
+    mutex.acquire(True)
+    try:
+        if number != turnNumber or status != "Game" or game.isGameOver():
+            return
+        playerName = turnPlayer
+        seatTimings.setdefault(playerName, SeatTiming()).timeouts += 1
+        logging.warning("Turn timeout: " + playerName + ", " + timeoutAction + " action")
+        if timeoutAction == "forfeit":
+            broadcast(GameData.ServerGameOver(0, playerName + " forfeited the game"))
+            restartGame()
+            publishGameState()
+            startTurn()
+            playBotTurns()
+        else:
+            seat = playerConnections.get(playerName)
+            if playTurn(defaultRequest(playerName), playerName, seat, timed=False):
+                lateSeats.add(playerName)
+    finally:
+        mutex.release()
+
+
+def logSeatTimings():
+    for name, timing in seatTimings.items():
+        logging.info("Seat " + name + ": " + timing.toString())
+
+
+def restartGame():
+    """Start a new game between the same players. Call with the game mutex held."""
     global game
+    lateSeats.clear()
+    logging.info("Game over")
+    logging.info("Game score: " + str(game.getScore()))
+    logSeatTimings()
+    players = game.getPlayers()
+    game = Game()
+    for player in players:
+        logging.info("Starting new game")
+        game.addPlayer(player.name)
+    game.start()
+    createBotSeats()
+    # the players go on without a start message
+    publishToSpectators(GameData.ServerStartGameData(
+        [p.name for p in players]).serialize())
+
+
+def isLateRequest(data: GameData.ClientToServerData, playerName: str) -> bool:
+    """Return True if the request is the action of a player the server
+    has already acted for. Call with the game mutex held."""
+    if type(data) is GameData.ClientGetGameStateRequest:
+        return False
+    actions = getattr(data, "actions", None)  # unset by older clients
+    if actions is not None:
+        # the player decided before the latest action of the game
+        lateSeats.discard(playerName)
+        return actions != game.getActions()
+    if playerName not in lateSeats:
+        return False
+    # without the count, the first request after the timeout is the late one
+    lateSeats.discard(playerName)
+    return True
+
+
+def applyRequest(data: GameData.ClientToServerData, playerName: str, seat, timed=True) -> bool:
+    """Satisfy the request of a player in game and send the outcome.
+    Return True if the player has acted. Call with the game mutex held."""
+    if isLateRequest(data, playerName):
+        logging.warning("Late request of " + playerName + " dropped")
+        return False
+    singleData, multipleData = game.satisfyRequest(data, playerName)
+    if singleData is not None and seat is not None:
+        seat.send(singleData)
+    if multipleData is None:
+        return False
+    if timed:
+        endTurn(playerName, seat)
+    broadcast(multipleData)
+    if game.isGameOver():
+        restartGame()
+    publishGameState()
+    startTurn()
+    return True
+
+
+def playTurn(data: GameData.ClientToServerData, playerName: str, seat, timed=True) -> bool:
+    """Satisfy the request of a player in game, then play the turns of the server bots that follow.
+    Return True if the player has acted."""
+    if applyRequest(data, playerName, seat, timed):
+        playBotTurns()
+        return True
+    return False
+
+
+# SERVER BOTS
+# With fillDelay set, the lobby is completed with bots fillDelay seconds
+# after the first player connects, so that a table starts without waiting
+# for numPlayers remote players. The bots play in the server process: they
+# act on the game directly, and observe the actions without serialization.
+BOT_NAME = "server_bot_"
+BOT_OBSERVED = (GameData.ServerHintData, GameData.ServerActionValid,
+                GameData.ServerPlayerMoveOk, GameData.ServerPlayerThunderStrike)
+fillDelay = None  # seconds, None for no bots
+fillTimer = None
+botNames = []
+botSeats = {}  # name: LocalSeat, for the current game
+botPolicy = RulePipeline()
+
+
+def createBotSeats():
+    """Seat the bots at the current game, once it has started. Call with the game mutex held."""
+    botSeats.clear()
+    public = None
+    for name in botNames:
+        seat = LocalSeat(name, game, botPolicy, public)
+        public = seat.hanabi_state.public
+        botSeats[name] = seat
+
+
+def fillWithBots():
+    """Called by the timer wheel: complete the lobby with bots."""
+    with mutex:
+        if status != "Lobby" or game.hasStarted():
+            return
+        i = 0
+        while len(game.getPlayers()) < numPlayers:
+            name = BOT_NAME + str(i)
+            i += 1
+            if name in playerConnections or name in botNames:
+                continue
+            botNames.append(name)
+            game.addPlayer(name)
+            game.setPlayerReady(name)
+            logging.info("Bot connected: " + name)
+        startIfReady()
+
+
+def playBotTurns():
+    """Play the turns of the server bots until a remote player has to act. Call with the game mutex held."""
+    while status == "Game" and game.getCurrentPlayerName() in botSeats:
+        name = game.getCurrentPlayerName()
+        action = botSeats[name].decide()
+        if not applyRequest(request_from_action(action, name, game.getActions()), name, None):
+            logging.error("Invalid action of " + name + ": " + str(action))
+            return
+
+
+def startIfReady():
+    """Start the game if every player in the lobby is ready. Call with the game mutex held."""
+    if len(game.getPlayers()) == game.getNumReadyPlayers() and len(game.getPlayers()) >= numPlayers:
+        listNames = []
+        for player in game.getPlayers():
+            listNames.append(player.name)
+        logging.info(
+            "Game start! Between: " + str(listNames))
+        broadcast(GameData.ServerStartGameData(listNames))
+        game.start()
+        createBotSeats()
+        # the bots do not need to confirm the start
+        playersOk.extend([1] * len(botSeats))
+        publishGameState()
+
+
+# SNAPSHOTS
+# With snapshotPath set, the table in game is saved every snapshotInterval
+# seconds by a forked process (see snapshot.fork_dump), and at exit. On
+# startup the table is restored from the file, and the remote players
+# reclaim their seats by connecting again with the same names. The server
+# bots get back their own state, with what they learned from the hints.
+snapshotPath = None
+snapshotInterval = 5.0
+snapshotChild = None  # pid of the process writing the last snapshot
+reservedSeats = set()  # players of the restored game not connected yet
+
+
+def tableSnapshot() -> dict:
+    """The table: the game, the seats, the state of the bots and the turn. Call with the game mutex held."""
+    return {
+        "game": game,
+        "status": status,
+        "players": [p.name for p in game.getPlayers() if p.name not in botSeats],
+        "bots": list(botNames),
+        # pickled together: the bots keep sharing their public knowledge
+        "botStates": {name: seat.hanabi_state for name, seat in botSeats.items()},
+        "turnNumber": turnNumber,
+        "seatTimings": {name: vars(timing) for name, timing in seatTimings.items()},
+    }
+
+
+def takeSnapshot():
+    """Called by the timer wheel: save the table from a forked process, unless the last one is still being written."""
+    global snapshotChild
+    timerWheel.schedule(snapshotInterval, takeSnapshot)
+    if snapshotChild is not None:
+        if snapshot.reap(snapshotChild) is None:
+            return
+        snapshotChild = None
+    with mutex:
+        if status != "Game":
+            return
+        start = perf_counter()
+        snapshotChild = snapshot.fork_dump([tableSnapshot()], snapshotPath)
+        pause = perf_counter() - start
+    logging.debug(f"Snapshot forked, play paused {1000 * pause:.2f} ms")
+
+
+def restoreSnapshot():
+    """Restore the table saved in snapshotPath, before accepting connections."""
+    global game, status, turnNumber
+    table = snapshot.load(snapshotPath)[0]
+    game = table["game"]
+    status = table["status"]
+    botNames[:] = table["bots"]
+    playersOk[:] = [1] * len(game.getPlayers())
+    reservedSeats.update(table["players"])
+    turnNumber = table["turnNumber"]
+    for name, timing in table["seatTimings"].items():
+        seatTimings.setdefault(name, SeatTiming()).__dict__.update(timing)
+    createBotSeats()
+    for name, state in table["botStates"].items():
+        botSeats[name].hanabi_state = state
+    logging.info("Game restored, waiting for: " + str(sorted(reservedSeats)))
+    startTurn()
+    playBotTurns()
+
+
+def reclaimSeat(playerName: str, seat) -> str:
+    """Give back the seat of a restored game to the player connecting with its name. Call with the game mutex held."""
+    if playerName not in reservedSeats:
+        logging.warning("No seat to reclaim: " + str(playerName))
+        seat.send(GameData.ServerActionInvalid("The game is in progress."))
+        return None
+    reservedSeats.discard(playerName)
+    playerConnections[playerName] = seat
+    logging.info("Seat reclaimed: " + playerName)
+    seat.send(GameData.ServerPlayerConnectionOk(playerName))
+    if playerName == turnPlayer:
+        startTurn()  # the time spent disconnected is not its think time
+    return playerName
+
+
+# ADMISSION
+# A connection storm (e.g. a bot fleet restarting) waits in the accept
+# backlog. At most maxHandshakes connections are served before their first
+# request is answered, and new players join at the rate of joinBucket if
+# set. The others are turned away at once with ServerActionInvalid,
+# without waiting for the game mutex.
+OVERLOADED = "Server overloaded, retry later."
+REJECT_LINGER = 1.0  # seconds before closing a connection turned away
+acceptBacklog = 1024  # capped by net.core.somaxconn
+maxHandshakes = 64
+handshakeSlots = threading.BoundedSemaphore(maxHandshakes)
+joinBucket = None  # TokenBucket, None for no rate limit
+admissionStats = AdmissionStats()
+
+
+def admitPlayer() -> bool:
+    """Take a token of the join rate limit, if any."""
+    if joinBucket is None or joinBucket.try_take():
+        return True
+    admissionStats.throttled += 1
+    return False
+
+
+def endHandshake(acceptTime: float):
+    """The first request of the connection has been answered: free its handshake slot."""
+    admissionStats.add_handshake(perf_counter() - acceptTime)
+    handshakeSlots.release()
+
+
+def rejectConnection(conn: socket):
+    """Turn the connection away without reading it. It is closed later, so that
+    the client reads the answer instead of a connection reset."""
+    admissionStats.busy += 1
+    try:
+        conn.setblocking(False)
+        conn.send(GameData.ServerActionInvalid(OVERLOADED).serialize(), SEND_FLAGS)
+        conn.shutdown(socket.SHUT_WR)
+    except OSError:
+        conn.close()
+        return
+    timerWheel.schedule(REJECT_LINGER, conn.close)
+
+
+# PROFILER
+# "profile start [ms]" samples the stacks of every thread of the server
+# (connections, sessions, spectators, timers) every ms milliseconds, and
+# "profile stop <file>" writes them as collapsed stacks for a flamegraph.
+# The handlers show up by name, e.g. game.py:__satisfyHintRequest, and the
+# pickling of the data as GameData.py:serialize and GameData.py:deserialize.
+PROFILE_INTERVAL = 5  # milliseconds
+PROFILE_HANDLERS = ("game.py:__satisfy", "GameData.py:serialize", "GameData.py:deserialize")
+profiler = None
+
+
+def manageProfiler(args: list):
+    """Run the console command "profile <args>"."""
+    global profiler
+    if len(args) >= 1 and args[0] == "start":
+        if profiler is not None:
+            logging.warning("The profiler is already running")
+            return
+        interval = float(args[1]) if len(args) > 1 else PROFILE_INTERVAL
+        profiler = SamplingProfiler(interval / 1000)
+        profiler.start()
+        logging.info(f"Profiler started, one sample every {interval} ms")
+    elif len(args) == 2 and args[0] == "stop":
+        if profiler is None:
+            logging.warning("The profiler is not running")
+            return
+        profiler.stop()
+        stacks = profiler.write_collapsed(args[1])
+        mean = 1000 * profiler.sampling_time / profiler.samples if profiler.samples else 0.0
+        logging.info(f"Profiler stopped: {profiler.samples} samples, {stacks} stacks written to {args[1]}, "
+                     f"{mean:.3f} ms per sample")
+        for name, count in profiler.top(prefixes=PROFILE_HANDLERS):
+            logging.info(f"    {name}: {count}")
+        profiler = None
+    else:
+        logging.warning("Usage: profile start [ms] | profile stop <file>")
+    return
+
+
+class Seat(object):
+    '''
+    Where the data for a player is sent: its own connection (seat None),
+    or a seat of a multiplexed session (see GameData.SeatFrame).
+    '''
+    def __init__(self, conn: socket, addr, seat=None) -> None:
+        self.conn = conn
+        self.addr = addr
+        self.seat = seat
+
+    def send(self, data: GameData.ServerToClientData):
+        if self.seat is None:
+            self.conn.send(data.serialize())
+        else:
+            self.conn.send(GameData.SeatFrame.wrap(self.seat, data.serialize()).serialize())
+
+
+def receiveFrame(conn: socket) -> bytes:
+    """Read a whole frame from the connection, empty bytes if it is closed."""
+    data = conn.recv(DATASIZE)
+    while data and len(data) < DATASIZE:
+        chunk = conn.recv(DATASIZE - len(data))
+        if not chunk:
+            return b""
+        data += chunk
+    return data
+
+
+def disconnectPlayer(playerName: str):
+    """Remove the player from the game. Call with the game mutex held."""
+    if playerConnections.pop(playerName, None) is None:
+        return
+    logging.warning("Player disconnected: " + playerName)
+    game.removePlayer(playerName)
+    if len(playerConnections) == 0:
+        logging.info("Shutting down server")
+        os._exit(0)
+
+
+def satisfyClient(data: GameData.ClientToServerData, playerName: str, seat: Seat) -> str:
+    """Satisfy the request of the player of the seat, and return the name of the player
+    (set by the connection request), or None if the seat must be closed. Call with the game mutex held."""
+    global status, fillTimer
+    if status == "Lobby":
+        if type(data) is GameData.ClientPlayerAddData:
+            playerName = data.sender
+            if playerName in playerConnections.keys() or playerName == "" or playerName is None:
+                logging.warning("Duplicate player: " + str(playerName))
+                seat.send(GameData.ServerActionInvalid(
+                    "Player with that name already registered."))
+                return None
+            commandQueue[playerName] = []
+            playerConnections[playerName] = seat
+            logging.info("Player connected: " + playerName)
+            if fillDelay is not None and fillTimer is None:
+                fillTimer = timerWheel.schedule(fillDelay, fillWithBots)
+            game.addPlayer(playerName)
+            seat.send(GameData.ServerPlayerConnectionOk(playerName))
+        elif type(data) is GameData.ClientPlayerStartRequest:
+            game.setPlayerReady(playerName)
+            logging.info("Player ready: " + playerName)
+            seat.send(GameData.ServerPlayerStartRequestAccepted(
+                len(game.getPlayers()), game.getNumReadyPlayers()))
+            startIfReady()
+
+        # This ensures every player is ready to send requests
+        elif type(data) is GameData.ClientPlayerReadyData:
+            playersOk.append(1)
+        # If every player is ready to send requests, then the game can start
+        if len(playersOk) == len(game.getPlayers()):
+            status = "Game"
+            for player in commandQueue:
+                for cmd in commandQueue[player]:
+                    singleData, multipleData = game.satisfyRequest(
+                        cmd, player)
+                    if singleData is not None:
+                        playerConnections[player].send(singleData)
+                    if multipleData is not None:
+                        broadcast(multipleData)
+                        if game.isGameOver():
+                            os._exit(0)
+                        publishGameState()
+            commandQueue.clear()
+            startTurn()
+            playBotTurns()
+        elif type(data) is not GameData.ClientPlayerAddData and type(
+                data) is not GameData.ClientPlayerStartRequest and type(
+                data) is not GameData.ClientPlayerReadyData:
+            commandQueue[playerName].append(data)
+    # In game
+    elif status == "Game":
+        # the players of a restored game join it as if it was starting
+        if type(data) is GameData.ClientPlayerAddData and playerName == "":
+            playerName = reclaimSeat(data.sender, seat)
+        elif type(data) is GameData.ClientPlayerStartRequest:
+            players = game.getPlayers()
+            seat.send(GameData.ServerPlayerStartRequestAccepted(len(players), len(players)))
+            seat.send(GameData.ServerStartGameData([p.name for p in players]))
+        elif type(data) is not GameData.ClientPlayerReadyData:
+            playTurn(data, playerName, seat)
+    return playerName
+
+
+def manageConnection(conn: socket, addr, acceptTime: float):
     with conn:
         logging.info("Connected by: " + str(addr))
-        keepActive = True
+        seat = Seat(conn, addr)
         playerName = ""
-        while keepActive:
-            print("SERVER WAITING")
-            data = conn.recv(DATASIZE)
+        handshaking = True
+        try:
+            while playerName is not None:
+                logging.debug("SERVER WAITING")
+                data = receiveFrame(conn)
+                if data:
+                    data = GameData.GameData.deserialize(data)
+                    logging.debug("SERVER RECEIVED %s from %s", type(data), data.sender)
+                    if type(data) is GameData.ClientPlayerAddData and playerName == "" and not admitPlayer():
+                        seat.send(GameData.ServerActionInvalid(OVERLOADED))
+                        return
+
+                mutex.acquire(True)
+
+                if not data:
+                    disconnectPlayer(playerName)
+                    playerName = None
+                else:
+                    if type(data) is GameData.ClientSpectatorAddData and playerName == "":
+                        added = addSpectator(conn, data)
+                        mutex.release()
+                        handshaking = False
+                        endHandshake(acceptTime)
+                        if added:
+                            watchSpectator(conn, data.sender)
+                        return
+                    if type(data) is GameData.SeatFrame and playerName == "":
+                        mutex.release()
+                        handshaking = False
+                        endHandshake(acceptTime)
+                        manageSession(conn, addr, data)
+                        return
+                    playerName = satisfyClient(data, playerName, seat)
+                mutex.release()
+                if handshaking:
+                    handshaking = False
+                    endHandshake(acceptTime)
+        finally:
+            if handshaking:
+                handshakeSlots.release()
 
-            mutex.acquire(True)
 
-            if not data:
-                del playerConnections[playerName]
-                logging.warning("Player disconnected: " + playerName)
-                game.removePlayer(playerName)
-                if len(playerConnections) == 0:
-                    logging.info("Shutting down server")
-                    os._exit(0)
-                keepActive = False
+def manageSession(conn: socket, addr, frame: GameData.SeatFrame):
+    """Serve the seats multiplexed over the connection: one thread for all of them."""
+    logging.info("Session opened by: " + str(addr))
+    seats = {}  # seat id: (Seat, player name), only used by this thread
+    while frame is not None:
+        if type(frame) is not GameData.SeatFrame:
+            logging.warning("Not a seat frame in session: " + str(addr))
+            break
+        # decoded and admitted before taking the game mutex
+        seat, playerName = seats.get(frame.seat, (None, ""))
+        data = None if frame.payload is None else frame.unwrap()
+        rejected = type(data) is GameData.ClientPlayerAddData and playerName == "" and not admitPlayer()
+        # the connection is shared with the broadcasts: send under the mutex
+        with mutex:
+            if rejected:
+                Seat(conn, addr, frame.seat).send(GameData.ServerActionInvalid(OVERLOADED))
+            elif frame.payload is None:
+                seats.pop(frame.seat, None)
+                disconnectPlayer(playerName)
             else:
-                print(
-                    f"SERVER PROCESSING {GameData.GameData.deserialize(data)}")
-                data = GameData.GameData.deserialize(data)
-                print(f"SERVER RECEIVED {type(data)} from {data.sender}")
-                if status == "Lobby":
-                    if type(data) is GameData.ClientPlayerAddData:
-                        playerName = data.sender
-                        commandQueue[playerName] = []
-                        if playerName in playerConnections.keys() or playerName == "" and playerName is None:
-                            logging.warning("Duplicate player: " + playerName)
-                            conn.send(GameData.ServerActionInvalid(
-                                "Player with that name already registered.").serialize())
-                            mutex.release()
-                            return
-                        playerConnections[playerName] = (conn, addr)
-                        logging.info("Player connected: " + playerName)
-                        game.addPlayer(playerName)
-                        conn.send(GameData.ServerPlayerConnectionOk(
-                            playerName).serialize())
-                    elif type(data) is GameData.ClientPlayerStartRequest:
-                        game.setPlayerReady(playerName)
-                        logging.info("Player ready: " + playerName)
-                        conn.send(GameData.ServerPlayerStartRequestAccepted(
-                            len(game.getPlayers()), game.getNumReadyPlayers()).serialize())
-
-                        if len(game.getPlayers()) == game.getNumReadyPlayers() and len(game.getPlayers()) >= numPlayers:
-                            listNames = []
-                            for player in game.getPlayers():
-                                listNames.append(player.name)
-                            logging.info(
-                                "Game start! Between: " + str(listNames))
-                            for player in playerConnections:
-                                playerConnections[player][0].send(
-                                    GameData.ServerStartGameData(listNames).serialize())
-                            game.start()
-
-                    # This ensures every player is ready to send requests
-                    elif type(data) is GameData.ClientPlayerReadyData:
-                        playersOk.append(1)
-                    # If every player is ready to send requests, then the game can start
-                    if len(playersOk) == len(game.getPlayers()):
-                        status = "Game"
-                        for player in commandQueue:
-                            for cmd in commandQueue[player]:
-                                singleData, multipleData = game.satisfyRequest(
-                                    cmd, player)
-                                if singleData is not None:
-                                    playerConnections[player][0].send(
-                                        singleData.serialize())
-                                if multipleData is not None:
-                                    for id in playerConnections:
-                                        playerConnections[id][0].send(
-                                            multipleData.serialize())
-                                        if game.isGameOver():
-                                            os._exit(0)
-                        commandQueue.clear()
-                    elif type(data) is not GameData.ClientPlayerAddData and type(
-                            data) is not GameData.ClientPlayerStartRequest and type(
-                            data) is not GameData.ClientPlayerReadyData:
-                        commandQueue[playerName].append(data)
-                # In game
-                elif status == "Game":
-                    singleData, multipleData = game.satisfyRequest(
-                        data, playerName)
-                    if singleData is not None:
-                        conn.send(singleData.serialize())
-                    if multipleData is not None:
-                        for id in playerConnections:
-                            playerConnections[id][0].send(
-                                multipleData.serialize())
-                            if game.isGameOver():
-                                logging.info("Game over")
-                                logging.info("Game score: " +
-                                             str(game.getScore()))
-                                # os._exit(0)
-                                players = game.getPlayers()
-                                game = Game()
-                                for player in players:
-                                    logging.info("Starting new game")
-                                    game.addPlayer(player.name)
-                                game.start()
-            mutex.release()
+                if seat is None:
+                    seat = Seat(conn, addr, frame.seat)
+                logging.debug("SERVER RECEIVED %s from %s on seat %s", type(data), data.sender, frame.seat)
+                playerName = satisfyClient(data, playerName, seat)
+                if playerName is None:
+                    seats.pop(frame.seat, None)
+                else:
+                    seats[frame.seat] = (seat, playerName)
+        data = receiveFrame(conn)
+        frame = GameData.GameData.deserialize(data) if data else None
+    logging.info("Session closed by: " + str(addr))
+    with mutex:
+        for _, playerName in seats.values():
+            disconnectPlayer(playerName)
 
 
 def manageInput():
@@ -139,36 +782,89 @@ def manageInput():
         data = input()
         if data == "exit":
             logging.info("Closing the server...")
+            if snapshotPath is not None:
+                with mutex:
+                    if status == "Game":
+                        snapshot.dump([tableSnapshot()], snapshotPath)
             os._exit(0)
+        elif data == "stats":
+            with mutex:
+                logSeatTimings()
+            logging.info("Admission: " + admissionStats.to_string())
+        elif data.startswith("profile"):
+            try:
+                manageProfiler(data.split()[1:])
+            except (OSError, ValueError) as e:
+                logging.error("Profiler: " + str(e))
 
 
 def manageNetwork():
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         s.bind((HOST, PORT))
+        s.listen(acceptBacklog)
         logging.info("Hanabi server started on " + HOST + ":" + str(PORT))
         while True:
-            s.listen()
             conn, addr = s.accept()
+            if not handshakeSlots.acquire(blocking=False):
+                rejectConnection(conn)
+                continue
+            admissionStats.accepted += 1
             threading.Thread(target=manageConnection,
-                             args=(conn, addr)).start()
+                             args=(conn, addr, perf_counter())).start()
 
 
-def start_server(nplayers):
-    global numPlayers
+def start_server(nplayers, timeout=None, action=TIMEOUT_ACTIONS[0], bots=None, snapshotFile=None, interval=snapshotInterval,
+                 backlog=acceptBacklog, handshakes=maxHandshakes, joinRate=None, joinBurst=None):
+    global numPlayers, turnTimeout, timeoutAction, fillDelay, snapshotPath, snapshotInterval
+    global acceptBacklog, maxHandshakes, handshakeSlots, joinBucket
+    acceptBacklog = backlog
+    maxHandshakes = handshakes
+    handshakeSlots = threading.BoundedSemaphore(maxHandshakes)
+    if joinRate is not None:
+        joinBucket = TokenBucket(joinRate, joinBurst or max(1, int(joinRate)))
     numPlayers = nplayers
+    turnTimeout = timeout
+    timeoutAction = action
+    fillDelay = bots
+    snapshotPath = snapshotFile
+    snapshotInterval = interval
     logging.basicConfig(filename="game.log", level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s',
                         datefmt="%m/%d/%Y %I:%M:%S %p")
     logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
+    if snapshotPath is not None:
+        if os.path.exists(snapshotPath):
+            restoreSnapshot()
+        timerWheel.schedule(snapshotInterval, takeSnapshot)
+    threading.Thread(target=manageSpectators, daemon=True).start()
     threading.Thread(target=manageNetwork).start()
     manageInput()
 
 
 if __name__ == '__main__':
     signal(SIGPIPE, SIG_DFL)
-    print("Type 'exit' to end the program")
-    if len(sys.argv) > 1:
-        if int(sys.argv[1]) > 1:
-            numPlayers = int(sys.argv[1])
+    parser = argparse.ArgumentParser(description="Hanabi server")
+    parser.add_argument("players", type=int, nargs="?", default=numPlayers)
+    parser.add_argument("--turn-timeout", type=float, default=None,
+                        help="seconds per turn, no deadline by default")
+    parser.add_argument("--timeout-action", choices=TIMEOUT_ACTIONS, default=TIMEOUT_ACTIONS[0])
+    parser.add_argument("--fill-bots", type=float, default=None, metavar="SECONDS",
+                        help="complete the table with server bots after SECONDS")
+    parser.add_argument("--snapshot", default=None, metavar="FILE",
+                        help="save the table in FILE periodically, and restore it on startup")
+    parser.add_argument("--snapshot-interval", type=float, default=snapshotInterval, metavar="SECONDS")
+    parser.add_argument("--accept-backlog", type=int, default=acceptBacklog)
+    parser.add_argument("--max-handshakes", type=int, default=maxHandshakes,
+                        help="connections served before their first request is answered")
+    parser.add_argument("--join-rate", type=float, default=None,
+                        help="players admitted per second, no limit by default")
+    parser.add_argument("--join-burst", type=int, default=None)
+    args = parser.parse_args()
+    print("Type 'exit' to end the program, 'stats' to log the think times, "
+          "'profile start [ms]' and 'profile stop <file>' to profile the server")
+    if args.players > 1:
+        numPlayers = args.players
 
-    start_server(numPlayers)
+    start_server(numPlayers, args.turn_timeout, args.timeout_action, args.fill_bots,
+                 args.snapshot, args.snapshot_interval, args.accept_backlog,
+                 args.max_handshakes, args.join_rate, args.join_burst)
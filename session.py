@@ -0,0 +1,117 @@
+"""Many seats over a single connection to the server.
+
+Every frame of a session is a GameData.SeatFrame carrying the seat id and
+the serialized data of the seat, so that the agents of a process share one
+socket (and one server thread) instead of opening one each. The server
+sends the broadcasts once per session, for all its seats.
+
+    session = Session()
+    agents = [RuleBasedAgent(name, transport=session.seat()) for name in names]
+
+A seat is a socket-like transport for Client: send() wraps the frames of
+the client in seat frames, recv() returns the frames received for the seat
+by the reader thread of the session."""
+import queue
+import socket
+import threading
+import GameData
+from constants import HOST, PORT, DATASIZE
+
+
+def pad(payload: bytes) -> bytes:
+    """Return the frame of DATASIZE bytes of the serialized data (see GameData.serialize)."""
+    return len(payload).to_bytes(2, "little") + payload + bytes(DATASIZE - 2 - len(payload))
+
+
+class SeatTransport:
+    def __init__(self, session, seat: int):
+        self.session = session
+        self.seat = seat
+        self.inbox = queue.SimpleQueue()  # frames, None once the session is closed
+        self.buffer = b""
+
+    def send(self, data: bytes) -> int:
+        self.session.send(GameData.SeatFrame.wrap(self.seat, data))
+        return len(data)
+
+    def recv(self, size: int) -> bytes:
+        if not self.buffer:
+            frame = self.inbox.get()
+            if frame is None:
+                self.inbox.put(None)  # every later call sees the end too
+                return b""
+            self.buffer = frame
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        self.session.send(GameData.SeatFrame(self.seat, None))
+        self.session.remove(self.seat)
+        return
+
+
+class Session:
+    def __init__(self, host=HOST, port=PORT):
+        self.socket = socket.create_connection((host, port))
+        self.seats = dict()  # seat id: SeatTransport
+        self.next_seat = 0
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.reader = threading.Thread(target=self._read_loop, daemon=True)
+        self.reader.start()
+
+    def seat(self) -> SeatTransport:
+        """Return the transport of a new seat."""
+        with self.lock:
+            transport = SeatTransport(self, self.next_seat)
+            self.seats[self.next_seat] = transport
+            self.next_seat += 1
+        return transport
+
+    def remove(self, seat: int):
+        with self.lock:
+            self.seats.pop(seat, None)
+        return
+
+    def send(self, frame: GameData.SeatFrame):
+        data = frame.serialize()
+        with self.send_lock:
+            self.socket.sendall(data)
+        return
+
+    def _receive(self) -> bytes:
+        data = b""
+        while len(data) < DATASIZE:
+            chunk = self.socket.recv(DATASIZE - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def _read_loop(self):
+        """Dispatch the frames received to the seats until the server closes
+        the connection."""
+        while True:
+            try:
+                data = self._receive()
+            except OSError:
+                data = None
+            if data is None:
+                break
+            frame = GameData.GameData.deserialize(data)
+            payload = pad(frame.payload)
+            with self.lock:
+                if frame.seat is None:
+                    seats = list(self.seats.values())
+                else:
+                    seats = [self.seats[frame.seat]] if frame.seat in self.seats else []
+            for seat in seats:
+                seat.inbox.put(payload)
+        with self.lock:
+            seats = list(self.seats.values())
+        for seat in seats:
+            seat.inbox.put(None)
+
+    def close(self):
+        self.socket.close()
+        return
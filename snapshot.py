@@ -0,0 +1,59 @@
+"""Snapshots of the live tables of the server.
+
+fork_dump() forks the server: the child process pickles the tables from
+its copy-on-write view of the memory and writes the file, while the
+parent goes on serving the players. The parent only pauses for the fork
+itself, not for the serialization. The caller must hold the lock of the
+tables while forking, so that the child sees them between two moves.
+
+A snapshot file is MAGIC followed by the zlib compressed pickle of the
+tables, and is replaced atomically."""
+import os
+import pickle
+import zlib
+
+MAGIC = b"HANABI-SNAPSHOT-1\n"
+COMPRESSION_LEVEL = 1
+
+
+def dump(tables, path: str) -> int:
+    """Write the snapshot of the tables and return its size in bytes."""
+    data = MAGIC + zlib.compress(
+        pickle.dumps(tables, pickle.HIGHEST_PROTOCOL), COMPRESSION_LEVEL
+    )
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return len(data)
+
+
+def load(path: str):
+    with open(path, "rb") as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError(f"Not a snapshot: {path}")
+    return pickle.loads(zlib.decompress(data[len(MAGIC) :]))
+
+
+def fork_dump(tables, path: str) -> int:
+    """Write the snapshot from a child process and return its pid.
+    The child exits with status 0 once the file is written."""
+    pid = os.fork()
+    if pid == 0:
+        # only the forking thread exists here: no logging, no locks
+        status = 1
+        try:
+            dump(tables, path)
+            status = 0
+        finally:
+            os._exit(status)
+    return pid
+
+
+def reap(pid: int):
+    """Return None while the child is writing, else True if it succeeded."""
+    done, status = os.waitpid(pid, os.WNOHANG)
+    if done == 0:
+        return None
+    return os.waitstatus_to_exitcode(status) == 0
@@ -0,0 +1,105 @@
+"""Watch the table of a server without playing.
+
+    python spectator.py [NAME] [--full-information] [--record FILE]
+
+A spectator receives the events broadcast to the players (start, hints,
+plays, discards, game over) and, with --full-information, the state of
+the game with every hand after every action. The events are printed, or
+appended to FILE one JSON object per line.
+
+The server sends the events to the spectators after the players, from a
+separate thread: a spectator that does not keep up is disconnected
+instead of slowing down the game."""
+import argparse
+import json
+import socket
+import sys
+import time
+import GameData
+from constants import HOST, PORT, DATASIZE
+
+
+class Spectator:
+    def __init__(self, name, host=HOST, port=PORT, full_information=False):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.full_information = full_information
+        self.socket = None
+
+    def connect(self):
+        self.socket = socket.create_connection((self.host, self.port))
+        request = GameData.ClientSpectatorAddData(self.name, self.full_information)
+        self.socket.send(request.serialize())
+        response = self.receive()
+        if type(response) is not GameData.ServerSpectatorConnectionOk:
+            raise ConnectionError(getattr(response, "message", "Connection refused"))
+        return
+
+    def receive(self) -> GameData.ServerToClientData:
+        """Return the next event, or None if the server closed the connection."""
+        data = b""
+        while len(data) < DATASIZE:
+            chunk = self.socket.recv(DATASIZE - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return GameData.GameData.deserialize(data)
+
+    def events(self):
+        """Yield the events until the server closes the connection."""
+        while True:
+            event = self.receive()
+            if event is None:
+                return
+            yield event
+
+    def close(self):
+        self.socket.close()
+        return
+
+
+def _to_json(value):
+    if hasattr(value, "hand"):  # game.Player
+        return {"name": value.name, "hand": value.hand}
+    if hasattr(value, "toClientString"):  # game.Card
+        return value.toClientString()
+    return str(value)
+
+
+def to_record(event: GameData.ServerToClientData) -> dict:
+    fields = {k: v for k, v in vars(event).items() if k not in ("sender", "action")}
+    return {"time": time.time(), "event": type(event).__name__, **fields}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("name", nargs="?", default="spectator")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--full-information", action="store_true")
+    parser.add_argument("--record", default=None, help="append the events here")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    spectator = Spectator(args.name, args.host, args.port, args.full_information)
+    spectator.connect()
+    out = sys.stdout if args.record is None else open(args.record, "a")
+    try:
+        for event in spectator.events():
+            out.write(json.dumps(to_record(event), default=_to_json))
+            out.write("\n")
+            out.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        spectator.close()
+        if out is not sys.stdout:
+            out.close()
+    return
+
+
+if __name__ == "__main__":
+    main()
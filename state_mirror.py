@@ -0,0 +1,132 @@
+import logging
+import GameData
+from game import Player
+
+
+def copy_state(state: GameData.ServerGameStateData) -> GameData.ServerGameStateData:
+    """Return a copy of the state that can be modified without touching
+    the hands, piles and lists of the original one."""
+    players = []
+    for p in state.players:
+        player = Player(p.name)
+        player.hand = list(p.hand)
+        players.append(player)
+    return GameData.ServerGameStateData(
+        state.currentPlayer,
+        state.handSize,
+        players,
+        state.usedNoteTokens,
+        state.usedStormTokens,
+        {color: list(pile) for color, pile in state.tableCards.items()},
+        list(state.discardPile),
+        state.actions,
+    )
+
+
+def state_checksum(state: GameData.ServerGameStateData) -> int:
+    """Return a checksum of everything a client can see of the game."""
+    return hash(
+        (
+            state.currentPlayer,
+            state.handSize,
+            state.usedNoteTokens,
+            state.usedStormTokens,
+            tuple((p.name, tuple(c.id for c in p.hand)) for p in state.players),
+            tuple(
+                (color, tuple(c.id for c in pile))
+                for color, pile in sorted(state.tableCards.items())
+            ),
+            tuple(c.id for c in state.discardPile),
+        )
+    )
+
+
+class StateMirror:
+    """A client-side copy of the ServerGameStateData, updated by applying
+    the actions notified by the server, so that the client does not have
+    to request the whole state after every action.
+
+    The only thing the action messages do not carry is the card drawn by
+    another player: in that case apply returns None and the state has to
+    be fetched (see reset). Every `resync_interval` actions applied without
+    a fetch, needs_resync becomes true: the caller should fetch the state
+    and call verify, which compares the checksums and adopts the server
+    state on mismatch."""
+
+    def __init__(
+        self,
+        player_name: str,
+        state: GameData.ServerGameStateData,
+        resync_interval=10,
+    ):
+        self.player_name = player_name
+        self.resync_interval = resync_interval
+        self.state = None
+        self.applied = 0  # actions applied since the last fetch
+        self.mismatches = 0
+        self.reset(state)
+
+    def reset(self, state: GameData.ServerGameStateData):
+        """Adopt the state received from the server."""
+        self.state = copy_state(state)
+        self.applied = 0
+        return
+
+    @property
+    def needs_resync(self) -> bool:
+        return self.applied >= self.resync_interval
+
+    def verify(self, state: GameData.ServerGameStateData) -> bool:
+        """Compare the mirror with the state received from the server,
+        then adopt the server state. Return True if they matched."""
+        ok = state_checksum(self.state) == state_checksum(state)
+        if not ok:
+            self.mismatches += 1
+            logging.warning(f"{self.player_name} - state mirror out of sync")
+        self.reset(state)
+        return ok
+
+    def apply(self, data: GameData.ServerToClientData) -> GameData.ServerGameStateData:
+        """Apply the action notified by the server and return the new state,
+        or None if the state cannot be computed and must be fetched.
+        The returned state is never modified afterwards."""
+        state = copy_state(self.state)
+
+        if type(data) is GameData.ServerHintData:
+            state.usedNoteTokens += 1
+        elif type(data) is GameData.ServerActionValid:
+            state.usedNoteTokens -= 1
+            state.discardPile.append(data.card)
+        elif type(data) is GameData.ServerPlayerMoveOk:
+            state.tableCards[data.card.color].append(data.card)
+            if data.card.value == 5 and state.usedNoteTokens > 0:
+                state.usedNoteTokens -= 1
+        elif type(data) is GameData.ServerPlayerThunderStrike:
+            state.usedStormTokens += 1
+            state.discardPile.append(data.card)
+        else:
+            raise ValueError(f"Invalid action response: {data}")
+        state.currentPlayer = data.player
+        state.actions += 1
+
+        if type(data) is not GameData.ServerHintData:
+            if data.lastPlayer == self.player_name:
+                # my own cards are not in the state: just track their number
+                state.handSize = data.handLength
+            else:
+                hand = self._get_player(state, data.lastPlayer).hand
+                drawn = data.handLength == len(hand)
+                hand.pop(data.cardHandIndex)
+                if drawn:
+                    return None  # the drawn card is only known by the server
+
+        self.state = state
+        self.applied += 1
+        return state
+
+    @staticmethod
+    def _get_player(state: GameData.ServerGameStateData, name: str) -> Player:
+        for p in state.players:
+            if p.name == name:
+                return p
+        raise ValueError(f"Unknown player: {name}")
@@ -0,0 +1,72 @@
+"""Hashed timing wheel: a single thread fires the timers of every table.
+
+The wheel is a ring of `slots` buckets, one per tick. A timer due in d
+seconds goes into the bucket of the first tick after now + d, so scheduling
+and cancelling cost O(1) whatever the number of timers, and every tick
+only looks at the timers of one bucket (those due a whole turn of the
+wheel later stay there). Timers fire up to one tick late, never early."""
+import logging
+import threading
+from math import ceil
+from time import monotonic, sleep
+
+
+class Timer:
+    __slots__ = ("tick", "callback", "args", "cancelled")
+
+    def __init__(self, tick: int, callback, args: tuple):
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+
+class TimerWheel:
+    def __init__(self, tick=0.05, slots=512):
+        self.tick = tick
+        self.slots = slots
+        self.buckets = [set() for _ in range(slots)]
+        self.current = 0  # ticks elapsed since the start
+        self.lock = threading.Lock()
+        self.start = None
+        self.thread = None
+
+    def __len__(self) -> int:
+        with self.lock:
+            return sum(len(bucket) for bucket in self.buckets)
+
+    def schedule(self, delay: float, callback, *args) -> Timer:
+        """Call callback(*args) from the wheel thread in `delay` seconds."""
+        with self.lock:
+            if self.thread is None:
+                self.start = monotonic()
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+            tick = ceil((monotonic() + delay - self.start) / self.tick)
+            timer = Timer(max(tick, self.current + 1), callback, args)
+            self.buckets[timer.tick % self.slots].add(timer)
+        return timer
+
+    def cancel(self, timer: Timer):
+        with self.lock:
+            timer.cancelled = True
+            self.buckets[timer.tick % self.slots].discard(timer)
+        return
+
+    def _run(self):
+        while True:
+            delay = self.start + (self.current + 1) * self.tick - monotonic()
+            if delay > 0:
+                sleep(delay)
+            with self.lock:
+                self.current += 1
+                bucket = self.buckets[self.current % self.slots]
+                due = [timer for timer in bucket if timer.tick <= self.current]
+                bucket.difference_update(due)
+            for timer in due:
+                if timer.cancelled:
+                    continue
+                try:
+                    timer.callback(*timer.args)
+                except Exception:
+                    logging.exception("Timer callback failed")
@@ -0,0 +1,378 @@
+"""Compare agent configurations over a fixed corpus of seeded decks.
+
+Every configuration plays the same games: for each number of players and
+each seed the deck (see Game.start) and the random choices of the rules
+are the same, so the scores of two configurations can be compared game by
+game. A configuration changes the order of the rules and/or the class
+attributes of the rules, e.g. a configs file
+
+    [
+        {"name": "baseline"},
+        {"name": "bold", "overrides": {"PlayAlmostSafeCard.PLAY_TRESHOLD": 0.5}},
+        {"name": "hints first", "rules": ["HintPlayableCard", "PlaySafeCard",
+                                          "DiscardLessUsefulCard"]}
+    ]
+
+    python tournament.py [--configs FILE] [--seeds N] [--players 2 3 4 5]
+                         [--workers W] [--json FILE] [--csv FILE]
+                         [--sequential [--batch-size B] [--alpha A] [--margin M]
+                                       [--min-games G]]
+
+The first configuration is the baseline of the paired differences.
+
+With --sequential the games are played in batches and every configuration
+stops as soon as the confidence interval of its mean paired difference
+with the baseline excludes 0 (or lies within +-margin), so that the
+obviously better or worse configurations do not use the whole corpus.
+The intervals are widened so that repeatedly looking at the data keeps
+the error rate below alpha (see sequential_tournament). No configuration
+is decided before it has played G paired games (20 by default)."""
+import argparse
+import csv
+import json
+import logging
+import os
+import random
+import sys
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from statistics import NormalDist, mean, median, stdev
+import rules as rl
+from local_game import LocalGame
+from rule_pipeline import RulePipeline
+
+MAX_SCORE = 25
+MAX_STORM_TOKENS = 3
+DEFAULT_CONFIGS = [{"name": "baseline"}]
+MIN_DECISION_GAMES = 20  # paired games before a comparison can be decided
+MIN_STDEV = 1.0  # floor of the stdev of the differences: the score resolution
+
+
+@contextmanager
+def configured(config: dict):
+    """Apply the class attribute overrides of the configuration and
+    return its RulePipeline. The attributes are restored on exit."""
+    saved = []
+    try:
+        for target, value in config.get("overrides", {}).items():
+            class_name, attribute = target.split(".")
+            rule = getattr(rl, class_name)
+            saved.append((rule, attribute, rule.__dict__.get(attribute)))
+            setattr(rule, attribute, value)
+        rules = None
+        if "rules" in config:
+            rules = [getattr(rl, name) for name in config["rules"]]
+        # overrides must be in place before the pipeline is compiled
+        yield RulePipeline(rules)
+    finally:
+        for rule, attribute, value in reversed(saved):
+            if value is None:
+                delattr(rule, attribute)
+            else:
+                setattr(rule, attribute, value)
+    return
+
+
+def play_match(config: dict, n_players: int, seed: int) -> dict:
+    """Play the seeded game with the given configuration."""
+    random.seed(seed)
+    with configured(config) as pipeline:
+        local_game = LocalGame(n_players, policy=pipeline, seed=seed)
+        score = local_game.play()
+    return {
+        "config": config["name"],
+        "players": n_players,
+        "seed": seed,
+        "score": score,
+        "struck_out": local_game.game.getStormTokens() == MAX_STORM_TOKENS,
+    }
+
+
+def _init_worker():
+    """Silence the game in the worker processes."""
+    logging.getLogger().setLevel(logging.WARNING)
+    sys.stdout = open(os.devnull, "w")
+
+
+def run_games(executor, tasks: list) -> list:
+    """Play the (config, n_players, seed) tasks over the executor."""
+    chunksize = max(1, len(tasks) // (8 * (os.cpu_count() or 1)))
+    return list(executor.map(play_match, *zip(*tasks), chunksize=chunksize))
+
+
+def summarize(results: list) -> dict:
+    """Return the score statistics of the given games."""
+    scores = [r["score"] for r in results]
+    histogram = [0] * (MAX_SCORE + 1)
+    for score in scores:
+        histogram[score] += 1
+    return {
+        "games": len(scores),
+        "mean": mean(scores),
+        "median": median(scores),
+        "strike_out_rate": sum(r["struck_out"] for r in results) / len(results),
+        "histogram": histogram,
+    }
+
+
+def paired_differences(results: list, baseline: str) -> dict:
+    """Return, for every configuration, the score differences with the
+    baseline on the same games, keyed by (players, seed)."""
+    scores = defaultdict(dict)
+    for r in results:
+        scores[r["config"]][(r["players"], r["seed"])] = r["score"]
+    base = scores[baseline]
+    return {
+        name: {game: score - base[game] for game, score in games.items() if game in base}
+        for name, games in scores.items()
+        if name != baseline
+    }
+
+
+def report(results: list, configs: list) -> dict:
+    baseline = configs[0]["name"]
+    by_config = defaultdict(list)
+    for r in results:
+        by_config[r["config"]].append(r)
+
+    summary = dict()
+    for config in configs:
+        games = by_config[config["name"]]
+        by_players = defaultdict(list)
+        for r in games:
+            by_players[r["players"]].append(r)
+        summary[config["name"]] = {
+            **summarize(games),
+            "by_players": {n: summarize(g) for n, g in sorted(by_players.items())},
+        }
+
+    paired = dict()
+    for name, diffs in paired_differences(results, baseline).items():
+        values = list(diffs.values())
+        paired[name] = {
+            "baseline": baseline,
+            "games": len(values),
+            "mean_diff": mean(values),
+            "stderr": stdev(values) / len(values) ** 0.5 if len(values) > 1 else None,
+            "wins": sum(d > 0 for d in values),
+            "losses": sum(d < 0 for d in values),
+            "diffs": [
+                {"players": players, "seed": seed, "diff": d}
+                for (players, seed), d in sorted(diffs.items())
+            ],
+        }
+    return {"configs": summary, "paired": paired}
+
+
+def write_csv(path: str, results: list, baseline: str):
+    """Write one row per game, with the difference with the baseline."""
+    diffs = paired_differences(results, baseline)
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(
+            ["config", "players", "seed", "score", "struck_out", "diff_vs_baseline"]
+        )
+        for r in results:
+            diff = diffs.get(r["config"], {}).get((r["players"], r["seed"]), "")
+            writer.writerow(
+                [r["config"], r["players"], r["seed"], r["score"], r["struck_out"], diff]
+            )
+    return
+
+
+def print_summary(summary: dict):
+    for name, s in summary["configs"].items():
+        print(
+            f"{name:>16}: {s['games']} games, mean {s['mean']:.2f}, "
+            f"median {s['median']}, strike-outs {s['strike_out_rate']:.1%}"
+        )
+    for name, p in summary["paired"].items():
+        stderr = "" if p["stderr"] is None else f" +- {p['stderr']:.2f}"
+        print(
+            f"{name:>16}: {p['mean_diff']:+.2f}{stderr} vs {p['baseline']} "
+            f"({p['wins']} wins, {p['losses']} losses)"
+        )
+    return
+
+
+def spent_alpha(alpha: float, t: float) -> float:
+    """O'Brien-Fleming-like alpha spending function (Lan-DeMets): the
+    error rate spent once a fraction t of the budget has been played.
+    Little is spent at the first looks, almost the whole alpha at the end."""
+    if t <= 0:
+        return 0.0
+    z = NormalDist().inv_cdf(1 - alpha / 2)
+    return 2 - 2 * NormalDist().cdf(z / min(t, 1.0) ** 0.5)
+
+
+def confidence_interval(diffs: list, alpha: float) -> tuple:
+    """Return the normal approximation (1 - alpha) confidence interval
+    of the mean of the differences. The stdev is floored at MIN_STDEV, so
+    that a few equal differences do not give a zero-width interval."""
+    m = mean(diffs)
+    se = max(stdev(diffs), MIN_STDEV) / len(diffs) ** 0.5
+    z = NormalDist().inv_cdf(1 - alpha / 2)
+    return m - z * se, m + z * se
+
+
+def sequential_tournament(
+    executor,
+    configs: list,
+    games: list,
+    batch_size: int,
+    alpha=0.05,
+    margin=0.0,
+    min_games=MIN_DECISION_GAMES,
+) -> tuple:
+    """Play the (n_players, seed) games in batches, stopping every
+    configuration as soon as its comparison with the baseline is decided.
+
+    At each look the interval of a configuration is computed at the level
+    spent since its previous look (see spent_alpha): by the union bound
+    the probability of a wrong decision over all the looks stays below
+    alpha. A configuration is decided "better" or "worse" when its
+    interval excludes 0, "equivalent" when it lies within +-margin, and
+    only after min_games paired games.
+    Return the results of the games and the decisions."""
+    baseline, *others = configs
+    active = {config["name"]: config for config in others}
+    decisions = {
+        name: {"decision": "undecided", "looks": 0, "spent_alpha": 0.0}
+        for name in active
+    }
+    results = []
+    played = 0
+    while active and played < len(games):
+        batch = games[played : played + batch_size]
+        played += len(batch)
+        tasks = [
+            (config, n_players, seed)
+            for config in [baseline, *active.values()]
+            for n_players, seed in batch
+        ]
+        results += run_games(executor, tasks)
+
+        diffs = paired_differences(results, baseline["name"])
+        for name in list(active):
+            values = list(diffs[name].values())
+            decision = decisions[name]
+            total_spent = spent_alpha(alpha, played / len(games))
+            look_alpha = total_spent - decision["spent_alpha"]
+            decision["spent_alpha"] = total_spent
+            decision["looks"] += 1
+            decision["games"] = len(values)
+            decision["mean_diff"] = mean(values)
+            if len(values) < max(min_games, 2) or look_alpha <= 0:
+                continue
+            low, high = confidence_interval(values, look_alpha)
+            decision["ci"] = [low, high]
+            if low > 0:
+                decision["decision"] = "better"
+            elif high < 0:
+                decision["decision"] = "worse"
+            elif margin > 0 and -margin < low and high < margin:
+                decision["decision"] = "equivalent"
+            else:
+                continue
+            del active[name]
+
+    budget = len(configs) * len(games)
+    games_played = len(results)
+    summary = {
+        "alpha": alpha,
+        "margin": margin,
+        "budget": budget,
+        "games_played": games_played,
+        "games_saved": budget - games_played,
+        "decisions": decisions,
+    }
+    return results, summary
+
+
+def print_sequential(sequential: dict):
+    for name, d in sequential["decisions"].items():
+        ci = d.get("ci")
+        ci = "" if ci is None else f", CI [{ci[0]:+.2f}, {ci[1]:+.2f}]"
+        print(f"{name:>16}: {d['decision']} after {d['games']} games{ci}")
+    print(
+        f"{sequential['games_played']} of {sequential['budget']} games played, "
+        f"{sequential['games_saved']} saved"
+    )
+    return
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--configs", default=None, help="JSON list of configurations")
+    parser.add_argument("--seeds", type=int, default=100, help="games per player count")
+    parser.add_argument("--first-seed", type=int, default=0)
+    parser.add_argument("--players", type=int, nargs="+", default=[2, 3, 4, 5])
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--json", default=None, help="write the report here")
+    parser.add_argument("--csv", default=None, help="write the games here")
+    parser.add_argument(
+        "--sequential", action="store_true", help="stop the decided configurations"
+    )
+    parser.add_argument("--batch-size", type=int, default=None)
+    parser.add_argument("--alpha", type=float, default=0.05)
+    parser.add_argument(
+        "--margin",
+        type=float,
+        default=0.0,
+        help="differences within +-margin are equivalent (default: disabled)",
+    )
+    parser.add_argument(
+        "--min-games",
+        type=int,
+        default=MIN_DECISION_GAMES,
+        help="paired games before a configuration can be decided",
+    )
+    return parser.parse_args()
+
+
+def load_configs(path: str) -> list:
+    if path is None:
+        return DEFAULT_CONFIGS
+    with open(path) as f:
+        return json.load(f)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    configs = load_configs(args.configs)
+    seeds = range(args.first_seed, args.first_seed + args.seeds)
+    sequential = None
+    with ProcessPoolExecutor(args.workers, initializer=_init_worker) as executor:
+        if args.sequential:
+            # every batch covers all the player counts evenly
+            games = [(n_players, seed) for seed in seeds for n_players in args.players]
+            batch_size = args.batch_size or 10 * len(args.players)
+            results, sequential = sequential_tournament(
+                executor,
+                configs,
+                games,
+                batch_size,
+                args.alpha,
+                args.margin,
+                args.min_games,
+            )
+        else:
+            tasks = [
+                (config, n_players, seed)
+                for config in configs
+                for n_players in args.players
+                for seed in seeds
+            ]
+            results = run_games(executor, tasks)
+
+    summary = report(results, configs)
+    print_summary(summary)
+    if sequential is not None:
+        summary["sequential"] = sequential
+        print_sequential(sequential)
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+    if args.csv is not None:
+        write_csv(args.csv, results, configs[0]["name"])
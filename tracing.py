@@ -0,0 +1,79 @@
+"""Structured tracing for the agents and the model.
+
+Trace events are kept in memory, in a ring buffer holding the last
+`capacity` events, and written only when flush is called. Call sites must
+check the flag before building the event, so that nothing is formatted or
+allocated when tracing is disabled:
+
+    if tracing.ENABLED:
+        tracing.event("hint_received", player=name, sender=hint._from)
+
+Tracing is enabled by enable(), or at import time by setting the
+HANABI_TRACE environment variable to the capacity of the buffer."""
+import json
+import os
+import threading
+from collections import deque
+from time import perf_counter
+
+DEFAULT_CAPACITY = 65536
+
+ENABLED = False
+_buffer = deque(maxlen=DEFAULT_CAPACITY)
+
+
+def enable(capacity=DEFAULT_CAPACITY):
+    global ENABLED, _buffer
+    if capacity != _buffer.maxlen:
+        _buffer = deque(_buffer, maxlen=capacity)
+    ENABLED = True
+    return
+
+
+def disable():
+    global ENABLED
+    ENABLED = False
+    return
+
+
+def event(name: str, **fields):
+    """Record an event. Values are stored as they are and converted
+    only by flush."""
+    _buffer.append((perf_counter(), threading.get_ident(), name, fields))
+    return
+
+
+def records() -> list:
+    """Return the buffered events as dictionaries, without removing them."""
+    return [
+        {"time": t, "thread": thread, "event": name, **fields}
+        for t, thread, name, fields in list(_buffer)
+    ]
+
+
+def _to_json(value):
+    if hasattr(value, "tolist"):  # numpy arrays and scalars
+        return value.tolist()
+    if hasattr(value, "toClientString"):  # game.Card
+        return value.toClientString()
+    if isinstance(value, (set, frozenset)):
+        return sorted(map(_to_json, value))
+    return str(value)
+
+
+def flush(path: str) -> int:
+    """Append the buffered events to `path`, one JSON object per line,
+    empty the buffer and return the number of events written."""
+    events = []
+    while _buffer:  # popleft is atomic: other threads can keep recording
+        events.append(_buffer.popleft())
+    with open(path, "a") as f:
+        for t, thread, name, fields in events:
+            record = {"time": t, "thread": thread, "event": name, **fields}
+            f.write(json.dumps(record, default=_to_json))
+            f.write("\n")
+    return len(events)
+
+
+if os.environ.get("HANABI_TRACE"):
+    enable(int(os.environ["HANABI_TRACE"]))